@@ -0,0 +1,176 @@
+"""
+Admission control: turning away downloads the system cannot take on right now.
+
+Every admitted job is recorded with its predicted cost (`scheduler.predict_cost`, in units of
+about 10 MB) until it ends. A new download (a job, `/start`, `/stream` or a whole batch) is
+refused with `Rejected`, which the routes answer with 429 and a `Retry-After`, when
+  - its client already has ADMISSION_CLIENT_JOBS jobs or ADMISSION_CLIENT_COST cost units open
+  - the open cost plus its own would take the RQ workers longer than ADMISSION_MAX_WAIT seconds
+    (each worker is assumed to get through a cost unit in ADMISSION_UNIT_SECONDS)
+  - the open jobs and this one would leave less than ADMISSION_MIN_FREE_DISK free in DOWNLOAD_DIR
+`Retry-After` is the time the backlog needs to drain to where the download would be admitted.
+A zero setting disables its check; without Redis every download is admitted.
+
+Ledger in Redis:
+  admit:leases         sorted set  job id -> lease expiry (a job that never ends drops out)
+  admit:cost           hash        job id -> cost units
+  admit:owner          hash        job id -> client id
+  admit:client:{id}    sorted set  job id -> lease expiry, the client's open jobs
+"""
+import os
+import math
+import time
+import shutil
+from redis.exceptions import RedisError, WatchError
+from yt_dlp.utils import parse_bytes
+import metrics
+from downloader import DOWNLOAD_DIR
+
+# Longest predicted time for the open work plus a new job before new jobs are refused
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '900'))
+# Seconds one worker needs for a cost unit (~10 MB of media): extraction, download and processing
+ADMISSION_UNIT_SECONDS = float(os.getenv('ADMISSION_UNIT_SECONDS', '5'))
+# Disk space that has to stay free after every open job has written its file
+ADMISSION_MIN_FREE_DISK = parse_bytes(os.getenv('ADMISSION_MIN_FREE_DISK', '2G') or '0') or 0
+# Open jobs and cost units per client (API token or IP)
+ADMISSION_CLIENT_JOBS = int(os.getenv('ADMISSION_CLIENT_JOBS', '20'))
+ADMISSION_CLIENT_COST = float(os.getenv('ADMISSION_CLIENT_COST', '300'))
+# Upper bound for a job whose end was never recorded, e.g. lost with its worker
+LEASE_SECONDS = 6 * 60 * 60
+# Retry-After when only freed disk space can help and no backlog is left to wait for
+DISK_RETRY_SECONDS = 60
+
+_LEASES = 'admit:leases'
+_COST = 'admit:cost'
+_OWNER = 'admit:owner'
+
+
+class Rejected(Exception):
+    """A download refused for now; `retry_after` is in whole seconds."""
+
+    def __init__(self, message: str, reason: str, retry_after: float):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def _workers(client):
+    from rq import Worker
+    return Worker.count(connection=client)
+
+
+def _sweep(client, now):
+    expired = [job_id.decode('utf-8') for job_id in client.zrangebyscore(_LEASES, '-inf', now)]
+    for job_id in expired:
+        release(client, job_id)
+
+
+def _record(pipe, job_id, client_id, cost):
+    expires = time.time() + LEASE_SECONDS
+    pipe.zadd(_LEASES, {job_id: expires})
+    pipe.hset(_COST, job_id, cost)
+    pipe.hset(_OWNER, job_id, client_id)
+    pipe.zadd(f'admit:client:{client_id}', {job_id: expires})
+    pipe.expire(f'admit:client:{client_id}', LEASE_SECONDS)
+
+
+def record(client, job_id: str, client_id: str, cost: float):
+    """Count `job_id` as open work of `client_id` until `release`."""
+    try:
+        pipe = client.pipeline()
+        _record(pipe, job_id, client_id, cost)
+        pipe.execute()
+    except RedisError as e:
+        print(f'[WARN] Could not record admitted job {job_id}: {e}', flush=True)
+
+
+def release(client, job_id: str):
+    """The job ended (or was cancelled before it ran); safe to call more than once."""
+    try:
+        owner = client.hget(_OWNER, job_id)
+        pipe = client.pipeline()
+        pipe.zrem(_LEASES, job_id)
+        pipe.hdel(_COST, job_id)
+        pipe.hdel(_OWNER, job_id)
+        if owner:
+            pipe.zrem(f'admit:client:{owner.decode("utf-8")}', job_id)
+        pipe.execute()
+    except RedisError as e:
+        print(f'[WARN] Could not release admitted job {job_id}: {e}', flush=True)
+
+
+def _open_cost(client, job_ids):
+    if not job_ids:
+        return 0.0
+    return sum(float(cost or 0) for cost in client.hmget(_COST, job_ids))
+
+
+def _decide(cost, jobs, backlog, mine, my_cost, workers):
+    """The `Rejected` for a download of `cost` units against the open work, or None to admit it."""
+    from scheduler import COST_UNIT_BYTES  # the scheduler records admitted jobs through this module
+    # cost units the workers get through per second
+    rate = max(workers, 1) / ADMISSION_UNIT_SECONDS
+
+    if ADMISSION_CLIENT_JOBS and len(mine) + jobs > ADMISSION_CLIENT_JOBS:
+        # one of the client's jobs has to end; on average they are this long
+        return Rejected(f'Too many downloads in progress for this client (at most {ADMISSION_CLIENT_JOBS})',
+                        'client_jobs', my_cost / len(mine) * ADMISSION_UNIT_SECONDS if mine else 0)
+    if ADMISSION_CLIENT_COST and mine and my_cost + cost > ADMISSION_CLIENT_COST:
+        return Rejected('This client has too much queued already; wait for some downloads to finish',
+                        'client_cost', (my_cost + cost - ADMISSION_CLIENT_COST) * ADMISSION_UNIT_SECONDS)
+    if ADMISSION_MAX_WAIT and backlog and (backlog + cost) / rate > ADMISSION_MAX_WAIT:
+        # a job too big for the budget on its own waits for an empty backlog instead
+        wait = backlog / rate if cost / rate > ADMISSION_MAX_WAIT else (backlog + cost) / rate - ADMISSION_MAX_WAIT
+        return Rejected('The server is busy, try again later', 'backlog', wait)
+    if ADMISSION_MIN_FREE_DISK:
+        try:
+            free = shutil.disk_usage(DOWNLOAD_DIR).free
+        except OSError:
+            free = None
+        if free is not None and free - (backlog + cost) * COST_UNIT_BYTES < ADMISSION_MIN_FREE_DISK:
+            return Rejected('Not enough disk space for more downloads, try again later',
+                            'disk', backlog / rate if backlog else DISK_RETRY_SECONDS)
+    return None
+
+
+def check(client, client_id: str, cost: float, jobs: int = 1, job_id: str = None):
+    """Raise `Rejected` if a download of `cost` units from `client_id` should not start now.
+    `jobs` is how many jobs it keeps open at once (a batch's concurrent entries).
+    With `job_id`, an admitted job is `record`ed in the same transaction as the check: the open
+    work is watched, so concurrent admissions can't all take the last of a limit."""
+    if client is None:
+        return
+    mine_key = f'admit:client:{client_id}'
+    try:
+        workers = _workers(client)
+        _sweep(client, time.time())
+        with client.pipeline() as pipe:
+            while True:
+                try:
+                    # every record and release writes the cost hash
+                    pipe.watch(_COST, mine_key)
+                    backlog = sum(float(value) for value in pipe.hvals(_COST))
+                    mine = [member.decode('utf-8') for member in pipe.zrangebyscore(mine_key, time.time(), '+inf')]
+                    rejected = _decide(cost, jobs, backlog, mine, _open_cost(pipe, mine), workers)
+                    if rejected is None and job_id is not None:
+                        pipe.multi()
+                        _record(pipe, job_id, client_id, cost)
+                        pipe.execute()
+                    else:
+                        pipe.unwatch()
+                    break
+                except WatchError:
+                    continue
+    except RedisError as e:
+        print(f'[WARN] Admission control unavailable, admitting: {e}', flush=True)
+        if job_id is not None:
+            record(client, job_id, client_id, cost)
+        return
+    metrics.ADMISSIONS.labels(rejected.reason if rejected else 'admitted').inc()
+    if rejected is not None:
+        raise rejected
+
+
+def admit(client, job_id: str, client_id: str, cost: float):
+    """`check` and `record` the job at once; for downloads that do not go through the scheduler."""
+    check(client, client_id, cost, job_id=job_id)
@@ -0,0 +1,373 @@
+"""
+ASGI entry point: the long-lived connections on asyncio, everything else through the Flask app.
+
+  GET  /jobs/{job_id}/events  Server-Sent Events; all watchers of a process share one pub/sub connection
+  GET  /jobs/{job_id}/file    finished files (Range, ETag, pacing as in `serving`); uvicorn has no
+                              sendfile(), so deployments leave the body to the proxy (SENDFILE_MODE)
+  GET  /stream                pass-through download, admitted like /start
+  POST /start                 synchronous download, run on a bounded thread pool and cancelled
+                              if the client disconnects; refused with 429 as in `admission`
+Any other path is handed to `web_app.app` on a2wsgi's thread pool, so the routes, template and
+API stay the same. A watcher or a transfer costs a coroutine instead of a WSGI thread, so a few
+worker processes hold thousands of them; blocking calls (Redis state reads, file reads, yt-dlp)
+run in threads only for as long as they block.
+
+Run with: gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import functools
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import anyio
+import redis.asyncio
+from redis.exceptions import RedisError
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+import cancel
+import clips
+import admission
+import storage
+import metrics
+import progress
+import jobstore
+import bandwidth
+import scheduler
+import serving
+import streaming
+import web_app
+from downloader import download_media
+from tasks import redis_conn
+
+# Threads running blocking /start downloads, and how many more may wait for one before
+# /start answers 503
+ASGI_DOWNLOAD_THREADS = int(os.getenv('ASGI_DOWNLOAD_THREADS', '4'))
+ASGI_DOWNLOAD_BACKLOG = int(os.getenv('ASGI_DOWNLOAD_BACKLOG', '16'))
+# Threads serving the routes left to the Flask app
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '16'))
+SSE_KEEPALIVE_SECONDS = web_app.SSE_KEEPALIVE_SECONDS
+
+_downloads = ThreadPoolExecutor(ASGI_DOWNLOAD_THREADS, thread_name_prefix='download')
+_pending_downloads = 0
+
+
+class _Hub:
+    """One pub/sub connection per process for all SSE watchers: each job channel is subscribed
+    while it has watchers, and a single reader task fans messages out to their queues."""
+
+    def __init__(self):
+        self.client = None
+        self.pubsub = None
+        self.queues = {}
+        self._reader = None
+
+    async def subscribe(self, channel):
+        queue = asyncio.Queue()
+        watchers = self.queues.setdefault(channel, set())
+        watchers.add(queue)
+        if len(watchers) == 1:
+            try:
+                if self.pubsub is None:
+                    self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                await self.pubsub.subscribe(channel)
+            except (RedisError, OSError) as e:
+                # the watcher still gets the keep-alive state reads
+                print(f'[WARN] Could not subscribe to {channel}: {e}', flush=True)
+                del self.queues[channel]
+                return queue
+            # only now does the pub/sub connection exist to be read from
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+        return queue
+
+    async def unsubscribe(self, channel, queue):
+        watchers = self.queues.get(channel)
+        if watchers is None or queue not in watchers:
+            return
+        watchers.discard(queue)
+        if not watchers:
+            del self.queues[channel]
+            try:
+                await self.pubsub.unsubscribe(channel)
+            except (RedisError, OSError):
+                pass
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except (RedisError, OSError) as e:
+                print(f'[WARN] Progress subscription lost: {e}', flush=True)
+                await asyncio.sleep(1)
+                continue
+            if message is None or message.get('type') != 'message':
+                continue
+            for queue in self.queues.get(message['channel'].decode('utf-8'), ()):
+                queue.put_nowait(message['data'])
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        if self.client is not None:
+            await self.client.aclose()
+
+
+hub = _Hub()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # the asyncio client is bound to the worker's event loop, so it is made here
+    hub.client = redis.asyncio.Redis.from_url(jobstore.REDIS_URL)
+    try:
+        yield
+    finally:
+        await hub.close()
+        _downloads.shutdown(wait=False)
+
+
+def _timed(endpoint):
+    # handler latency under the Flask endpoint names; bodies streamed afterwards are timed as `transfer`
+    def wrap(handler):
+        @functools.wraps(handler)
+        async def timed(request):
+            started = time.perf_counter()
+            response = await handler(request)
+            metrics.REQUEST_SECONDS.labels(endpoint, request.method, str(response.status_code)).observe(time.perf_counter() - started)
+            return response
+        return timed
+    return wrap
+
+
+def _client_id(request):
+    # same as web_app._client_id: the API token, else the address seen by the trusted proxies
+    address = scheduler.client_address(request.headers.get('X-Forwarded-For'), request.client.host if request.client else None)
+    return scheduler.client_id_for(request.headers.get('X-API-Token'), address)
+
+
+async def _paced(chunks, client_id, ingress=False):
+    """Async body over a blocking chunk iterator: each read runs in a thread and bandwidth
+    debts are slept on the event loop. `chunks` is closed however the transfer ends."""
+    buckets = bandwidth.served_buckets(client_id, ingress)
+    try:
+        while True:
+            chunk = await run_in_threadpool(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+            if buckets:
+                wait = await run_in_threadpool(bandwidth.wait_for, redis_conn, buckets, len(chunk))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+    finally:
+        # also on disconnect: releases the quota pin, or stops the yt-dlp subprocess
+        with anyio.CancelScope(shield=True):
+            await run_in_threadpool(chunks.close)
+
+
+class _ClosingResponse(StreamingResponse):
+    """StreamingResponse that runs the blocking `on_close` however the response ends, also when
+    the client leaves before the body starts (the body's own `finally` then never runs)."""
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(self.on_close)
+
+
+async def _file_response(request, path):
+    client_id = _client_id(request)
+    prepared = await run_in_threadpool(serving.prepare, path, request.headers, None, True, client_id)
+    headers = dict(prepared.headers.items())
+    if prepared.file is None:
+        return Response(status_code=prepared.status, headers=headers)
+    # not zero-copy: every chunk is read on the thread pool (see SENDFILE_MODE)
+    body = _paced(serving.read_range(prepared.file, prepared.length), client_id)
+    return StreamingResponse(body, status_code=prepared.status, headers=headers)
+
+
+def _state(request, job_id):
+    # blocking (two Redis round trips at most); run it in a thread
+    return web_app._job_states([job_id], file_url=lambda job_id: str(request.app.url_path_for('job_file', job_id=job_id)))[0]
+
+
+@_timed('job_events')
+async def job_events(request):
+    job_id = request.path_params['job_id']
+    if await run_in_threadpool(_state, request, job_id) is None:
+        return JSONResponse({'error': 'Unknown job'}, status_code=404)
+
+    async def stream():
+        channel = progress.channel(job_id)
+        queue = await hub.subscribe(channel)
+        try:
+            # read the state after subscribing so no update is missed in between
+            state = await run_in_threadpool(_state, request, job_id) or {'status': 'error', 'error': 'Unknown job'}
+            yield f'data: {json.dumps(state)}\n\n'
+            while state.get('status') not in jobstore.FINAL_STATUSES:
+                try:
+                    data = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # also catches workers that died without a final update
+                    state = await run_in_threadpool(_state, request, job_id) or {'status': 'error', 'error': 'Unknown job'}
+                    yield f'data: {json.dumps(state)}\n\n'
+                    continue
+                state = json.loads(data)
+                if state.get('status') in jobstore.FINAL_STATUSES:
+                    # the job's state may have expired or been deleted meanwhile
+                    state = await run_in_threadpool(_state, request, job_id) or {'status': 'error', 'error': 'Unknown job'}
+                state['job_id'] = job_id
+                yield f'data: {json.dumps(state)}\n\n'
+        finally:
+            with anyio.CancelScope(shield=True):
+                await hub.unsubscribe(channel, queue)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@_timed('job_file')
+async def job_file(request):
+    state = await run_in_threadpool(jobstore.read, request.path_params['job_id'], redis_conn)
+    path = state and state['result']
+    if not path:
+        return PlainTextResponse('Result not ready', status_code=404)
+    try:
+        return await _file_response(request, path)
+    except FileNotFoundError:
+        return PlainTextResponse('Result file no longer available', status_code=410)
+
+
+@_timed('stream')
+async def stream(request):
+    # pass-through download: bytes are sent while yt-dlp is still fetching them
+    url = request.query_params.get('url', '').strip()
+    kind = request.query_params.get('kind', 'video')
+    if not url:
+        return PlainTextResponse('Provide URL', status_code=400)
+    path = await run_in_threadpool(streaming.cached_path, url, kind)
+    if path:
+        return await _file_response(request, path)
+    client_id = _client_id(request)
+    # leased against the admission budget like /start, until the response ends
+    lease = f'stream:{uuid.uuid4()}'
+    try:
+        await run_in_threadpool(_admit, lease, client_id, url, kind, None, None)
+    except admission.Rejected as e:
+        print(f'[INFO] Stream for {client_id} rejected ({e.reason}), retry after {e.retry_after}s', flush=True)
+        return PlainTextResponse(str(e), status_code=429, headers={'Retry-After': str(e.retry_after)})
+    try:
+        opened = await run_in_threadpool(streaming.open_stream, url, kind)
+    except Exception as e:
+        await run_in_threadpool(admission.release, redis_conn, lease)
+        error_msg = f'Error during streaming: {str(e)}'
+        print(f'[ERROR] {error_msg}', flush=True)
+        return PlainTextResponse(error_msg, status_code=502)
+    if opened is None:
+        await run_in_threadpool(admission.release, redis_conn, lease)
+        return PlainTextResponse('This media has no single-file format that can be streamed; use a regular download', status_code=409)
+    filename, chunks = opened
+
+    def close():
+        try:
+            chunks.close()
+        finally:
+            admission.release(redis_conn, lease)
+
+    try:
+        response = _ClosingResponse(_paced(chunks, client_id, ingress=True), close, media_type='application/octet-stream')
+        response.headers['Content-Disposition'] = serving.content_disposition(filename)
+        response.headers['X-Accel-Buffering'] = 'no'
+    except BaseException:
+        await run_in_threadpool(close)
+        raise
+    return response
+
+
+def _admit(lease, client_id, url, kind, quality, section):
+    # Redis and cached metadata only, but both block
+    _, cost = scheduler.predict_cost(url, kind, quality, section)
+    admission.admit(redis_conn, lease, client_id, cost)
+
+
+@_timed('start')
+async def start(request):
+    # synchronous download on the download pool; the event loop keeps serving meanwhile
+    global _pending_downloads
+    form = await request.form()
+    url = form.get('url', '').strip()
+    if not url:
+        return PlainTextResponse('Provide URL', status_code=400)
+    if _pending_downloads >= ASGI_DOWNLOAD_THREADS + ASGI_DOWNLOAD_BACKLOG:
+        return PlainTextResponse('Too many downloads in progress, try again later', status_code=503, headers={'Retry-After': '30'})
+    try:
+        clip_start, clip_end = clips.parse_section(form.get('start'), form.get('end')) or (None, None)
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+    fragments = form.get('fragments', '').strip()
+    cookies_text = form.get('cookies', '').strip()
+    client_id = _client_id(request)
+    lease = f'sync:{uuid.uuid4()}'
+    try:
+        await run_in_threadpool(_admit, lease, client_id, url, form.get('kind', 'video'), form.get('quality'),
+                                None if clip_start is None else (clip_start, clip_end))
+    except admission.Rejected as e:
+        print(f'[INFO] Download from {client_id} rejected ({e.reason}), retry after {e.retry_after}s', flush=True)
+        return PlainTextResponse(str(e), status_code=429, headers={'Retry-After': str(e.retry_after)})
+    disconnected = threading.Event()
+    download = functools.partial(
+        download_media, url, kind=form.get('kind', 'video'), job_id=None, cookies_text=cookies_text if cookies_text else None,
+        max_filesize=None, use_redis=False, concurrent_fragments=int(fragments) if fragments.isdigit() and int(fragments) > 0 else None,
+        platform=form.get('platform', 'auto'), audio_format=form.get('audio_format'), client_id=client_id, quality=form.get('quality'),
+        cancelled=disconnected.is_set, start=clip_start, end=clip_end)
+    _pending_downloads += 1
+    try:
+        future = asyncio.get_running_loop().run_in_executor(_downloads, download)
+        # the body has been read, so the next ASGI message is the disconnect; a download still
+        # waiting for a thread is skipped, a running one stops within CANCEL_POLL_SECONDS
+        while not disconnected.is_set():
+            done, _ = await asyncio.wait({future}, timeout=cancel.CANCEL_POLL_SECONDS)
+            if done:
+                break
+            if await request.is_disconnected():
+                disconnected.set()
+        path = await future
+    except cancel.Cancelled:
+        print(f'[INFO] Client disconnected, download of {url} cancelled', flush=True)
+        return PlainTextResponse('Download cancelled', status_code=499)
+    except Exception as e:
+        error_msg = f'Error during download: {str(e)}'
+        print(f'[ERROR] {error_msg}', flush=True)  # log to container stdout
+        return PlainTextResponse(error_msg, status_code=500)
+    finally:
+        _pending_downloads -= 1
+        await run_in_threadpool(admission.release, redis_conn, lease)
+
+    if not await run_in_threadpool(storage.exists, path):
+        error_msg = f'Download succeeded but file missing at {path}'
+        print(f'[ERROR] {error_msg}', flush=True)
+        return PlainTextResponse(error_msg, status_code=500)
+    return await _file_response(request, path)
+
+
+app = Starlette(routes=[
+    Route('/jobs/{job_id}/events', job_events, methods=['GET'], name='job_events'),
+    Route('/jobs/{job_id}/file', job_file, methods=['GET'], name='job_file'),
+    Route('/stream', stream, methods=['GET'], name='stream'),
+    Route('/start', start, methods=['POST'], name='start'),
+    Mount('/', WSGIMiddleware(web_app.app, workers=ASGI_WSGI_THREADS)),
+], lifespan=lifespan)
@@ -0,0 +1,203 @@
+import os
+import time
+import socket
+import threading
+import subprocess
+from typing import Optional
+from redis.exceptions import RedisError
+import hostlimit
+
+# Output formats offered for audio downloads. 'best' keeps the source codec and never transcodes.
+AUDIO_FORMATS = ('mp3', 'm4a', 'opus', 'best')
+DEFAULT_AUDIO_FORMAT = os.getenv('AUDIO_FORMAT', 'mp3')
+# Concurrent transcodes per machine (shared by all worker processes on it), one core each
+FFMPEG_WORKERS = int(os.getenv('FFMPEG_WORKERS', '0')) or os.cpu_count() or 2
+FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', '1'))
+
+# Source codecs each target can take as-is, and the encoder used otherwise
+_COPYABLE = {'mp3': ('mp3',), 'm4a': ('aac', 'alac'), 'opus': ('opus',)}
+_ENCODERS = {
+    'mp3': ['-c:a', 'libmp3lame', '-b:a', '192k'],
+    'm4a': ['-c:a', 'aac', '-b:a', '192k'],
+    'opus': ['-c:a', 'libopus', '-b:a', '160k'],
+}
+# Container for a codec copied out of its source when the target is 'best'
+_NATURAL_EXT = {'aac': 'm4a', 'alac': 'm4a', 'mp3': 'mp3', 'opus': 'opus', 'vorbis': 'ogg', 'flac': 'flac'}
+_MUXERS = {'m4a': 'ipod', 'opus': 'opus', 'ogg': 'ogg', 'mp3': 'mp3', 'flac': 'flac', 'mka': 'matroska'}
+
+_HOST = socket.gethostname()
+_local_slots = threading.BoundedSemaphore(FFMPEG_WORKERS)
+
+
+def format_selector(audio_format: str) -> str:
+    """yt-dlp format for an audio download: the best audio-only stream, preferring one whose
+    codec can be copied into `audio_format` so no transcode is needed."""
+    codecs = _COPYABLE.get(audio_format)
+    if not codecs:
+        return 'bestaudio/best'
+    preferred = '/'.join(f'bestaudio[acodec^={"mp4a" if codec == "aac" else codec}]' for codec in codecs)
+    return f'{preferred}/bestaudio/best'
+
+
+def normalize_codec(acodec: Optional[str]) -> Optional[str]:
+    """'mp4a.40.2' -> 'aac', 'opus' -> 'opus'; None when unknown or absent."""
+    if not acodec or acodec == 'none':
+        return None
+    acodec = acodec.lower()
+    if acodec.startswith('mp4a'):
+        return 'aac'
+    return acodec.split('.')[0]
+
+
+def plan(info: dict, path: str, audio_format: str):
+    """
+    Decide how to turn the downloaded file into `audio_format`. Returns (action, ext):
+    'keep' (already right), 'remux' (stream copy into the `ext` container) or 'transcode'.
+    """
+    codec = normalize_codec(info.get('acodec'))
+    has_video = info.get('vcodec') not in (None, 'none')
+    ext = os.path.splitext(path)[1].lstrip('.').lower()
+    if audio_format == 'best':
+        if not has_video:
+            return 'keep', ext
+        return 'remux', _NATURAL_EXT.get(codec, 'mka')
+    if codec in _COPYABLE[audio_format]:
+        if ext == audio_format and not has_video:
+            return 'keep', ext
+        return 'remux', audio_format
+    return 'transcode', audio_format
+
+
+def finalize(info: dict, path: str, audio_format: str, client=None, report=None) -> str:
+    """
+    Produce the requested audio file from the downloaded `path` and return its path.
+    Remuxes (codec copy) run right away since they are I/O-bound; transcodes go through the
+    bounded ffmpeg pool. The source file is removed once the output is in place.
+    `report(payload)` receives progress payloads while a transcode waits for a pool slot.
+    """
+    if audio_format not in AUDIO_FORMATS:
+        audio_format = DEFAULT_AUDIO_FORMAT
+    action, ext = plan(info, path, audio_format)
+    _count(client, action)
+    if action == 'keep':
+        return path
+    target = os.path.splitext(path)[0] + '.' + ext
+    tmp = f'{os.path.splitext(path)[0]}.audio-tmp.{ext}'
+    cmd = ['ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-i', path, '-vn', '-map_metadata', '0']
+    if action == 'remux':
+        cmd += ['-c:a', 'copy']
+    else:
+        cmd += _ENCODERS[audio_format] + ['-threads', str(FFMPEG_THREADS)]
+    cmd += ['-f', _MUXERS[ext], tmp]
+    try:
+        if action == 'remux':
+            _run(cmd)
+        else:
+            _run_pooled(cmd, client, report)
+        os.replace(tmp, target)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        _count(client, 'failures')
+        raise
+    if target != path and os.path.exists(path):
+        os.remove(path)
+    return target
+
+
+def _run(cmd, slots=None):
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        while True:
+            try:
+                _, stderr = proc.communicate(timeout=hostlimit.HOST_SLOT_TTL / 3)
+                break
+            except subprocess.TimeoutExpired:
+                if slots is not None:
+                    try:
+                        slots.renew()
+                    except Exception:
+                        pass
+    except BaseException:
+        # e.g. the job timed out: don't leave ffmpeg running
+        proc.kill()
+        proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise RuntimeError(f'ffmpeg exited with status {proc.returncode}: {stderr.decode("utf-8", "replace").strip()[-500:]}')
+
+
+def _run_pooled(cmd, client, report):
+    """Run a transcode once a pool slot is free: one of FFMPEG_WORKERS per machine (Redis),
+    and per process (for threads in the web tier, or without Redis)."""
+    started = time.monotonic()
+    waited = []
+
+    def _on_wait(reason=None):
+        if not waited and report is not None:
+            report({'status': 'waiting', 'reason': 'transcode'})
+        waited.append(True)
+
+    _incr(client, 'waiting', 1)
+    slots = None
+    try:
+        if not _local_slots.acquire(blocking=False):
+            _on_wait()
+            _local_slots.acquire()
+        try:
+            if client is not None:
+                slots = hostlimit.HostSlots(client, f'ffmpeg:{_HOST}', limit=FFMPEG_WORKERS)
+                if not slots.acquire(on_wait=_on_wait):
+                    slots = None
+        except RedisError:
+            slots = None
+        except BaseException:
+            _local_slots.release()
+            raise
+    finally:
+        _incr(client, 'waiting', -1)
+    if waited and report is not None:
+        report({'status': 'processing'})
+    _incr(client, 'running', 1)
+    _incr(client, 'wait_seconds', time.monotonic() - started)
+    started = time.monotonic()
+    try:
+        _run(cmd, slots)
+    finally:
+        _incr(client, 'running', -1)
+        _incr(client, 'transcode_seconds', time.monotonic() - started)
+        _local_slots.release()
+        if slots is not None:
+            try:
+                slots.release()
+            except Exception:
+                pass
+
+
+# Pool metrics per machine in the `transcode:{host}` hash: waiting and running transcodes, counts
+# of keep/remux/transcode/failures, and total seconds spent waiting for a slot and transcoding.
+def _incr(client, field, amount):
+    if client is None:
+        return
+    try:
+        if isinstance(amount, float):
+            client.hincrbyfloat(f'transcode:{_HOST}', field, round(amount, 3))
+        else:
+            client.hincrby(f'transcode:{_HOST}', field, amount)
+    except Exception:
+        pass
+
+
+def _count(client, action):
+    _incr(client, action, 1)
+
+
+def pool_stats(client) -> dict:
+    """Transcode pool metrics for every machine that has run the audio pipeline."""
+    stats = {}
+    for key in client.scan_iter('transcode:*'):
+        host = key.decode('utf-8').split(':', 1)[1]
+        values = {k.decode('utf-8'): float(v) for k, v in client.hgetall(key).items()}
+        values['slots'] = client.zcount(f'hostsem:ffmpeg:{host}', time.time(), '+inf')
+        stats[host] = values
+    return stats
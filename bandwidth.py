@@ -0,0 +1,177 @@
+"""
+Bandwidth governor: token buckets that pace downloads and the files sent to clients.
+
+Limits in bytes per second, with yt-dlp's size syntax (e.g. '20M'); unset or 0 means unlimited:
+  BANDWIDTH_GLOBAL      total ingress of all downloads on all workers
+  BANDWIDTH_PER_CLIENT  ingress of one client's downloads, and separately what is sent to it
+  BANDWIDTH_PER_JOB     one download, all its parallel fragments together
+
+The buckets are work-conserving: bandwidth an idle or slow download leaves unused goes to
+whichever download asks next, so a lone job runs at the full global (or client) rate and N busy
+jobs settle at about 1/N each, without any reallocation step.
+
+Per bucket (GCRA): the time at which everything charged so far is paid off.
+  bw:in             float  global ingress
+  bw:in:{client}    float  ingress on behalf of one client
+  bw:out:{client}   float  bytes served to one client
+Charging n bytes moves the time forward by n / rate with INCRBYFLOAT, so workers never lock;
+the caller sleeps until it is no more than BANDWIDTH_BURST_SECONDS ahead of now.
+"""
+import os
+import time
+import threading
+from typing import Iterator, Optional
+from yt_dlp.utils import parse_bytes
+from redis.exceptions import RedisError
+
+
+def _parse_rate(value):
+    value = (value or '').strip()
+    if not value or value == '0':
+        return None
+    return parse_bytes(value) or None
+
+
+GLOBAL_RATE = _parse_rate(os.getenv('BANDWIDTH_GLOBAL'))
+CLIENT_RATE = _parse_rate(os.getenv('BANDWIDTH_PER_CLIENT'))
+JOB_RATE = _parse_rate(os.getenv('BANDWIDTH_PER_JOB'))
+# A bucket holds this many seconds of its rate, so short bursts are not slowed down
+BURST_SECONDS = float(os.getenv('BANDWIDTH_BURST_SECONDS', '1'))
+# Bytes accumulated before a download charges the shared buckets (one Redis round trip each)
+CHARGE_BYTES = 64 * 1024
+# Longest single sleep; the rest of a debt is slept at the next charge (keeps leases renewed)
+MAX_SLEEP = 5.0
+# An idle bucket is full again long before this; a forgotten debt only lets one burst through
+_BUCKET_TTL = 10 * 60
+
+
+def _key(direction, client_id=None):
+    return f'bw:{direction}:{client_id}' if client_id else f'bw:{direction}'
+
+
+def _take(client, buckets, amount):
+    """Charge `amount` bytes to each (key, rate) bucket and return the seconds to wait."""
+    now = time.time()
+    pipe = client.pipeline(transaction=False)
+    for key, rate in buckets:
+        pipe.incrbyfloat(key, amount / rate)
+        pipe.expire(key, _BUCKET_TTL)
+    paid_off = pipe.execute()[::2]
+    wait = 0.0
+    for (key, rate), tat in zip(buckets, paid_off):
+        if tat - amount / rate < now:
+            # the bucket had filled up (or expired) while idle: restart from full. Charges racing
+            # with this reset are lost, which lets at most one burst through.
+            tat = now + amount / rate
+            client.set(key, repr(tat), ex=_BUCKET_TTL)
+        wait = max(wait, tat - now - BURST_SECONDS)
+    return wait
+
+
+class _LocalBucket:
+    """The same bucket in-process, for the per-job limit."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tat = 0.0
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self.tat = max(self.tat, now) + amount / self.rate
+            return self.tat - now - BURST_SECONDS
+
+
+def enabled() -> bool:
+    return bool(GLOBAL_RATE or CLIENT_RATE or JOB_RATE)
+
+
+class Governor:
+    """Paces one download: `hook` is a yt-dlp progress hook that sleeps in the downloading thread
+    (including each parallel fragment's) whenever a bucket is in debt."""
+
+    def __init__(self, client, client_id=None):
+        self.client = client
+        self.buckets = []
+        if GLOBAL_RATE:
+            self.buckets.append((_key('in'), GLOBAL_RATE))
+        if CLIENT_RATE and client_id:
+            self.buckets.append((_key('in', client_id), CLIENT_RATE))
+        self.job = _LocalBucket(JOB_RATE) if JOB_RATE else None
+        self._seen = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def hook(self, d):
+        if d.get('status') != 'downloading':
+            return
+        name = d.get('tmpfilename') or d.get('filename')
+        downloaded = d.get('downloaded_bytes') or 0
+        with self._lock:
+            delta = downloaded - self._seen.get(name, 0)
+            self._seen[name] = max(downloaded, self._seen.get(name, 0))
+            if delta <= 0:
+                return
+            self._pending += delta
+            if self._pending < CHARGE_BYTES:
+                return
+            amount, self._pending = self._pending, 0
+        self.charge(amount)
+
+    def charge(self, amount):
+        wait = self.job.take(amount) if self.job is not None else 0.0
+        if self.buckets and self.client is not None:
+            try:
+                wait = max(wait, _take(self.client, self.buckets, amount))
+            except RedisError:
+                pass
+        if wait > 0:
+            time.sleep(min(wait, MAX_SLEEP))
+
+
+def served_buckets(client_id: Optional[str], ingress: bool = False) -> list:
+    """Buckets charged for bytes sent to `client_id`; with `ingress` (bytes fetched while they
+    are sent, as in `/stream`) the download buckets too. Empty when nothing limits them."""
+    buckets = []
+    if CLIENT_RATE and client_id:
+        buckets.append((_key('out', client_id), CLIENT_RATE))
+    if ingress and GLOBAL_RATE:
+        buckets.append((_key('in'), GLOBAL_RATE))
+    if ingress and CLIENT_RATE and client_id:
+        buckets.append((_key('in', client_id), CLIENT_RATE))
+    return buckets
+
+
+def wait_for(client, buckets: list, amount: int) -> float:
+    """Charge `amount` bytes to `buckets` and return how long to sleep (at most MAX_SLEEP); for
+    callers that sleep on their own, like the asyncio serving tier."""
+    try:
+        wait = _take(client, buckets, amount)
+    except RedisError:
+        return 0.0
+    return min(wait, MAX_SLEEP) if wait > 0 else 0.0
+
+
+def pace(chunks: Iterator[bytes], client, client_id: Optional[str], ingress: bool = False) -> Iterator[bytes]:
+    """Yield `chunks` no faster than the client's share of BANDWIDTH_PER_CLIENT. With `ingress`
+    (bytes fetched while they are sent, as in `/stream`) the download buckets are charged too."""
+    buckets = served_buckets(client_id, ingress)
+    if not buckets or client is None:
+        yield from chunks
+        return
+    try:
+        for chunk in chunks:
+            yield chunk
+            wait = wait_for(client, buckets, len(chunk))
+            if wait > 0:
+                time.sleep(wait)
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def served_rate(client_id: Optional[str]) -> Optional[int]:
+    """Per-connection rate for a front proxy sending the file (nginx `X-Accel-Limit-Rate`)."""
+    return CLIENT_RATE if client_id else None
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import uuid
+import zipfile
+from typing import Iterator, Optional
+import quota
+import storage
+import platforms
+import admission
+import scheduler
+import jobstore
+from downloader import new_ydl, _base_opts, _write_cookiefile, _remove_file
+from tasks import redis_conn
+
+# Entries of one batch downloading at the same time (the scheduler's lane limits still apply)
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+BATCH_MAX_ENTRIES = int(os.getenv('BATCH_MAX_ENTRIES', '200'))
+BATCH_TTL = int(os.getenv('BATCH_TTL', str(24 * 60 * 60)))
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# Per batch:
+#   batch:{id}          hash  url, kind, platform, audio_format, quality, title, total, client_id,
+#                             cookies_text (only until the last entry is handed to the scheduler)
+#   batch:{id}:entries  list  JSON {index, url, title, job_id}, in playlist order
+#   batch:{id}:next     int   number of entries handed to the scheduler so far
+# Every entry gets its job id up front, so its progress is read from `jobstore` by that id.
+_DONE = jobstore.FINAL_STATUSES
+
+
+def expand(url: str, cookies_text: Optional[str] = None, limit: int = BATCH_MAX_ENTRIES, platform: Optional[str] = 'auto') -> dict:
+    """Flat-extract a playlist or channel: returns {'title', 'entries': [{'url', 'title'}]} without
+    resolving the individual entries. A URL that is not a playlist yields a single entry."""
+    route = platforms.resolve(url, platform)
+    opts = _base_opts()
+    opts.update(route['opts'])
+    opts.update({'noplaylist': False, 'extract_flat': 'in_playlist', 'playlistend': limit})
+    cookiefile = None
+    if cookies_text and cookies_text.strip():
+        cookiefile = _write_cookiefile(f'batch-{uuid.uuid4()}', cookies_text)
+        opts['cookiefile'] = cookiefile
+    try:
+        with new_ydl(opts, route['extractors']) as ydl:
+            info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        raise RuntimeError(f'yt-dlp failed: {str(e)}') from e
+    finally:
+        _remove_file(cookiefile)
+
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        return {'title': info.get('title'), 'entries': [{'url': info.get('webpage_url') or url, 'title': info.get('title')}]}
+    entries = []
+    for entry in info.get('entries') or []:
+        entry_url = entry and (entry.get('url') or entry.get('webpage_url'))
+        if entry_url:
+            entries.append({'url': entry_url, 'title': entry.get('title')})
+    return {'title': info.get('title'), 'entries': entries[:limit]}
+
+
+def create(url: str, kind: str = 'video', cookies_text: Optional[str] = None, client_id: str = 'anonymous', platform: Optional[str] = 'auto',
+           audio_format: Optional[str] = None, quality: Optional[str] = None) -> dict:
+    """Expand `url` and start its first BATCH_CONCURRENCY entries. Returns {'batch_id', 'title', 'total'}.
+    Raises `admission.Rejected` if the client or the system can't take on all of its entries now."""
+    expanded = expand(url, cookies_text, platform=platform)
+    if not expanded['entries']:
+        raise RuntimeError('The playlist has no downloadable entries')
+    # admitted as a whole; the entries are then recorded as they are handed to the scheduler
+    cost = sum(scheduler.predict_cost(entry['url'], kind, quality)[1] for entry in expanded['entries'])
+    admission.check(redis_conn, client_id, cost, jobs=min(len(expanded['entries']), _concurrency()))
+    batch_id = str(uuid.uuid4())
+    entries = [dict(entry, index=i, job_id=str(uuid.uuid4())) for i, entry in enumerate(expanded['entries'])]
+    pipe = redis_conn.pipeline()
+    pipe.hset(f'batch:{batch_id}', mapping={
+        'url': url, 'kind': kind, 'platform': platform or 'auto', 'audio_format': audio_format or '', 'quality': quality or '', 'title': expanded['title'] or '', 'total': len(entries),
+        'client_id': client_id, 'cookies_text': cookies_text or '',
+    })
+    pipe.rpush(f'batch:{batch_id}:entries', *[json.dumps(entry) for entry in entries])
+    pipe.set(f'batch:{batch_id}:next', 0)
+    for key in (f'batch:{batch_id}', f'batch:{batch_id}:entries', f'batch:{batch_id}:next'):
+        pipe.expire(key, BATCH_TTL)
+    pipe.execute()
+    advance(batch_id)
+    return {'batch_id': batch_id, 'title': expanded['title'], 'total': len(entries)}
+
+
+def _concurrency():
+    # a batch never holds more open jobs than its client may have
+    return min(BATCH_CONCURRENCY, admission.ADMISSION_CLIENT_JOBS or BATCH_CONCURRENCY)
+
+
+def _entries(batch_id):
+    return [json.loads(raw) for raw in redis_conn.lrange(f'batch:{batch_id}:entries', 0, -1)]
+
+
+def _states(entries):
+    states = jobstore.read_many((entry['job_id'] for entry in entries), conn=redis_conn)
+    return [state or {'result': None} for state in states]
+
+
+def _advance(batch_id):
+    meta = {k.decode('utf-8'): v.decode('utf-8') for k, v in redis_conn.hgetall(f'batch:{batch_id}').items()}
+    if not meta:
+        return
+    entries = _entries(batch_id)
+    submitted = int(redis_conn.get(f'batch:{batch_id}:next') or 0)
+    active = sum(1 for state in _states(entries[:submitted]) if state.get('status') not in _DONE)
+    while active < _concurrency() and submitted < len(entries):
+        entry = entries[submitted]
+        scheduler.submit(entry['url'], kind=meta['kind'], cookies_text=meta['cookies_text'] or None,
+                         client_id=meta['client_id'], job_id=entry['job_id'], meta={'batch_id': batch_id},
+                         platform=meta.get('platform', 'auto'), audio_format=meta.get('audio_format') or None,
+                         quality=meta.get('quality') or None)
+        submitted += 1
+        active += 1
+        redis_conn.set(f'batch:{batch_id}:next', submitted, ex=BATCH_TTL)
+    if submitted >= len(entries) and meta.get('cookies_text'):
+        # every entry carries its own copy now; don't keep the session cookies for the batch's lifetime
+        redis_conn.hdel(f'batch:{batch_id}', 'cookies_text')
+
+
+def advance(batch_id: str):
+    """Hand entries to the scheduler until BATCH_CONCURRENCY (at most ADMISSION_CLIENT_JOBS) of them are unfinished.
+    Called when the batch is created and whenever one of its jobs ends; like `scheduler.dispatch`,
+    concurrent callers mark the batch dirty instead of advancing it twice."""
+    dirty, lock = f'batch-dirty:{batch_id}', f'batch-lock:{batch_id}'
+    redis_conn.set(dirty, 1, ex=BATCH_TTL)
+    while redis_conn.set(lock, 1, nx=True, ex=30):
+        try:
+            redis_conn.delete(dirty)
+            _advance(batch_id)
+        finally:
+            redis_conn.delete(lock)
+        if not redis_conn.exists(dirty):
+            break
+
+
+def status(batch_id: str) -> Optional[dict]:
+    """Aggregate progress of a batch, or None if it is unknown."""
+    meta = redis_conn.hmget(f'batch:{batch_id}', 'title', 'kind', 'total')
+    if meta[2] is None:
+        return None
+    entries = _entries(batch_id)
+    submitted = int(redis_conn.get(f'batch:{batch_id}:next') or 0)
+    counts = {'pending': 0, 'queued': 0, 'downloading': 0, 'finished': 0, 'error': 0, 'cancelled': 0}
+    percent = 0.0
+    items = []
+    for i, (entry, state) in enumerate(zip(entries, _states(entries))):
+        entry_status = state.get('status') or ('queued' if i < submitted else 'pending')
+        if entry_status in _DONE:
+            percent += 100
+        elif entry_status == 'downloading':
+            percent += state.get('percent') or 0
+        counts[entry_status if entry_status in counts else 'downloading'] += 1
+        items.append({'index': entry['index'], 'title': entry['title'], 'job_id': entry['job_id'],
+                      'status': entry_status, 'percent': state.get('percent'), 'error': state.get('error')})
+    total = len(entries)
+    done = counts['finished'] + counts['error'] + counts['cancelled'] == total
+    return {
+        'batch_id': batch_id,
+        'title': meta[0].decode('utf-8'),
+        'kind': meta[1].decode('utf-8'),
+        'total': total,
+        'status': 'finished' if done else 'downloading',
+        'percent': round(percent / total, 2) if total else 100.0,
+        'counts': counts,
+        'entries': items,
+    }
+
+
+def finished_files(batch_id: str) -> list:
+    """(archive name, result) of every finished entry whose file is still stored, in playlist order."""
+    entries = _entries(batch_id)
+    files = []
+    for entry, state in zip(entries, _states(entries)):
+        path = state.get('result')
+        if state.get('status') == 'finished' and path and storage.exists(path):
+            files.append((f'{entry["index"] + 1:03d} {storage.basename(path)}', path))
+    return files
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object collecting what `zipfile` writes, so it can be yielded."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return b''.join(chunks)
+
+
+def _drain(sink):
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def stream_zip(files: list) -> Iterator[bytes]:
+    """
+    Yield a ZIP archive of `files` ((archive name, `storage` reference) pairs) while it is being built.
+    Entries are stored uncompressed (media is already compressed) and, since the output is not
+    seekable, sizes and CRCs follow each entry in a data descriptor. Files stay pinned against
+    disk quota eviction until the generator finishes or is closed.
+    """
+    pinned = []
+    try:
+        for _, path in files:
+            if storage.is_remote(path):
+                continue
+            try:
+                quota.pin(redis_conn, path)
+                pinned.append(path)
+            except Exception:
+                pass
+        sink = _ChunkSink()
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for name, path in files:
+                st = storage.stat(path)
+                zinfo = zipfile.ZipInfo(name, time.localtime(st.mtime)[:6])
+                zinfo.external_attr = 0o644 << 16
+                zinfo.file_size = st.size
+                zinfo.compress_type = zipfile.ZIP_STORED
+                with storage.open_range(path) as src, zf.open(zinfo, 'w') as dst:
+                    while True:
+                        chunk = src.read(ZIP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        yield from _drain(sink)
+                yield from _drain(sink)
+        yield from _drain(sink)
+    finally:
+        for path in pinned:
+            try:
+                quota.unpin(redis_conn, path)
+            except Exception:
+                pass
@@ -0,0 +1,420 @@
+"""
+Offline load test of the download paths against a local media server and a local Redis.
+
+Targets:
+  direct  `download_media` called from a thread pool in one process
+  rq      jobs submitted through the scheduler and run by the warm worker pool (`worker.py`)
+  start   concurrent `POST /start` requests against gunicorn serving the ASGI app (`asgi.py`)
+Each target runs for every media variant of `media_server.py` (progressive MP4, HLS, DASH).
+Redis is a throwaway `redis-server` when one is on PATH, otherwise fakeredis' TCP server.
+The result cache is off unless --cache is given, so every request downloads.
+
+Reported per run: throughput (requests/s and MB/s), p50/p99 latency, peak RSS of the
+processes under test (summed over the process tree) and their disk reads/writes.
+Peak RSS and disk I/O are sampled from /proc and are only available on Linux.
+
+Usage: python benchmarks/bench_load.py [--targets direct,rq,start] [--media progressive,hls,dash]
+           [--requests 20] [--concurrency 4] [--size-kb 1024] [--cache] [--json out.json]
+           [--compare previous.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import threading
+import subprocess
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from media_server import MediaServer  # noqa: E402
+
+TARGETS = ('direct', 'rq', 'start')
+MEDIA = tuple(MediaServer.PATHS)
+STARTUP_TIMEOUT = 60
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_port(port, proc, timeout=STARTUP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'{proc.args[0]} exited with status {proc.returncode} during startup')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'nothing listening on port {port} after {timeout}s')
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def _keep_alive_handler(base):
+    """fakeredis' TCP handler drops the connection after any error reply, e.g. to the INFO probe
+    RQ sends before saving a job; answer with the error and keep the connection instead."""
+    from redis.exceptions import ResponseError
+
+    class _Handler(base):
+        def setup(self):
+            super().setup()
+            read_response = self.current_client.read_response
+
+            def _read_response(*args, **kwargs):
+                try:
+                    return read_response(*args, **kwargs)
+                except ResponseError as e:
+                    return e
+
+            self.current_client.read_response = _read_response
+
+    return _Handler
+
+
+class LocalRedis:
+    """A throwaway Redis on a free port: `redis-server` if installed, else fakeredis' TCP server."""
+
+    def __init__(self):
+        self.port = _free_port()
+        self.url = f'redis://127.0.0.1:{self.port}/0'
+        self._proc = None
+        self._server = None
+
+    def __enter__(self):
+        if shutil.which('redis-server'):
+            self._proc = subprocess.Popen(['redis-server', '--port', str(self.port), '--save', '', '--appendonly', 'no'],
+                                          stdout=subprocess.DEVNULL)
+            _wait_port(self.port, self._proc)
+            self.kind = 'redis-server'
+        else:
+            from fakeredis import TcpFakeServer
+            self._server = TcpFakeServer(('127.0.0.1', self.port))
+            self._server.RequestHandlerClass = _keep_alive_handler(self._server.RequestHandlerClass)
+            self._server.daemon_threads = True
+            # clients of the process under test vanish mid-connection when it is stopped
+            self._server.handle_error = lambda request, client_address: None
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            self.kind = 'fakeredis'
+        return self
+
+    def __exit__(self, *exc):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.wait()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class TreeSampler:
+    """Samples a process and its descendants from /proc: peak summed RSS and the last seen
+    storage read/write byte counters of every process."""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid, self.interval = pid, interval
+        self.peak_rss = 0
+        self._io = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.available = os.path.exists(f'/proc/{pid}/statm')
+
+    def __enter__(self):
+        if self.available:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.available:
+            self._thread.join()
+
+    def _tree(self):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        pids, todo = [], [self.pid]
+        while todo:
+            pid = todo.pop()
+            pids.append(pid)
+            todo.extend(children.get(pid, ()))
+        return pids
+
+    def _sample(self):
+        rss = 0
+        for pid in self._tree():
+            try:
+                with open(f'/proc/{pid}/statm') as f:
+                    rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+                with open(f'/proc/{pid}/io') as f:
+                    counters = dict(line.split(': ') for line in f.read().splitlines())
+                self._io[pid] = (int(counters['read_bytes']), int(counters['write_bytes']))
+            except (OSError, KeyError, ValueError):
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+        self._sample()
+
+    def result(self):
+        if not self.available:
+            return {'peak_rss_mb': None, 'disk_read_mb': None, 'disk_write_mb': None}
+        return {
+            'peak_rss_mb': round(self.peak_rss / 2 ** 20, 1),
+            'disk_read_mb': round(sum(r for r, _ in self._io.values()) / 2 ** 20, 2),
+            'disk_write_mb': round(sum(w for _, w in self._io.values()) / 2 ** 20, 2),
+        }
+
+
+def _child_env(redis_url, cache, concurrency):
+    env = dict(os.environ, REDIS_URL=redis_url, RESULT_CACHE='1' if cache else '0', PYTHONUNBUFFERED='1',
+               LANE_LIMITS=f'fast={concurrency},standard={concurrency},bulk={concurrency}')
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    return env
+
+
+def _run_child(args, env):
+    """Start this script in child mode; `_child_result` collects its output."""
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + args, env=env, cwd=ROOT,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return proc
+
+
+def _child_result(proc):
+    out, _ = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f'benchmark child exited with status {proc.returncode}')
+    return json.loads(out.strip().splitlines()[-1])
+
+
+# -- child modes: run inside the process under test --
+
+def _child_direct(url, requests, concurrency):
+    sys.path.insert(0, ROOT)
+    import downloader
+
+    def _one(_):
+        started = time.perf_counter()
+        try:
+            path = downloader.download_media(url)
+        except Exception:
+            return None, 0
+        size = os.path.getsize(path)
+        return time.perf_counter() - started, size
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(_one, range(requests)))
+    print(json.dumps({'seconds': time.perf_counter() - started, 'latencies': [r[0] for r in results],
+                      'bytes': sum(r[1] for r in results)}))
+
+
+def _child_rq_client(url, requests):
+    sys.path.insert(0, ROOT)
+    import scheduler
+    import jobstore
+    started = time.perf_counter()
+    pending = {}
+    for i in range(requests):
+        job_id = scheduler.submit(url, kind='video', client_id=f'bench:{i}')
+        pending[job_id] = time.perf_counter()
+    latencies, total_bytes = [], 0
+    while pending:
+        job_ids = list(pending)
+        for job_id, state in zip(job_ids, jobstore.read_many(job_ids)):
+            status = state.get('status') if state else None
+            if status in ('finished', 'error'):
+                submitted_at = pending.pop(job_id)
+                latencies.append(time.perf_counter() - submitted_at if status == 'finished' else None)
+                result = state['result']
+                if status == 'finished' and result and os.path.exists(result):
+                    total_bytes += os.path.getsize(result)
+        time.sleep(0.02)
+    print(json.dumps({'seconds': time.perf_counter() - started, 'latencies': latencies, 'bytes': total_bytes}))
+
+
+# -- targets: run in the harness --
+
+def run_direct(url, redis, opts):
+    proc = _run_child(['--child', 'direct', url, '--requests', str(opts.requests), '--concurrency', str(opts.concurrency)],
+                      _child_env(redis.url, opts.cache, opts.concurrency))
+    with TreeSampler(proc.pid) as sampler:
+        result = _child_result(proc)
+    return result, sampler.result()
+
+
+def run_rq(url, redis, opts):
+    env = _child_env(redis.url, opts.cache, opts.concurrency)
+    env['WORKER_PROCESSES'] = str(opts.concurrency)
+    workers = subprocess.Popen([sys.executable, 'worker.py'], env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        import redis as redis_py
+        conn = redis_py.Redis.from_url(redis.url)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while conn.scard('rq:workers') < opts.concurrency:
+            if workers.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('worker pool did not start')
+            time.sleep(0.1)
+        with TreeSampler(workers.pid) as sampler:
+            result = _child_result(_run_child(['--child', 'rq-client', url, '--requests', str(opts.requests)], env))
+        return result, sampler.result()
+    finally:
+        workers.terminate()
+        workers.wait()
+
+
+def run_start(url, redis, opts):
+    port = _free_port()
+    env = dict(_child_env(redis.url, opts.cache, opts.concurrency), ASGI_DOWNLOAD_THREADS=str(opts.concurrency))
+    server = subprocess.Popen(['gunicorn', 'asgi:app', '-b', f'127.0.0.1:{port}', '--workers', '2',
+                               '-k', 'uvicorn.workers.UvicornWorker', '--timeout', '600'],
+                              env=env, cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_port(port, server)
+        body = urllib.parse.urlencode({'url': url, 'kind': 'video'}).encode('ascii')
+
+        def _one(_):
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/start', data=body, timeout=600) as response:
+                    size = len(response.read())
+            except Exception:
+                return None, 0
+            return time.perf_counter() - started, size
+
+        with TreeSampler(server.pid) as sampler:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(opts.concurrency) as pool:
+                results = list(pool.map(_one, range(opts.requests)))
+            result = {'seconds': time.perf_counter() - started, 'latencies': [r[0] for r in results],
+                      'bytes': sum(r[1] for r in results)}
+        return result, sampler.result()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+RUNNERS = {'direct': run_direct, 'rq': run_rq, 'start': run_start}
+
+
+def summarize(target, media, result, resources, opts):
+    latencies = sorted(x for x in result['latencies'] if x is not None)
+    seconds = result['seconds']
+    row = {
+        'target': target, 'media': media, 'requests': opts.requests, 'concurrency': opts.concurrency,
+        'ok': len(latencies), 'failed': len(result['latencies']) - len(latencies),
+        'seconds': round(seconds, 3),
+        'throughput_rps': round(len(latencies) / seconds, 2) if seconds else None,
+        'throughput_mbps': round(result['bytes'] / 2 ** 20 / seconds, 2) if seconds else None,
+        'p50_ms': round(_percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+    }
+    row.update(resources)
+    return row
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_table(rows, previous=None):
+    before = {(r['target'], r['media']): r for r in (previous or [])}
+    print(f'{"target":<7} {"media":<12} {"ok":>4} {"req/s":>7} {"MB/s":>7} {"p50 ms":>9} {"p99 ms":>9} {"peak RSS MB":>12} {"read MB":>8} {"write MB":>9}')
+    for r in rows:
+        print(f'{r["target"]:<7} {r["media"]:<12} {r["ok"]:>4} {r["throughput_rps"]!s:>7} {r["throughput_mbps"]!s:>7} '
+              f'{r["p50_ms"]!s:>9} {r["p99_ms"]!s:>9} {r["peak_rss_mb"]!s:>12} {r["disk_read_mb"]!s:>8} {r["disk_write_mb"]!s:>9}')
+        old = before.get((r['target'], r['media']))
+        if old and old.get('p50_ms') and r['p50_ms'] and old.get('throughput_rps') and r['throughput_rps']:
+            print(f'{"":<20} vs previous: p50 {(r["p50_ms"] / old["p50_ms"] - 1) * 100:+.1f}%, '
+                  f'throughput {(r["throughput_rps"] / old["throughput_rps"] - 1) * 100:+.1f}%')
+
+
+def _new_entries(before):
+    downloads = os.path.join(ROOT, 'downloads')
+    return [os.path.join(downloads, name) for name in os.listdir(downloads) if name not in before] if os.path.isdir(downloads) else []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--targets', default=','.join(TARGETS))
+    parser.add_argument('--media', default=','.join(MEDIA))
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--size-kb', type=int, default=1024)
+    parser.add_argument('--segments', type=int, default=10)
+    parser.add_argument('--cache', action='store_true', help='keep the result cache on')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='previous --json output to compare against')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'URL'), help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+    if opts.child:
+        mode, url = opts.child
+        if mode == 'direct':
+            _child_direct(url, opts.requests, opts.concurrency)
+        else:
+            _child_rq_client(url, opts.requests)
+        return
+
+    targets = [t for t in opts.targets.split(',') if t]
+    media = [m for m in opts.media.split(',') if m]
+    for name in targets + media:
+        if name not in TARGETS + MEDIA:
+            parser.error(f'unknown target or media: {name}')
+    downloads = os.path.join(ROOT, 'downloads')
+    existing = set(os.listdir(downloads)) if os.path.isdir(downloads) else set()
+    rows = []
+    with MediaServer(opts.size_kb, opts.segments) as server:
+        for target in targets:
+            for variant in media:
+                # a fresh Redis per run, so no queue, cache or quota state carries over
+                with LocalRedis() as redis:
+                    result, resources = RUNNERS[target](server.url(variant), redis, opts)
+                    redis_kind = redis.kind
+                rows.append(summarize(target, variant, result, resources, opts))
+                for path in _new_entries(existing):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+
+    previous = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            previous = json.load(f)['results']
+    _print_table(rows, previous)
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump({'commit': _git_commit(), 'timestamp': int(time.time()), 'redis': redis_kind,
+                       'size_kb': opts.size_kb, 'segments': opts.segments, 'cache': opts.cache,
+                       'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Micro-benchmark of per-request setup cost before a download touches the network.
+
+`before` repeats the previous request path: a YoutubeDL with yt-dlp's full extractor list, the
+extra `cookies_from_browser` YoutubeDL built for every YouTube URL, and matching the URL
+against the whole list (for the cache identity and again for the extraction).
+`after` is the platform route: `platforms.resolve`, `downloader.new_ydl` with the route's
+pre-resolved extractor set, and the same two matches.
+
+`warm` times repeated requests in one process (what a warm worker sees); `cold` is the first
+request in a fresh process, which also pays for compiling the extractors' URL patterns.
+
+Usage: python benchmarks/bench_request_setup.py [--rounds 50] [--json out.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+URLS = {
+    'youtube': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'tiktok': 'https://www.tiktok.com/@user/video/7200000000000000000',
+    'soundcloud': 'https://soundcloud.com/artist/track',
+    'direct': 'https://cdn.example.com/media/clip.mp4',
+    'other': 'https://vimeo.com/76979871',
+}
+MODES = ('before', 'after')
+
+
+def _first_suitable(ies, url):
+    return next(ie for ie in ies if ie.suitable(url))
+
+
+def _setup_before(url):
+    from yt_dlp import YoutubeDL
+    from yt_dlp.extractor import gen_extractor_classes
+    import downloader
+    _first_suitable(gen_extractor_classes(), url)
+    if 'youtube' in url or 'youtu.be' in url:
+        with YoutubeDL({'cookies_from_browser': ('chrome',)}):
+            pass
+    with YoutubeDL(downloader._base_opts()) as ydl:
+        _first_suitable(ydl._ies.values(), url)
+
+
+def _setup_after(url):
+    import downloader
+    import platforms
+    import result_cache
+    result_cache.resolve_extractor(url)
+    route = platforms.resolve(url, 'auto')
+    opts = downloader._base_opts()
+    opts.update(route['opts'])
+    with downloader.new_ydl(opts, route['extractors']) as ydl:
+        if not opts.get('force_generic_extractor'):
+            _first_suitable(ydl._ies.values(), url)
+
+
+def _child_main(mode, name, rounds):
+    sys.path.insert(0, ROOT)
+    setup = _setup_before if mode == 'before' else _setup_after
+    url = URLS[name]
+    import downloader  # noqa: F401  (module import is not part of the per-request cost)
+    started = time.perf_counter()
+    setup(url)
+    cold = time.perf_counter() - started
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        setup(url)
+        timings.append(time.perf_counter() - started)
+    print(json.dumps({'mode': mode, 'url': name, 'cold_ms': round(cold * 1000, 2),
+                      'warm_ms': round(statistics.median(timings) * 1000, 2)}))
+
+
+def run(mode, name, rounds):
+    env = dict(os.environ, REDIS_URL='redis://127.0.0.1:1/0')
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, name, '--rounds', str(rounds)],
+                         env=env, cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'URL'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        _child_main(args.child[0], args.child[1], args.rounds)
+        return
+
+    results = [run(mode, name, args.rounds) for name in URLS for mode in MODES]
+    print(f'{"url":<11} {"mode":<7} {"cold ms":>9} {"warm ms":>9}')
+    for r in results:
+        print(f'{r["url"]:<11} {r["mode"]:<7} {r["cold_ms"]:>9} {r["warm_ms"]:>9}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Benchmark finished-file serving: Flask `send_file` (the previous path) against
+`serving.serve_file` served directly (sendfile) and offloaded with X-Accel-Redirect.
+
+Each mode runs in its own single-worker gunicorn process. The workload mixes full downloads
+and single byte-range requests from concurrent clients, and reports throughput, mean latency
+and worker occupancy (CPU seconds of the gunicorn worker per GiB requested).
+
+Usage: python benchmarks/bench_serving.py [--size-mb 256] [--clients 4] [--requests 24] [--json out.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODES = ('legacy', 'serve', 'offload')
+
+# --- app under test (imported by gunicorn in a subprocess) -------------------------------
+app = None
+if os.getenv('BENCH_FILE'):
+    from flask import Flask, send_file
+    import serving
+
+    app = Flask(__name__)
+    BENCH_FILE = os.environ['BENCH_FILE']
+
+    @app.route('/file')
+    def bench_file():
+        if os.environ.get('BENCH_MODE') == 'legacy':
+            return send_file(BENCH_FILE, as_attachment=True)
+        return serving.serve_file(BENCH_FILE, pin=False)
+
+
+# --- driver ------------------------------------------------------------------------------
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _worker_cpu(master_pid):
+    """utime + stime (seconds) of the gunicorn worker processes under `master_pid`."""
+    total = 0.0
+    tick = os.sysconf('SC_CLK_TCK')
+    for task in os.listdir(f'/proc/{master_pid}/task'):
+        with open(f'/proc/{master_pid}/task/{task}/children') as f:
+            for pid in f.read().split():
+                with open(f'/proc/{pid}/stat') as st:
+                    fields = st.read().rsplit(')', 1)[1].split()
+                total += (int(fields[11]) + int(fields[12])) / tick
+    return total
+
+
+def _start_server(mode, path, port):
+    env = dict(os.environ, BENCH_FILE=path, BENCH_MODE=mode, REDIS_URL='redis://127.0.0.1:1/0')
+    if mode == 'offload':
+        env['SENDFILE_MODE'] = 'x-accel'
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'bench_serving:app', '--chdir', os.path.dirname(os.path.abspath(__file__)),
+         '--pythonpath', ROOT, '--bind', f'127.0.0.1:{port}', '--workers', '1', '--log-level', 'warning'],
+        env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f'gunicorn did not start for mode {mode}')
+
+
+def _fetch(port, size, ranged):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    headers = {}
+    expected = size
+    if ranged:
+        length = max(1, size // 8)
+        start = random.randrange(0, size - length)
+        headers['Range'] = f'bytes={start}-{start + length - 1}'
+        expected = length
+    started = time.perf_counter()
+    conn.request('GET', '/file', headers=headers)
+    resp = conn.getresponse()
+    received = 0
+    while True:
+        chunk = resp.read(1024 * 1024)
+        if not chunk:
+            break
+        received += len(chunk)
+    conn.close()
+    return time.perf_counter() - started, expected, received, resp.status
+
+
+def run_mode(mode, path, size, clients, requests):
+    port = _free_port()
+    proc = _start_server(mode, path, port)
+    try:
+        _fetch(port, size, ranged=True)  # warm-up
+        cpu_before = _worker_cpu(proc.pid)
+        jobs = [i % 2 == 1 for i in range(requests)]
+        results = []
+        lock = threading.Lock()
+
+        def client():
+            while True:
+                with lock:
+                    if not jobs:
+                        return
+                    ranged = jobs.pop()
+                res = _fetch(port, size, ranged)
+                with lock:
+                    results.append(res)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - started
+        cpu = _worker_cpu(proc.pid) - cpu_before
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    requested = sum(r[1] for r in results)
+    received = sum(r[2] for r in results)
+    return {
+        'mode': mode,
+        'requests': len(results),
+        'statuses': sorted({r[3] for r in results}),
+        'short_or_long_bodies': sum(1 for r in results if r[2] != r[1]) if mode != 'offload' else None,
+        'wall_seconds': round(wall, 3),
+        'throughput_mib_s': round(received / wall / 2**20, 1) if mode != 'offload' else None,
+        'mean_latency_ms': round(sum(r[0] for r in results) / len(results) * 1000, 1),
+        'worker_cpu_seconds': round(cpu, 3),
+        'worker_cpu_seconds_per_gib': round(cpu / (requested / 2**30), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=24)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    size = args.size_mb * 2**20
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.bin')
+        with open(path, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(2**20))
+        results = [run_mode(mode, path, size, args.clients, args.requests) for mode in MODES]
+
+    print(f'{"mode":<8} {"status":<10} {"wall s":>8} {"MiB/s":>8} {"mean ms":>9} {"cpu s":>7} {"cpu s/GiB":>10}')
+    for r in results:
+        print(f'{r["mode"]:<8} {",".join(map(str, r["statuses"])):<10} {r["wall_seconds"]:>8} '
+              f'{r["throughput_mib_s"] if r["throughput_mib_s"] is not None else "-":>8} '
+              f'{r["mean_latency_ms"]:>9} {r["worker_cpu_seconds"]:>7} {r["worker_cpu_seconds_per_gib"]:>10}')
+    print('offload: the body is sent by the front proxy, so only header time is measured.')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Benchmark per-job startup overhead: fork-per-job (`rq worker`) against the warm pool (`worker.py`).
+
+`fork` mirrors an RQ work-horse: a process that has only imported rq forks for every job, and
+the child imports the downloader and runs the job. `warm` mirrors a warm pool process: the
+downloader is imported and `warm_up()` has run once, and jobs execute in-process. Both modes
+download the same small file from a local HTTP server with the result cache off, so the
+difference between them is the per-job startup overhead.
+
+Usage: python benchmarks/bench_worker_startup.py [--jobs 20] [--size-kb 512] [--json out.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import http.server
+import functools
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('fork', 'warm')
+
+
+def _serve(directory):
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=directory)
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _job(url):
+    import downloader
+    path = downloader.download_media(url, use_redis=False)
+    os.remove(path)
+
+
+def _run_fork(url, jobs):
+    import rq  # noqa: F401  (what the forking worker has loaded before a job)
+    timings = []
+    for _ in range(jobs):
+        read_fd, write_fd = os.pipe()
+        started = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            status = 0
+            try:
+                _job(url)
+            except BaseException:
+                status = 1
+            os.write(write_fd, b'ok' if status == 0 else b'fail')
+            os._exit(status)
+        os.close(write_fd)
+        result = os.read(read_fd, 16)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        timings.append(time.perf_counter() - started)
+        if result != b'ok':
+            raise RuntimeError('benchmark job failed in the forked child')
+    return timings, None
+
+
+def _run_warm(url, jobs):
+    import downloader
+    started = time.perf_counter()
+    downloader.warm_up()
+    warm_up_seconds = time.perf_counter() - started
+    timings = []
+    for _ in range(jobs):
+        started = time.perf_counter()
+        _job(url)
+        timings.append(time.perf_counter() - started)
+    return timings, warm_up_seconds
+
+
+def _child_main(mode, jobs, size_kb):
+    sys.path.insert(0, ROOT)
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'bench.mp4'), 'wb') as f:
+            f.write(os.urandom(size_kb * 1024))
+        server = _serve(tmp)
+        url = f'http://127.0.0.1:{server.server_address[1]}/bench.mp4'
+        timings, warm_up_seconds = (_run_fork if mode == 'fork' else _run_warm)(url, jobs)
+        server.shutdown()
+    timings.sort()
+    print(json.dumps({
+        'mode': mode,
+        'jobs': jobs,
+        'mean_ms': round(statistics.mean(timings) * 1000, 1),
+        'median_ms': round(statistics.median(timings) * 1000, 1),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 1),
+        'warm_up_seconds': round(warm_up_seconds, 3) if warm_up_seconds is not None else None,
+    }))
+
+
+def run_mode(mode, jobs, size_kb):
+    # no Redis and no result cache: every job does the full download path
+    env = dict(os.environ, REDIS_URL='redis://127.0.0.1:1/0', RESULT_CACHE='0')
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, '--jobs', str(jobs), '--size-kb', str(size_kb)],
+                         env=env, cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=20)
+    parser.add_argument('--size-kb', type=int, default=512)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        _child_main(args.child, args.jobs, args.size_kb)
+        return
+
+    results = [run_mode(mode, args.jobs, args.size_kb) for mode in MODES]
+    print(f'{"mode":<6} {"jobs":>5} {"mean ms":>9} {"median ms":>10} {"p95 ms":>8} {"warm-up s":>10}')
+    for r in results:
+        print(f'{r["mode"]:<6} {r["jobs"]:>5} {r["mean_ms"]:>9} {r["median_ms"]:>10} {r["p95_ms"]:>8} '
+              f'{r["warm_up_seconds"] if r["warm_up_seconds"] is not None else "-":>10}')
+    by_mode = {r['mode']: r for r in results}
+    print(f'per-job startup overhead removed: {by_mode["fork"]["mean_ms"] - by_mode["warm"]["mean_ms"]:.1f} ms (mean)')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
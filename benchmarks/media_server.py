@@ -0,0 +1,161 @@
+"""
+Local stand-in for a media host, for benchmarks that must not touch the network.
+
+Serves synthetic media from a temporary directory over HTTP (Range requests included):
+  /progressive.mp4      one progressive file
+  /hls/index.m3u8       HLS media playlist with SEGMENTS MPEG-TS segments
+  /dash/manifest.mpd    DASH manifest, one muxed representation with SEGMENTS segments
+The payload bytes are random; yt-dlp's native downloaders do not inspect them and no
+post-processing runs for these formats, so ffmpeg is not needed.
+
+Usage: python benchmarks/media_server.py [--size-kb 1024] [--segments 10] [--port 8765]
+"""
+import os
+import argparse
+import tempfile
+import threading
+import functools
+import http.server
+
+SEGMENT_SECONDS = 4
+_HLS = '''#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:{duration}
+#EXT-X-MEDIA-SEQUENCE:0
+#EXT-X-PLAYLIST-TYPE:VOD
+{segments}
+#EXT-X-ENDLIST
+'''
+_DASH = '''<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" profiles="urn:mpeg:dash:profile:isoff-on-demand:2011"
+     mediaPresentationDuration="PT{total}S" minBufferTime="PT2S">
+  <Period id="0" start="PT0S">
+    <AdaptationSet mimeType="video/mp4" segmentAlignment="true">
+      <Representation id="muxed" codecs="avc1.64001f,mp4a.40.2" width="1280" height="720" bandwidth="{bandwidth}">
+        <SegmentTemplate timescale="1" duration="{duration}" startNumber="1" initialization="init.mp4" media="seg-$Number$.m4s"/>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+'''
+
+
+class _Handler(http.server.SimpleHTTPRequestHandler):
+    """Static files with single byte-range support, which yt-dlp uses for resumes and chunks."""
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        rng = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if not rng or not rng.startswith('bytes=') or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start, _, end = rng[len('bytes='):].partition('-')
+        start = int(start or 0)
+        end = min(int(end), size - 1) if end else size - 1
+        if start >= size:
+            self.send_error(416)
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return _Limited(f, end - start + 1)
+
+
+class _Limited:
+    """File wrapper that stops `copyfile` at the end of the requested range."""
+
+    def __init__(self, f, length):
+        self.f, self.remaining = f, length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def _write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+
+
+def generate(directory, size_kb=1024, segments=10):
+    """Write the synthetic media into `directory`; every variant is about `size_kb` KiB."""
+    size = size_kb * 1024
+    _write(os.path.join(directory, 'progressive.mp4'), size)
+    segment = max(size // segments, 1)
+    lines = []
+    for i in range(segments):
+        _write(os.path.join(directory, 'hls', f'seg{i}.ts'), segment)
+        lines.append(f'#EXTINF:{SEGMENT_SECONDS}.0,\nseg{i}.ts')
+    with open(os.path.join(directory, 'hls', 'index.m3u8'), 'w') as f:
+        f.write(_HLS.format(duration=SEGMENT_SECONDS, segments='\n'.join(lines)))
+    _write(os.path.join(directory, 'dash', 'init.mp4'), 1024)
+    for i in range(1, segments + 1):
+        _write(os.path.join(directory, 'dash', f'seg-{i}.m4s'), segment)
+    with open(os.path.join(directory, 'dash', 'manifest.mpd'), 'w') as f:
+        f.write(_DASH.format(total=segments * SEGMENT_SECONDS, duration=SEGMENT_SECONDS,
+                             bandwidth=segment * 8 // SEGMENT_SECONDS))
+
+
+class MediaServer:
+    """Context manager: generates the media in a temporary directory and serves it on 127.0.0.1."""
+
+    PATHS = {'progressive': '/progressive.mp4', 'hls': '/hls/index.m3u8', 'dash': '/dash/manifest.mpd'}
+
+    def __init__(self, size_kb=1024, segments=10, port=0):
+        self.size_kb, self.segments, self.port = size_kb, segments, port
+        self._tmp = None
+        self._server = None
+
+    def __enter__(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix='bench-media-')
+        generate(self._tmp.name, self.size_kb, self.segments)
+        handler = functools.partial(_Handler, directory=self._tmp.name)
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), handler)
+        self._server.daemon_threads = True
+        # downloaders drop connections mid-transfer when a benchmark stops them
+        self._server.handle_error = lambda request, client_address: None
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        self._tmp.cleanup()
+
+    def url(self, variant):
+        return f'http://127.0.0.1:{self._server.server_address[1]}{self.PATHS[variant]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-kb', type=int, default=1024)
+    parser.add_argument('--segments', type=int, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    with MediaServer(args.size_kb, args.segments, args.port) as server:
+        for variant in MediaServer.PATHS:
+            print(f'{variant:<12} {server.url(variant)}')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
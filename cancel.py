@@ -0,0 +1,131 @@
+"""
+Cooperative cancellation of running downloads.
+
+A background job is cancelled through the `cancel` field of its `jobstore` hash (set by
+`DELETE /jobs/<id>`); a synchronous download is cancelled by its caller, e.g. when the client
+disconnects. A `Watch` runs next to every download and polls both every CANCEL_POLL_SECONDS.
+Once the download is cancelled:
+  - `Watch.check`, called from the downloader's progress and postprocessor hooks, raises
+    `Cancelled` in every thread yt-dlp downloads in, which stops it mid-transfer
+  - ffmpeg processes working in the job's workspace (merges, fixups, audio transcodes) are killed
+The downloader then removes the workspace as for any failed download.
+"""
+import os
+import signal
+import select
+import socket
+import threading
+from typing import Callable, Optional
+from yt_dlp.utils import DownloadCancelled
+from redis.exceptions import RedisError
+import jobstore
+
+CANCEL_POLL_SECONDS = float(os.getenv('CANCEL_POLL_SECONDS', '1'))
+
+
+class Cancelled(DownloadCancelled):
+    # yt-dlp passes DownloadCancelled through its own error handling instead of wrapping it
+    msg = 'The download was cancelled'
+
+
+def kill_processes(marker: str) -> int:
+    """SIGKILL the child processes of this process whose command line contains `marker` (a job's
+    workspace path) and return how many were killed. Needs /proc; elsewhere nothing is killed."""
+    parent = str(os.getpid())
+    marker = os.fsencode(marker)
+    killed = 0
+    try:
+        pids = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                # the command name in parentheses may contain spaces
+                ppid = f.read().rsplit(b')', 1)[1].split()[1].decode()
+            if ppid != parent:
+                continue
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                args = f.read().split(b'\0')
+            if any(marker in arg for arg in args):
+                os.kill(int(pid), signal.SIGKILL)
+                killed += 1
+        except (OSError, IndexError):
+            continue
+    return killed
+
+
+def socket_closed(sock) -> bool:
+    """Whether the peer of a connected socket went away, without consuming anything from it:
+    for synchronous requests whose client waits without sending anything more."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except ValueError:
+        # TLS sockets can't peek; assume the client is still there
+        return False
+    except OSError:
+        return True
+
+
+class Watch:
+    """Cancellation state of one download. `requested` is polled besides the job's Redis flag
+    (with `client`); `workdir` is where the ffmpeg processes to kill work."""
+
+    def __init__(self, client=None, job_id=None, workdir=None, requested: Optional[Callable[[], bool]] = None):
+        self.client = client
+        self.job_id = job_id
+        self.workdir = workdir
+        self.requested = requested
+        self._cancelled = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def _poll(self):
+        if self.requested is not None and self.requested():
+            return True
+        if self.client is None or self.job_id is None:
+            return False
+        try:
+            return jobstore.cancel_requested(self.job_id, conn=self.client)
+        except RedisError:
+            return False
+
+    def _run(self):
+        while not self._stopped.wait(CANCEL_POLL_SECONDS):
+            if self._poll():
+                self.cancel()
+                return
+
+    def start(self):
+        """Check once right away (the job may have been cancelled while queued), then keep
+        polling in a daemon thread until `stop`."""
+        if self.client is None and self.requested is None:
+            return self
+        if self._poll():
+            self.cancel()
+            return self
+        self._thread = threading.Thread(target=self._run, name=f'cancel-{self.job_id}', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.workdir and not self._stopped.is_set():
+            killed = kill_processes(self.workdir)
+            if killed:
+                print(f'[INFO] Killed {killed} ffmpeg process(es) working on cancelled job {self.job_id}', flush=True)
+
+    def check(self, d=None):
+        """Raise `Cancelled` once the download is cancelled; a yt-dlp progress/postprocessor hook."""
+        if self._cancelled.is_set():
+            raise Cancelled()
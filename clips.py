@@ -0,0 +1,63 @@
+"""
+Clips: downloading only a time range of the media.
+
+yt-dlp's `download_ranges` hands the section to ffmpeg, which seeks in its input before reading:
+of HLS/DASH media only the segments covering the section are fetched, of a single file only the
+byte ranges around it. The cut is made at the keyframe at or before the start and the streams
+are copied, so a clip may begin up to one keyframe interval early but nothing is re-encoded.
+CLIP_EXACT_CUTS re-encodes around the cuts for frame-exact clips instead.
+"""
+import os
+from typing import Optional, Tuple
+from yt_dlp.utils import download_range_func, parse_duration
+
+CLIP_EXACT_CUTS = os.getenv('CLIP_EXACT_CUTS', '0') == '1'
+
+Section = Tuple[float, Optional[float]]
+
+
+def _seconds(value):
+    value = (value or '').strip() if isinstance(value, str) else value
+    if value in (None, ''):
+        return None
+    seconds = parse_duration(str(value))
+    if seconds is None or seconds < 0:
+        raise ValueError(f'Unreadable time {value!r}; use seconds or [h:]mm:ss')
+    return float(seconds)
+
+
+def parse_section(start=None, end=None) -> Optional[Section]:
+    """(start, end) in seconds from form values like '90', '1:30' or '1:02:03.5'; `end` None
+    means the end of the media. None when neither is given; ValueError for an empty section."""
+    start, end = _seconds(start), _seconds(end)
+    if start is None and end is None:
+        return None
+    start = start or 0.0
+    if end is not None and end <= start:
+        raise ValueError('The clip must end after it starts')
+    return start, end
+
+
+def length(section: Optional[Section], duration: Optional[float] = None) -> Optional[float]:
+    """Seconds of media the section covers (None if unknown); the whole `duration` without one."""
+    if section is None:
+        return duration
+    start, end = section
+    if end is None or (duration and end > duration):
+        end = duration
+    return max(end - start, 0.0) if end is not None else None
+
+
+def label(section: Section) -> str:
+    """'90s-120s', '0s-end': part of the clip's file name."""
+    start, end = section
+    return f'{start:g}s-{"end" if end is None else f"{end:g}s"}'
+
+
+def ydl_opts(section: Section) -> dict:
+    """yt-dlp options downloading only `section`."""
+    start, end = section
+    return {
+        'download_ranges': download_range_func(None, [(start, float('inf') if end is None else end)]),
+        'force_keyframes_at_cuts': CLIP_EXACT_CUTS,
+    }
@@ -1,47 +1,75 @@
 import os
+import time
 import uuid
 import json
+import shutil
+import hashlib
+import threading
 import subprocess
-from typing import Optional
+from collections import OrderedDict
+from typing import Callable, Optional
 from yt_dlp import YoutubeDL
+from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+from yt_dlp.utils import format_bytes
 from dotenv import load_dotenv
 import redis
+import quota
+import progress
+import hostlimit
+import metrics
+import platforms
+import audio
+import presets
+import clips
+import jobstore
+import bandwidth
+import resume
+import cancel
+import result_cache
+import storage
 
 load_dotenv()
 
 BASE_DIR = os.path.dirname(__file__)
 DOWNLOAD_DIR = os.path.join(BASE_DIR, 'downloads')
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+# Per-job workspaces (`.work/{job_id}`); finished files go to `storage` (by default `{job_id}/` next to it)
+WORK_DIR = os.path.join(DOWNLOAD_DIR, '.work')
+os.makedirs(WORK_DIR, exist_ok=True)
 
-REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
-try:
-    redis_client = redis.from_url(REDIS_URL)
-except Exception:
-    redis_client = None
+redis_client = jobstore.client
 
 DEFAULT_MAX_FILESIZE = os.getenv('MAX_FILESIZE', None)  # e.g. '50M' or None
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE', '1') != '0'
+INFO_CACHE_TTL = int(os.getenv('INFO_CACHE_TTL', str(30 * 60)))
+INFO_CACHE_LOCAL_BYTES = int(os.getenv('INFO_CACHE_LOCAL_BYTES', str(32 * 1024 * 1024)))
+# A workspace untouched for this long belongs to a crashed job (longer than any lane timeout)
+WORKSPACE_STALE_SECONDS = int(os.getenv('WORKSPACE_STALE_SECONDS', str(4 * 60 * 60)))
+WORKSPACE_SWEEP_INTERVAL = 10 * 60
+# HTTP answers to a stream URL from cached metadata that mean it has to be extracted again
+EXPIRED_URL_STATUSES = (403, 404, 410)
+
+# info key -> (expires_at, info JSON); bounded by the total JSON size
+_info_local = OrderedDict()
+_info_local_bytes = 0
+_info_lock = threading.Lock()
+
+# YoutubeDL's default extractor list, resolved once per process (see `new_ydl`)
+_default_ies = None
+_ies_lock = threading.Lock()
+
+_last_sweep = 0.0
 
 
 def _safe_title(info):
     return info.get('title', 'download')
 
 
-def _make_outtmpl(ext_template='%(title)s.%(ext)s'):
-    return os.path.join(DOWNLOAD_DIR, ext_template)
+def _make_outtmpl(ext_template='%(title)s.%(ext)s', directory=DOWNLOAD_DIR):
+    return os.path.join(directory, ext_template)
 
 
-def download_media(url: str, kind: str = 'video', job_id: Optional[str] = None, cookies_text: Optional[str] = None, max_filesize: Optional[str] = None, use_redis: bool = True) -> str:
-    """
-    Download media via yt-dlp. kind: 'video' or 'audio'.
-    Reports progress to Redis key `progress:{job_id}` as JSON with keys: status, downloaded_bytes, total_bytes, percent.
-    Stores final filepath to Redis key `result:{job_id}`.
-    """
-    if job_id is None:
-        job_id = str(uuid.uuid4())
-
-    outtmpl = _make_outtmpl('%(title)s.%(ext)s')
-    opts = {
-        'outtmpl': outtmpl,
+def _base_opts():
+    return {
         'noplaylist': True,
         'quiet': True,
         'socket_timeout': 60,
@@ -49,35 +77,511 @@ def download_media(url: str, kind: str = 'video', job_id: Optional[str] = None,
         'age_limit': None,
     }
 
+
+def _extractor_list():
+    global _default_ies
+    with _ies_lock:
+        if _default_ies is None:
+            with YoutubeDL({'quiet': True}) as ydl:
+                _default_ies = list(ydl._ies.values())
+    return _default_ies
+
+
+def new_ydl(opts: dict, extractors=None) -> YoutubeDL:
+    """
+    YoutubeDL for `opts` that reuses the process-wide extractor list, or the pre-resolved
+    `extractors` of a platform route. YoutubeDL otherwise rebuilds the ordered list of ~1800
+    extractors for every instance, which dominates its construction time. Options that change
+    the list (`allowed_extractors`) or want the verbose header get a regular instance.
+    """
+    if opts.get('allowed_extractors') or opts.get('verbose'):
+        return YoutubeDL(opts)
+    ydl = YoutubeDL(opts, auto_init=False)
+    for ie in extractors or _extractor_list():
+        # classes are instantiated lazily per YoutubeDL; instances must not be shared
+        ydl.add_info_extractor(ie if isinstance(ie, type) else type(ie)())
+    return ydl
+
+
+def warm_up():
+    """
+    Pay one-time per-process costs up front, for long-lived workers: build the extractor list,
+    compile every extractor's URL pattern, build the format selectors, probe ffmpeg and open
+    the Redis connection. Processes forked afterwards inherit all of it.
+    """
+    _extractor_list()
+    for platform in platforms.PLATFORMS:
+        platforms.extractors_for(platform)
+    # the generic extractor is tried last, so an unmatched URL compiles every _VALID_URL
+    result_cache.resolve_extractor('https://warm-up.invalid/')
+    with new_ydl(_base_opts()) as ydl:
+        ydl.build_format_selector(_format_opts('audio')['format'])
+    FFmpegPostProcessor.get_versions()
+    cleanup_workspaces()
+    if redis_client is not None:
+        try:
+            redis_client.ping()
+        except Exception:
+            pass
+
+
+def _cookiefile_path(name, directory=DOWNLOAD_DIR):
+    return os.path.join(directory, f'cookies-{name}.txt')
+
+
+def _write_cookiefile(name, cookies_text, directory=DOWNLOAD_DIR):
+    """Write user-supplied cookies to a temporary file for yt-dlp's `cookiefile` option."""
+    os.makedirs(directory, exist_ok=True)
+    cookiefile = _cookiefile_path(name, directory)
+    # Ensure cookies text is properly formatted (each line is a cookie entry)
+    # Remove any BOM or extra whitespace at start/end
+    cookies_clean = cookies_text.strip()
+    if not cookies_clean.startswith('# Netscape HTTP Cookie File'):
+        # If it doesn't look like a Netscape cookie file, just write it as-is
+        pass
+    with open(cookiefile, 'w', encoding='utf-8') as f:
+        f.write(cookies_clean)
+    print(f'[INFO] Using cookies file: {cookiefile}', flush=True)
+    return cookiefile
+
+
+def cleanup_workspaces(max_age: int = None):
+    """Remove workspaces left behind by crashed or killed jobs. A workspace counts as stale
+    when neither it nor any file in it changed for `max_age` seconds (WORKSPACE_STALE_SECONDS)."""
+    global _last_sweep
+    _last_sweep = time.time()
+    cutoff = time.time() - (WORKSPACE_STALE_SECONDS if max_age is None else max_age)
+    try:
+        workspaces = list(os.scandir(WORK_DIR))
+    except FileNotFoundError:
+        return
+    for entry in workspaces:
+        try:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            changed = max([entry.stat().st_mtime] + [f.stat().st_mtime for f in os.scandir(entry.path)])
+        except FileNotFoundError:
+            continue
+        if changed < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            print(f'[INFO] Removed stale workspace {entry.path}', flush=True)
+
+
+def _remove_file(path):
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+
+def _set_progress(job_id, payload, result=None):
+    """Write and publish a progress payload for `job_id`; Redis errors are ignored."""
+    if redis_client is None:
+        return
+    try:
+        progress.publish(redis_client, job_id, payload, result)
+    except Exception:
+        pass
+
+
+def _info_key(url):
+    return 'info:' + hashlib.sha256(json.dumps(result_cache.media_identity(url)).encode('utf-8')).hexdigest()
+
+
+def _info_local_get(key):
+    with _info_lock:
+        entry = _info_local.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            _info_local_pop(key)
+            return None
+        _info_local.move_to_end(key)
+        return entry[1]
+
+
+def _info_local_pop(key):
+    global _info_local_bytes
+    entry = _info_local.pop(key, None)
+    if entry is not None:
+        _info_local_bytes -= len(entry[1])
+
+
+def _info_local_put(key, text, ttl):
+    global _info_local_bytes
+    with _info_lock:
+        _info_local_pop(key)
+        if len(text) > INFO_CACHE_LOCAL_BYTES:
+            return
+        _info_local[key] = (time.time() + ttl, text)
+        _info_local_bytes += len(text)
+        while _info_local_bytes > INFO_CACHE_LOCAL_BYTES:
+            _info_local_pop(next(iter(_info_local)))
+
+
+def peek_info(url: str) -> Optional[dict]:
+    """Cached info for `url` from the local LRU or Redis, or None; never runs an extraction."""
+    key = _info_key(url)
+    text = _info_local_get(key)
+    if text is None and redis_client:
+        try:
+            pipe = redis_client.pipeline()
+            pipe.get(key)
+            pipe.ttl(key)
+            raw, ttl = pipe.execute()
+        except Exception:
+            raw = None
+        if raw:
+            text = raw.decode('utf-8')
+            _info_local_put(key, text, ttl if ttl and ttl > 0 else INFO_CACHE_TTL)
+    return json.loads(text) if text else None
+
+
+def _store_info(url, info):
+    key = _info_key(url)
+    text = json.dumps(info)
+    _info_local_put(key, text, INFO_CACHE_TTL)
+    if redis_client:
+        try:
+            redis_client.set(key, text, ex=INFO_CACHE_TTL)
+        except Exception:
+            pass
+
+
+def get_info(url: str, cookies_text: Optional[str] = None, platform: Optional[str] = 'auto') -> dict:
+    """
+    Extract metadata for `url` without downloading and return the sanitized info dict.
+    `platform` ('auto' or a key of `platforms.PLATFORMS`) picks the extractor set to match against.
+    Results are cached in Redis for INFO_CACHE_TTL seconds and in a size-bounded in-process LRU,
+    and a following `download_media` for the same media reuses them instead of extracting again.
+    Requests with cookies are neither served from nor stored in the cache.
+    """
+    use_cache = not (cookies_text and cookies_text.strip())
+    if use_cache:
+        info = peek_info(url)
+        metrics.CACHE_LOOKUPS.labels('info', 'miss' if info is None else 'hit').inc()
+        if info is not None:
+            return info
+
+    route = platforms.resolve(url, platform)
+    opts = _base_opts()
+    opts.update(route['opts'])
+    cookiefile = None
+    if not use_cache:
+        cookiefile = _write_cookiefile(f'info-{uuid.uuid4()}', cookies_text)
+        opts['cookiefile'] = cookiefile
+    try:
+        with new_ydl(opts, route['extractors']) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        raise RuntimeError(f'yt-dlp failed: {str(e)}') from e
+    finally:
+        _remove_file(cookiefile)
+
+    # subtitles are never written, and auto-generated caption tracks can dominate the size
+    info.pop('automatic_captions', None)
+    if use_cache:
+        _store_info(url, info)
+    return info
+
+
+def estimate_filesize(fmt: dict, duration: Optional[float] = None) -> Optional[int]:
+    """Best size estimate for a format: exact size, yt-dlp's approximation, or bitrate x duration."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+
+def summarize_info(info: dict) -> dict:
+    """Compact view of an info dict: title, duration and the available formats with size estimates."""
+    duration = info.get('duration')
+    formats = []
+    for f in info.get('formats') or []:
+        formats.append({
+            'format_id': f.get('format_id'),
+            'ext': f.get('ext'),
+            'resolution': f.get('resolution'),
+            'height': f.get('height'),
+            'vcodec': f.get('vcodec'),
+            'acodec': f.get('acodec'),
+            'tbr': f.get('tbr'),
+            'filesize': estimate_filesize(f, duration),
+        })
+    return {
+        'id': info.get('id'),
+        'title': _safe_title(info),
+        'extractor': info.get('extractor_key'),
+        'duration': duration,
+        'uploader': info.get('uploader'),
+        'thumbnail': info.get('thumbnail'),
+        'webpage_url': info.get('webpage_url'),
+        'filesize': estimate_filesize(info, duration),
+        'formats': formats,
+    }
+
+
+def _track_result(filename, reused):
+    """Account a finished file in the disk quota index; Redis errors are ignored. Objects are left
+    to the store's own expiry rules."""
+    if redis_client is None or storage.is_remote(filename):
+        return
+    try:
+        quota.rebuild(redis_client, storage.file_root())
+        if reused:
+            quota.touch(redis_client, filename)
+        else:
+            quota.register(redis_client, filename)
+    except Exception as e:
+        print(f'[WARN] Disk quota bookkeeping failed: {e}', flush=True)
+
+
+def _format_opts(kind, audio_format=None, quality=None, max_filesize=None, seconds=None):
+    """yt-dlp format options for a download kind; audio conversion is done by `audio.finalize`.
+    Video formats are picked by `presets.FormatSelector` for the quality preset and size cap,
+    sized for `seconds` of media when only a clip is downloaded."""
     if kind == 'video':
-        opts.update({'format': 'bestvideo+bestaudio/best'})
-    else:
-        opts.update({'format': 'bestaudio/best', 'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}]})
+        return {'format': presets.FormatSelector(quality, max_filesize, seconds)}
+    return {'format': audio.format_selector(audio_format or audio.DEFAULT_AUDIO_FORMAT)}
+
+
+def download_media(url: str, kind: str = 'video', job_id: Optional[str] = None, cookies_text: Optional[str] = None, max_filesize: Optional[str] = None, use_redis: bool = True, concurrent_fragments: Optional[int] = None, platform: Optional[str] = 'auto',
+                   audio_format: Optional[str] = None, client_id: Optional[str] = None, quality: Optional[str] = None,
+                   resumable: bool = False, cancelled: Optional[Callable[[], bool]] = None, start: Optional[float] = None,
+                   end: Optional[float] = None) -> str:
+    """
+    Download media via yt-dlp. kind: 'video' or 'audio'.
+    `audio_format` ('mp3', 'm4a', 'opus' or 'best') is the output for audio; the source codec is
+    copied when the target allows it and only real transcodes use the bounded ffmpeg pool.
+    `quality` ('best', '1080p', '720p', '480p', '360p' or 'under:<size>') picks the video format,
+    preferring a pre-muxed file over a merge and never one estimated over `max_filesize`.
+    `concurrent_fragments` overrides the platform's FRAGMENT_CONCURRENCY for DASH/HLS downloads.
+    `platform` ('auto' or a key of `platforms.PLATFORMS`) picks the extractor set and platform options.
+    `start`/`end` (seconds, or '1:30'-style strings) download only that section of the media; see `clips`.
+    Reports progress to the job's `jobstore` hash as JSON with keys: status, downloaded_bytes, total_bytes, percent,
+    and stores the result there with the `finished` status. The result, also returned, is the
+    finished file's `storage` reference: its path, unless results are kept in an object store.
+
+    Finished files are cached by (extractor, media id, kind, format or preset, section, max_filesize); a cache hit
+    skips yt-dlp entirely and identical concurrent requests share one download.
+    Requests with cookies bypass the cache since their result may be private to the user.
+
+    Requests to one extractor (or host) are capped across all workers by `hostlimit.HostSlots`,
+    and a 429/503 answer backs that host off for every worker.
+    The transfer is paced by `bandwidth.Governor` (global, per-`client_id` and per-job limits).
 
-    # apply max filesize if provided
+    `resumable` means the caller runs the download again after a transient failure (RQ retry):
+    the attempt then leaves its workspace behind and reports `retrying`, and the next attempt
+    resumes the partial files. Attempts stop once RETRY_REFETCH_LIMIT bytes had to be fetched twice.
+
+    The download stops with `cancel.Cancelled` once the job is cancelled (`DELETE /jobs/<id>`) or
+    `cancelled()` returns True, e.g. for a client that disconnected; running ffmpeg processes are
+    killed, the workspace is removed and the job reports `cancelled`.
+    """
+    if job_id is None:
+        job_id = str(uuid.uuid4())
     if max_filesize is None:
         max_filesize = DEFAULT_MAX_FILESIZE
-    if max_filesize:
-        opts['max_filesize'] = max_filesize
+    if kind == 'audio' and audio_format not in audio.AUDIO_FORMATS:
+        audio_format = audio.DEFAULT_AUDIO_FORMAT
+    if kind == 'video':
+        quality = presets.normalize(quality)
+    section = clips.parse_section(start, end)
+
+    if time.time() - _last_sweep > WORKSPACE_SWEEP_INTERVAL:
+        cleanup_workspaces()
+
+    workdir = os.path.join(WORK_DIR, job_id)
+    watch = cancel.Watch(redis_client if use_redis else None, job_id, workdir, cancelled)
+
+    def _produce():
+        # yt-dlp writes into a workspace private to this job; only the finished file leaves it,
+        # unless a failed attempt keeps it for the next one to resume
+        os.makedirs(workdir, exist_ok=True)
+        keep = False
+        try:
+            watch.check()
+            if use_redis and redis_client and resume.RETRY_REFETCH_LIMIT:
+                wasted = resume.refetched(redis_client, job_id, workdir)
+                if wasted > resume.RETRY_REFETCH_LIMIT:
+                    error = f'Gave up after downloading {format_bytes(wasted)} more than once'
+                    _set_progress(job_id, {'status': 'error', 'error': error})
+                    raise RuntimeError(error)
+            return _download(url, kind, job_id, cookies_text, max_filesize, use_redis, concurrent_fragments, platform, audio_format, workdir,
+                             client_id, quality, resumable, watch, section)
+        except BaseException as e:
+            keep = resumable and resume.is_transient(e)
+            if isinstance(e, cancel.Cancelled) and use_redis:
+                _set_progress(job_id, {'status': 'cancelled'})
+            raise
+        finally:
+            if not keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+            else:
+                # the partial media is kept for the next attempt, the user's cookies are not
+                _remove_file(_cookiefile_path(job_id, workdir))
+
+    started = time.perf_counter()
+    metrics.IN_PROGRESS.inc()
+    watch.start()
+    try:
+        filename, hit = _download_cached(url, kind, cookies_text, max_filesize, audio_format, quality, _produce, section)
+    except cancel.Cancelled:
+        metrics.DOWNLOAD_SECONDS.labels(kind, 'cancelled').observe(time.perf_counter() - started)
+        raise
+    except Exception as e:
+        metrics.DOWNLOAD_SECONDS.labels(kind, 'failed').observe(time.perf_counter() - started)
+        metrics.FAILURES.labels(metrics.failure_reason(e)).inc()
+        raise
+    finally:
+        watch.stop()
+        metrics.IN_PROGRESS.dec()
+    metrics.DOWNLOAD_SECONDS.labels(kind, 'cached' if hit else 'downloaded').observe(time.perf_counter() - started)
+    _track_result(filename, reused=hit)
+
+    # write result and final status together (if Redis available and enabled)
+    if use_redis and redis_client:
+        _set_progress(job_id, {'status': 'finished'}, result=filename)
+    return filename
+
+
+def _download_cached(url, kind, cookies_text, max_filesize, audio_format, quality, produce, section=None):
+    """Return (result, cache_hit): the cached result for an identical request, or `produce()`."""
+    hit = False
+    if RESULT_CACHE_ENABLED and redis_client and not (cookies_text and cookies_text.strip()):
+        if kind == 'video':
+            fmt_opts = {'quality': quality}
+        else:
+            fmt_opts = _format_opts(kind, audio_format)
+            fmt_opts['audio_format'] = audio_format
+        if section is not None:
+            # a clip is its own result; the whole media stays cached under the key without it
+            fmt_opts['section'] = list(section)
+        fmt = json.dumps(fmt_opts, sort_keys=True)
+        try:
+            key = result_cache.cache_key(url, kind, fmt, max_filesize)
+        except Exception:
+            key = None
+        if key:
+            filename, hit = result_cache.get_or_create(redis_client, key, produce)
+            metrics.CACHE_LOOKUPS.labels('result', 'hit' if hit else 'miss').inc()
+            if hit:
+                print(f'[INFO] Result cache hit for {url}: {filename}', flush=True)
+        else:
+            filename = produce()
+    else:
+        filename = produce()
+    return filename, hit
+
+
+def _acquire_host_slots(key, weight, job_id, use_redis):
+    """Take `weight` request slots for `key`, or None if Redis is unavailable or the wait times out."""
+    if redis_client is None:
+        return None
+
+    def _on_wait(reason):
+        print(f'[INFO] Waiting for {key} ({reason})', flush=True)
+        if use_redis:
+            _set_progress(job_id, {'status': 'waiting', 'reason': reason})
+
+    slots = hostlimit.HostSlots(redis_client, key, weight)
+    try:
+        if slots.acquire(on_wait=_on_wait):
+            return slots
+        print(f'[WARN] Timed out waiting for {key}, downloading without a slot', flush=True)
+    except redis.exceptions.RedisError as e:
+        print(f'[WARN] Host limiter unavailable: {e}', flush=True)
+    return None
+
+
+def _expired_url_error(exc):
+    """True if `exc` (or an error it wraps) is an HTTP answer to a stream URL that expired or
+    is no longer valid for this client (403, 404, 410)."""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if getattr(exc, 'status', None) in EXPIRED_URL_STATUSES:
+            return True
+        exc_info = getattr(exc, 'exc_info', None)
+        exc = (exc_info[1] if exc_info else None) or exc.__cause__ or exc.__context__
+    return False
+
+
+def _output_path(ydl, info):
+    """Final path of the downloaded file as reported by yt-dlp after merging and post-processing."""
+    for download in reversed(info.get('requested_downloads') or []):
+        if download.get('filepath'):
+            return download['filepath']
+    return ydl.prepare_filename(info)
+
+
+def _download(url, kind, job_id, cookies_text, max_filesize, use_redis, concurrent_fragments=None, platform='auto', audio_format=None,
+              workdir=DOWNLOAD_DIR, client_id=None, quality=None, resumable=False, watch=None, section=None):
+    """Run yt-dlp for one request in `workdir` and return the `storage` reference of the published file."""
+    route = platforms.resolve(url, platform)
+    outtmpl = _make_outtmpl(f'%(title)s ({clips.label(section)}).%(ext)s' if section else '%(title)s.%(ext)s', workdir)
+    opts = _base_opts()
+    opts.update(route['opts'])
+    opts['outtmpl'] = outtmpl
+    # continue `.part` and fragment files a previous attempt of this job left in the workspace
+    opts['continuedl'] = True
+
+    opts.update(_format_opts(kind, audio_format, quality, max_filesize, clips.length(section)))
+    if section:
+        opts.update(clips.ydl_opts(section))
+
+    # apply max filesize (and a preset's size cap) in bytes; also stops downloads of unknown size
+    max_bytes = presets.size_cap(quality if kind == 'video' else None, max_filesize)
+    if max_bytes:
+        opts['max_filesize'] = max_bytes
 
     # handle cookies: if cookies_text provided, write to a temporary file and pass cookiefile
     cookiefile = None
     if cookies_text and cookies_text.strip():
-        cookiefile = os.path.join(DOWNLOAD_DIR, f'cookies-{job_id}.txt')
-        # Ensure cookies text is properly formatted (each line is a cookie entry)
-        # Remove any BOM or extra whitespace at start/end
-        cookies_clean = cookies_text.strip()
-        if not cookies_clean.startswith('# Netscape HTTP Cookie File'):
-            # If it doesn't look like a Netscape cookie file, just write it as-is
-            pass
-        with open(cookiefile, 'w', encoding='utf-8') as f:
-            f.write(cookies_clean)
+        # in the workspace, so it goes with it however the download ends
+        cookiefile = _write_cookiefile(job_id, cookies_text, workdir)
         opts['cookiefile'] = cookiefile
-        print(f'[INFO] Using cookies file: {cookiefile}', flush=True)
+
+    # reuse metadata from a preceding get_info() instead of extracting again
+    cached = None if cookiefile else peek_info(url)
+    if not cookiefile:
+        metrics.CACHE_LOOKUPS.labels('info', 'miss' if cached is None else 'hit').inc()
+    host_key = hostlimit.limit_key(url, cached)
+    fragments = hostlimit.fragment_concurrency(host_key, concurrent_fragments)
+    opts['concurrent_fragment_downloads'] = fragments
+    opts['retry_sleep_functions'] = {'http': hostlimit.retry_sleep, 'fragment': hostlimit.retry_sleep}
+
+    reporter = progress.ProgressReporter(redis_client, job_id) if use_redis and redis_client else None
+    # paces from the progress hook: yt-dlp's own `ratelimit` is fixed per download and per fragment
+    governor = bandwidth.Governor(redis_client, client_id) if bandwidth.enabled() else None
+    tracker = resume.Tracker(redis_client, job_id, workdir) if use_redis and redis_client else None
+    slots = None
+    timer = metrics.PhaseTimer(kind)
+    fetched = []
 
     def _progress_hook(d):
+        if watch is not None:
+            # raising here stops yt-dlp, in each fragment thread too
+            watch.check()
+        if slots is not None:
+            try:
+                slots.renew()
+            except Exception:
+                pass
+        if d.get('status') == 'downloading' and timer.phase != 'download':
+            timer.enter('download')
+        elif d.get('status') == 'finished':
+            fetched.append(d.get('downloaded_bytes') or d.get('total_bytes') or 0)
+        if governor is not None:
+            governor.hook(d)
+        if tracker is not None:
+            tracker.hook(d)
+        if reporter is None:
+            return
         try:
-            key = f'progress:{job_id}'
             if d.get('status') == 'downloading':
                 downloaded_bytes = d.get('downloaded_bytes') or 0
                 total_bytes = d.get('total_bytes') or d.get('estimated_bytes') or 0
@@ -93,79 +597,110 @@ def download_media(url: str, kind: str = 'video', job_id: Optional[str] = None,
                     'total_bytes': total_bytes,
                     'percent': percent,
                 }
-                if use_redis and redis_client:
-                    try:
-                        redis_client.set(key, json.dumps(payload))
-                    except Exception:
-                        pass
+                reporter.update(payload)
             elif d.get('status') == 'finished':
                 # finalizing
-                payload = {'status': 'processing'}
-                if use_redis and redis_client:
-                    try:
-                        redis_client.set(f'progress:{job_id}', json.dumps(payload))
-                    except Exception:
-                        pass
+                reporter.update({'status': 'processing'})
         except Exception:
             pass
 
+    def _postprocessor_hook(d):
+        # merging the video and audio streams, fixups, ...
+        if watch is not None:
+            watch.check()
+        if d.get('status') == 'started' and timer.phase != 'postprocess':
+            timer.enter('postprocess')
+
     opts['progress_hooks'] = [_progress_hook]
+    opts['postprocessor_hooks'] = [_postprocessor_hook]
 
+    # each parallel fragment is an in-flight request against the host
+    slots = _acquire_host_slots(host_key, fragments, job_id, use_redis)
+    if section and reporter is not None:
+        # ffmpeg cuts clips without progress reports; only its end is seen by the hook
+        reporter.update({'status': 'downloading', 'downloaded_bytes': 0, 'total_bytes': 0, 'percent': None})
+    timer.enter('extract')
     try:
-        # For YouTube videos, try to extract cookies from browser
-        if 'youtube' in url or 'youtu.be' in url:
+        with new_ydl(opts, route['extractors']) as ydl:
+            info = None
+            if cached is not None:
+                try:
+                    info = ydl.process_ie_result(cached, download=True)
+                except Exception as e:
+                    # stream URLs in cached metadata can expire: extract again only then; a cancel
+                    # or a throttled host must not cost another round of requests
+                    if (watch is not None and watch.cancelled) or not _expired_url_error(e):
+                        raise
+                    print(f'[WARN] Cached info for {url} failed, extracting again: {e}', flush=True)
+            if info is None:
+                info = ydl.extract_info(url, download=True)
+            filename = _output_path(ydl, info)
+        if redis_client:
             try:
-                with YoutubeDL({'cookies_from_browser': ('chrome',)}) as temp_ydl:
-                    # This will extract cookies if available
-                    pass
+                hostlimit.clear_throttle(redis_client, host_key)
             except Exception:
-                pass  # If cookie extraction fails, continue without them
-        
-        with YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
+                pass
     except Exception as e:
+        if watch is not None and watch.cancelled:
+            # stopped by a hook, or ffmpeg was killed under a postprocessor
+            raise cancel.Cancelled() from e
+        if redis_client and hostlimit.is_throttle_error(e):
+            try:
+                delay = hostlimit.record_throttle(redis_client, host_key)
+                print(f'[WARN] {host_key} is throttling requests, backing off for {delay:.0f}s', flush=True)
+            except Exception:
+                pass
+        if use_redis:
+            # watchers keep following a job that RQ will run again
+            status = 'retrying' if resumable and resume.is_transient(e) else 'error'
+            _set_progress(job_id, {'status': status, 'error': f'yt-dlp failed: {str(e)}'})
         raise RuntimeError(f'yt-dlp failed: {str(e)}') from e
-
-    # For audio with FFmpegExtractAudio, the actual file may have a different extension
-    # Try to find the real file: if audio, look for .mp3; otherwise use prepare_filename result
-    if kind == 'audio' and not os.path.exists(filename):
-        # Try common audio extensions
-        base_name = os.path.splitext(filename)[0]
-        for ext in ['.mp3', '.m4a', '.wav', '.aac', '.opus']:
-            alt_path = base_name + ext
-            if os.path.exists(alt_path):
-                filename = alt_path
-                break
-        else:
-            # If still not found, list directory and find most recent file with audio extension
+    finally:
+        timer.close()
+        if tracker is not None:
+            tracker.flush()
+        if slots is not None:
             try:
-                audio_exts = {'.mp3', '.m4a', '.wav', '.aac', '.opus', '.flac', '.ogg'}
-                files = [
-                    os.path.join(DOWNLOAD_DIR, f) 
-                    for f in os.listdir(DOWNLOAD_DIR) 
-                    if os.path.splitext(f)[1].lower() in audio_exts
-                ]
-                if files:
-                    filename = max(files, key=os.path.getctime)
+                slots.release()
             except Exception:
                 pass
 
+    extractor = (info.get('extractor_key') or 'generic').lower()
+    metrics.DOWNLOADED_BYTES.labels(extractor).inc(sum(fetched))
+    metrics.NETWORK_SECONDS.labels(extractor).inc(timer.spent.get('download', 0.0))
+
+    if not os.path.exists(filename) and max_bytes:
+        # yt-dlp stops without an error once a download grows past max_filesize
+        error = f'The media is larger than the size limit of {format_bytes(max_bytes)}'
+        if use_redis:
+            _set_progress(job_id, {'status': 'error', 'error': error})
+        raise RuntimeError(error)
     if not os.path.exists(filename):
+        if use_redis:
+            _set_progress(job_id, {'status': 'error', 'error': 'Download completed but file not found'})
         raise RuntimeError(f'Download completed but file not found at {filename}. Expected downloads in {DOWNLOAD_DIR}')
 
-    # cleanup cookiefile
-    if cookiefile and os.path.exists(cookiefile):
+    if kind == 'audio':
+        # copy the audio stream out as-is when the target allows it, transcode otherwise
+        timer.enter('transcode')
         try:
-            os.remove(cookiefile)
-        except Exception:
-            pass
+            if watch is not None:
+                watch.check()
+            filename = audio.finalize(info, filename, audio_format, redis_client,
+                                      (lambda payload: _set_progress(job_id, payload)) if use_redis else None)
+        except Exception as e:
+            timer.close()
+            _remove_file(cookiefile)
+            if watch is not None and watch.cancelled:
+                raise cancel.Cancelled() from e
+            if use_redis:
+                _set_progress(job_id, {'status': 'error', 'error': f'Audio conversion failed: {str(e)}'})
+            raise
 
-    # write result key (if Redis available and enabled)
-    if use_redis and redis_client:
-        try:
-            redis_client.set(f'result:{job_id}', filename)
-            redis_client.set(f'progress:{job_id}', json.dumps({'status': 'finished'}))
-        except Exception:
-            pass
-    return filename
+        timer.close()
+
+    # cleanup cookiefile
+    _remove_file(cookiefile)
+
+    # readers never see a partial file: an atomic rename, a copy renamed into place, or an upload
+    return storage.publish(filename, job_id)
@@ -0,0 +1,7 @@
+# Loaded automatically by gunicorn from the working directory.
+import metrics
+
+
+def child_exit(server, worker):
+    # drop the exited worker's live gauges from the shared PROMETHEUS_MULTIPROC_DIR
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,161 @@
+import os
+import re
+import time
+import uuid
+import random
+from typing import Optional
+from urllib.parse import urlsplit
+from redis.exceptions import WatchError
+import result_cache
+
+
+def _parse_map(value, default):
+    """Parse 'default=4,youtube=8,cdn.example.com=2' into a dict with a 'default' entry."""
+    limits = {'default': default}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, limit = item.partition('=')
+        if limit.strip().isdigit():
+            limits[name.strip().lower()] = int(limit)
+    return limits
+
+
+# Max in-flight requests per extractor (or host, for generic URLs) across all workers
+HOST_LIMITS = _parse_map(os.getenv('HOST_LIMITS', ''), 8)
+# Fragments fetched in parallel for DASH/HLS downloads, per extractor or host
+FRAGMENT_CONCURRENCY = _parse_map(os.getenv('FRAGMENT_CONCURRENCY', ''), 4)
+FRAGMENT_MAX = 16
+# A slot lease expires unless renewed, so a crashed worker cannot hold slots forever
+HOST_SLOT_TTL = int(os.getenv('HOST_SLOT_TTL', '60'))
+# How long a download waits for slots before going ahead uncoordinated
+HOST_WAIT_TIMEOUT = int(os.getenv('HOST_WAIT_TIMEOUT', str(10 * 60)))
+HOST_POLL_INTERVAL = 0.5
+# Cluster-wide pause after a host answers 429/503: doubles per consecutive failure up to the max
+BACKOFF_BASE = float(os.getenv('HOST_BACKOFF_BASE', '5'))
+BACKOFF_MAX = float(os.getenv('HOST_BACKOFF_MAX', '300'))
+
+# Per limit key:
+#   hostsem:{key}         sorted set  slot member -> lease expiry timestamp
+#   throttle:{key}        exists while the host is backed off (PX = remaining pause)
+#   throttle-level:{key}  consecutive throttling failures, reset by a successful download
+_THROTTLE_RE = re.compile(r'HTTP Error (429|503)|Too Many Requests', re.IGNORECASE)
+
+
+def limit_key(url: str, info: Optional[dict] = None) -> str:
+    """Name a download is limited under: the extractor (e.g. 'youtube') or, for generic URLs, the host."""
+    ie_key = (info or {}).get('extractor_key') or result_cache.resolve_extractor(url)[0]
+    if ie_key and ie_key != 'Generic':
+        return ie_key.lower()
+    return (urlsplit(url).hostname or 'unknown').lower()
+
+
+def fragment_concurrency(key: str, requested: Optional[int] = None) -> int:
+    """Fragments to fetch in parallel: the per-job request if given, else the platform default."""
+    value = requested if requested else FRAGMENT_CONCURRENCY.get(key, FRAGMENT_CONCURRENCY['default'])
+    return max(1, min(FRAGMENT_MAX, int(value)))
+
+
+def retry_sleep(n: int) -> float:
+    """Exponential backoff with jitter between yt-dlp's own HTTP/fragment retries."""
+    return min(BACKOFF_MAX, 2 ** n) * random.uniform(0.5, 1.0)
+
+
+def is_throttle_error(exc: BaseException) -> bool:
+    """True if `exc` (or an error it wraps) is an HTTP 429/503 answer."""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if getattr(exc, 'status', None) in (429, 503) or _THROTTLE_RE.search(str(exc)):
+            return True
+        exc_info = getattr(exc, 'exc_info', None)
+        exc = (exc_info[1] if exc_info else None) or exc.__cause__ or exc.__context__
+    return False
+
+
+def backoff_remaining(client, key: str) -> float:
+    ms = client.pttl(f'throttle:{key}')
+    return ms / 1000 if ms and ms > 0 else 0.0
+
+
+def record_throttle(client, key: str) -> float:
+    """Back `key` off for all workers; returns the pause in seconds."""
+    level = client.incr(f'throttle-level:{key}')
+    client.expire(f'throttle-level:{key}', int(BACKOFF_MAX * 4))
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (level - 1)) * random.uniform(0.8, 1.2)
+    client.set(f'throttle:{key}', 1, px=int(delay * 1000))
+    return delay
+
+
+def clear_throttle(client, key: str):
+    client.delete(f'throttle-level:{key}')
+
+
+class HostSlots:
+    """
+    Weighted distributed semaphore on `hostsem:{key}`: a holder takes `weight` slots out of
+    `limit` (default HOST_LIMITS[key]). Each slot is a sorted-set member scored by its lease expiry; expired
+    leases are ignored and swept, so `renew()` has to be called while the slots are in use.
+    """
+
+    def __init__(self, client, key: str, weight: int = 1, limit: Optional[int] = None):
+        self.client = client
+        self.key = key
+        self.limit = limit or HOST_LIMITS.get(key, HOST_LIMITS['default'])
+        self.weight = max(1, min(weight, self.limit))
+        token = uuid.uuid4().hex
+        self.members = [f'{token}:{i}' for i in range(self.weight)]
+        self.held = False
+        self._renewed = 0.0
+
+    def _try_acquire(self):
+        sem = f'hostsem:{self.key}'
+        now = time.time()
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(sem)
+                in_use = pipe.zcount(sem, now, '+inf')
+                if in_use + self.weight > self.limit:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.zremrangebyscore(sem, '-inf', now)
+                pipe.zadd(sem, {member: now + HOST_SLOT_TTL for member in self.members})
+                pipe.expire(sem, HOST_SLOT_TTL * 2)
+                pipe.execute()
+            except WatchError:
+                return False
+        self.held = True
+        self._renewed = now
+        return True
+
+    def acquire(self, timeout: float = HOST_WAIT_TIMEOUT, on_wait=None) -> bool:
+        """Wait out any backoff on the key, then take the slots. Returns False on timeout.
+        `on_wait(reason)` is called once when the caller has to wait."""
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            pause = backoff_remaining(self.client, self.key)
+            if not pause and self._try_acquire():
+                return True
+            if not waited and on_wait is not None:
+                on_wait('backoff' if pause else 'host_limit')
+            waited = True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(min(max(pause, HOST_POLL_INTERVAL), max(0.0, deadline - time.monotonic())) * random.uniform(0.9, 1.1))
+
+    def renew(self):
+        """Extend the lease; cheap to call often, it only writes every HOST_SLOT_TTL / 3 seconds."""
+        now = time.time()
+        if not self.held or now - self._renewed < HOST_SLOT_TTL / 3:
+            return
+        self._renewed = now
+        pipe = self.client.pipeline()
+        pipe.zadd(f'hostsem:{self.key}', {member: now + HOST_SLOT_TTL for member in self.members})
+        pipe.expire(f'hostsem:{self.key}', HOST_SLOT_TTL * 2)
+        pipe.execute()
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.client.zrem(f'hostsem:{self.key}', *self.members)
+
@@ -0,0 +1,103 @@
+"""
+Job state in Redis, and the connection pool shared by every module of a process.
+
+Per job:
+  job:{job_id}   hash  status, progress (JSON payload of the latest update), result (final file path),
+                       fetched (bytes downloaded by all attempts of the job, see `resume`),
+                       cancel (set while a cancellation is requested, see `cancel`)
+Every write goes through a pipeline that also refreshes the key's TTL, so the state of a job
+expires JOB_STATE_TTL seconds after its last update instead of staying in Redis forever.
+"""
+import os
+import json
+from typing import Iterable, List, Optional
+import redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+JOB_STATE_TTL = int(os.getenv('JOB_STATE_TTL', str(24 * 60 * 60)))
+# Max ids per `read_many` call from the web API
+JOB_STATUS_MAX_IDS = int(os.getenv('JOB_STATUS_MAX_IDS', '500'))
+# Statuses after which a job's state no longer changes
+FINAL_STATUSES = ('finished', 'error', 'cancelled')
+
+# One pool per process; redis-py notices a fork and opens fresh connections in the child
+pool = redis.ConnectionPool.from_url(REDIS_URL)
+client = redis.Redis(connection_pool=pool)
+
+
+def _key(job_id):
+    return f'job:{job_id}'
+
+
+def stage(pipe, job_id, payload=None, result=None):
+    """Queue a write of the progress `payload` and/or the `result` path of `job_id` on `pipe`."""
+    fields = {}
+    if payload is not None:
+        fields['status'] = payload.get('status', '')
+        fields['progress'] = json.dumps(payload)
+    if result is not None:
+        fields['result'] = result
+    pipe.hset(_key(job_id), mapping=fields)
+    pipe.expire(_key(job_id), JOB_STATE_TTL)
+
+
+def write(job_id, payload=None, result=None, conn=None):
+    """Store the progress `payload` and/or `result` path of `job_id` in one round trip."""
+    pipe = (conn or client).pipeline(transaction=False)
+    stage(pipe, job_id, payload, result)
+    pipe.execute()
+
+
+def _decode(raw_progress, raw_result):
+    if raw_progress is None and raw_result is None:
+        return None
+    state = json.loads(raw_progress) if raw_progress else {}
+    state['result'] = raw_result.decode('utf-8') if raw_result else None
+    return state
+
+
+def read(job_id, conn=None) -> Optional[dict]:
+    """The latest progress payload of `job_id` plus its `result` path (or None); None if unknown."""
+    return _decode(*(conn or client).hmget(_key(job_id), 'progress', 'result'))
+
+
+def read_many(job_ids: Iterable[str], conn=None) -> List[Optional[dict]]:
+    """`read` for many jobs in one round trip, in the order of `job_ids`."""
+    job_ids = list(job_ids)
+    if not job_ids:
+        return []
+    pipe = (conn or client).pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.hmget(_key(job_id), 'progress', 'result')
+    return [_decode(*raw) for raw in pipe.execute()]
+
+
+def status(job_id, conn=None) -> Optional[str]:
+    """Just the status of `job_id`, without decoding its payload."""
+    raw = (conn or client).hget(_key(job_id), 'status')
+    return raw.decode('utf-8') if raw else None
+
+
+def add_fetched(job_id, amount: int, conn=None):
+    """Add `amount` bytes to what the attempts of `job_id` downloaded."""
+    (conn or client).hincrby(_key(job_id), 'fetched', amount)
+
+
+def fetched(job_id, conn=None) -> int:
+    """Bytes downloaded by all attempts of `job_id` so far."""
+    return int((conn or client).hget(_key(job_id), 'fetched') or 0)
+
+
+def request_cancel(job_id, conn=None):
+    """Flag `job_id` for cancellation; the download polls the flag (see `cancel.Watch`)."""
+    pipe = (conn or client).pipeline(transaction=False)
+    pipe.hset(_key(job_id), 'cancel', 1)
+    pipe.expire(_key(job_id), JOB_STATE_TTL)
+    pipe.execute()
+
+
+def cancel_requested(job_id, conn=None) -> bool:
+    return bool((conn or client).hexists(_key(job_id), 'cancel'))
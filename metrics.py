@@ -0,0 +1,158 @@
+"""
+Prometheus metrics for the web tier, the RQ workers and the queue.
+
+Metrics are plain `prometheus_client` objects. With PROMETHEUS_MULTIPROC_DIR set in the
+environment (before any process starts), every gunicorn and worker process writes its values
+to files in that directory and `/metrics` aggregates all of them; the directory must be shared
+by the web and worker containers. Without it, `/metrics` only shows the serving process.
+Queue depth and worker states are read from Redis when `/metrics` is scraped.
+"""
+import os
+import time
+import socket
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess, values
+from prometheus_client.core import GaugeMetricFamily
+import hostlimit
+
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+_HOST = socket.gethostname()
+
+
+def _process_id(pid=None):
+    # containers sharing the directory reuse the same PIDs, so files are keyed by host and PID
+    return f'{_HOST}-{os.getpid() if pid is None else pid}'
+
+
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    values.ValueClass = values.MultiProcessValue(_process_id)
+
+# Download phases run from seconds to hours
+PHASE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 10800)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600)
+
+# schedule_wait (fair scheduler) -> queue_wait (RQ) -> extract -> download -> postprocess
+# (yt-dlp merge) -> transcode (audio pipeline) -> transfer (response body, served from Python)
+PHASE_SECONDS = Histogram('mediadl_phase_seconds', 'Time spent in each phase of a download', ['phase', 'kind'], buckets=PHASE_BUCKETS)
+DOWNLOAD_SECONDS = Histogram('mediadl_download_seconds', 'End-to-end time of download_media', ['kind', 'outcome'], buckets=PHASE_BUCKETS)
+DOWNLOADED_BYTES = Counter('mediadl_downloaded_bytes', 'Bytes fetched from sources', ['extractor'])
+# throughput per extractor: rate(mediadl_downloaded_bytes_total) / rate(mediadl_network_seconds_total)
+NETWORK_SECONDS = Counter('mediadl_network_seconds', 'Seconds spent in the network download phase', ['extractor'])
+SERVED_BYTES = Counter('mediadl_served_bytes', 'Bytes of finished files sent to clients', ['mode'])
+CACHE_LOOKUPS = Counter('mediadl_cache_lookups', 'Result and metadata cache lookups', ['cache', 'result'])
+FAILURES = Counter('mediadl_failures', 'Failed downloads by reason', ['reason'])
+JOBS = Counter('mediadl_jobs', 'Finished RQ jobs by outcome', ['outcome'])
+ADMISSIONS = Counter('mediadl_admissions', 'Admission decisions for new downloads', ['decision'])
+IN_PROGRESS = Gauge('mediadl_downloads_in_progress', 'Downloads running right now', multiprocess_mode='livesum')
+REQUEST_SECONDS = Histogram('mediadl_http_request_seconds', 'Handler latency of HTTP requests', ['endpoint', 'method', 'status'], buckets=REQUEST_BUCKETS)
+
+
+class PhaseTimer:
+    """Times the consecutive phases of one download: `enter(phase)` closes the current phase
+    and starts the next one, `close()` ends the last. Seconds per phase are kept in `spent`."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.phase = None
+        self.started = 0.0
+        self.spent = {}
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        if self.phase is not None:
+            seconds = now - self.started
+            PHASE_SECONDS.labels(self.phase, self.kind).observe(seconds)
+            self.spent[self.phase] = self.spent.get(self.phase, 0.0) + seconds
+        self.phase, self.started = phase, now
+
+    def close(self):
+        self.enter(None)
+
+
+def observe_phase(phase, kind, seconds):
+    PHASE_SECONDS.labels(phase, kind).observe(max(seconds, 0.0))
+
+
+def observe_job(job, failed=False, exc_type=None):
+    """Record an RQ job's time in the queue and its outcome; called from the job callbacks."""
+    if job.enqueued_at and job.started_at:
+        kind = job.args[1] if len(job.args) > 1 else 'video'
+        observe_phase('queue_wait', kind, (job.started_at - job.enqueued_at).total_seconds())
+    if not failed:
+        JOBS.labels('finished').inc()
+        return
+    from rq.timeouts import JobTimeoutException
+    from cancel import Cancelled
+    if exc_type is not None and issubclass(exc_type, Cancelled):
+        JOBS.labels('cancelled').inc()
+        return
+    JOBS.labels('timeout' if exc_type is not None and issubclass(exc_type, JobTimeoutException) else 'failed').inc()
+
+
+def failure_reason(exc) -> str:
+    """'timeout' (RQ job timeout), 'throttled' (429/503) or 'error' for a failed download;
+    looks through the chain since the downloader wraps yt-dlp's exceptions."""
+    from rq.timeouts import JobTimeoutException
+    if hostlimit.is_throttle_error(exc):
+        return 'throttled'
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, JobTimeoutException):
+            return 'timeout'
+        exc = exc.__cause__ or exc.__context__
+    return 'error'
+
+
+class QueueCollector:
+    """Scheduler/RQ queue depth and worker states, read from Redis at scrape time."""
+
+    def describe(self):
+        # keeps the registry from calling collect() (and Redis) when registering
+        return []
+
+    def collect(self):
+        from rq import Worker
+        import scheduler
+        depth = GaugeMetricFamily('mediadl_queue_depth', 'Jobs per lane: pending in the scheduler, queued in RQ, started, retrying', labels=['lane', 'state'])
+        workers = GaugeMetricFamily('mediadl_workers', 'RQ workers by state', labels=['state'])
+        utilization = GaugeMetricFamily('mediadl_worker_utilization', 'Share of RQ workers busy with a job')
+        try:
+            for lane, stats in scheduler.lane_stats().items():
+                for state in ('pending', 'queued', 'started', 'retrying'):
+                    depth.add_metric([lane, state], stats[state])
+            states = {}
+            for worker in Worker.all(connection=scheduler.redis_conn):
+                state = worker.get_state()
+                states[state] = states.get(state, 0) + 1
+        except Exception as e:
+            print(f'[WARN] Queue metrics unavailable: {e}', flush=True)
+            return
+        for state, count in states.items():
+            workers.add_metric([state], count)
+        total = sum(states.values())
+        utilization.add_metric([], states.get('busy', 0) / total if total else 0.0)
+        yield depth
+        yield workers
+        yield utilization
+
+
+_queue_collector = QueueCollector()
+if not MULTIPROC_DIR:
+    REGISTRY.register(_queue_collector)
+
+
+def render() -> bytes:
+    """Exposition text for `/metrics`, aggregated over all processes in multiprocess mode."""
+    if not MULTIPROC_DIR:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(_queue_collector)
+    return generate_latest(registry)
+
+
+def mark_process_dead(pid):
+    """Drop the live gauges of an exited process (gunicorn `child_exit`, worker pool)."""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(_process_id(pid))
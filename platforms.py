@@ -0,0 +1,81 @@
+import re
+import functools
+from typing import Optional
+from urllib.parse import urlsplit
+from yt_dlp.extractor import gen_extractor_classes, get_info_extractor
+from yt_dlp.utils import KNOWN_EXTENSIONS
+
+# Platforms offered by the form. `ie_key` selects the platform's extractors by key prefix,
+# `hosts` auto-detects it from the URL and `opts` are yt-dlp options that only apply there.
+PLATFORMS = {
+    'youtube': {
+        'ie_key': r'Youtube',
+        'hosts': ('youtube.com', 'youtu.be', 'youtube-nocookie.com'),
+        # subtitles are never written, so don't request machine translations of every track
+        'opts': {'extractor_args': {'youtube': {'skip': ['translated_subs']}}},
+    },
+    'tiktok': {'ie_key': r'TikTok', 'hosts': ('tiktok.com',)},
+    'instagram': {'ie_key': r'Instagram', 'hosts': ('instagram.com',)},
+    'vk': {'ie_key': r'VK', 'hosts': ('vk.com', 'vk.ru', 'vkvideo.ru')},
+    'soundcloud': {'ie_key': r'Soundcloud', 'hosts': ('soundcloud.com',)},
+    'pinterest': {'ie_key': r'Pinterest', 'hosts': ('pinterest.com', 'pin.it')},
+}
+
+
+@functools.lru_cache(maxsize=None)
+def extractors_for(platform: str) -> tuple:
+    """The platform's extractor classes in yt-dlp's order, followed by the generic extractor
+    for URLs they hand off without naming an extractor. Empty for unknown platforms."""
+    spec = PLATFORMS.get(platform)
+    if spec is None:
+        return ()
+    pattern = re.compile(spec['ie_key'] + r'(?![a-z])')
+    ies = [ie for ie in gen_extractor_classes() if ie._ENABLED and pattern.match(ie.ie_key())]
+    return tuple(ies) + (get_info_extractor('Generic'),)
+
+
+def detect(url: str) -> Optional[str]:
+    """Platform of `url` from its host name alone, or None."""
+    host = (urlsplit(url.strip()).hostname or '').lower()
+    for name, spec in PLATFORMS.items():
+        if any(host == h or host.endswith('.' + h) for h in spec['hosts']):
+            return name
+    return None
+
+
+def is_direct_media(url: str) -> bool:
+    """True for a plain link to a media file or manifest, which only the generic extractor handles."""
+    path = urlsplit(url.strip()).path
+    return '.' in path.rsplit('/', 1)[-1] and path.rsplit('.', 1)[-1].lower() in KNOWN_EXTENSIONS
+
+
+def suitable_extractor(url: str, extractors) -> Optional[type]:
+    """First non-generic extractor in `extractors` that accepts `url`."""
+    for ie in extractors:
+        if ie.ie_key() != 'Generic' and ie.suitable(url):
+            return ie
+    return None
+
+
+def resolve(url: str, platform: Optional[str] = 'auto') -> dict:
+    """
+    Route `url` to a pre-resolved extractor set.
+
+    Returns {'platform', 'extractors', 'opts'}: `extractors` is the tuple of extractor classes
+    for the YoutubeDL (None means yt-dlp's full list) and `opts` the platform's extra options.
+    An explicit platform that does not accept the URL is treated like 'auto', so a wrong
+    choice in the form never makes a download fail.
+    """
+    name = platform if platform in PLATFORMS else None
+    if name is not None and suitable_extractor(url, extractors_for(name)) is None:
+        print(f'[WARN] {url} does not look like a {name} URL, detecting the platform instead', flush=True)
+        name = None
+    if name is None:
+        name = detect(url)
+        if name is not None and suitable_extractor(url, extractors_for(name)) is None:
+            name = None
+    if name is not None:
+        return {'platform': name, 'extractors': extractors_for(name), 'opts': dict(PLATFORMS[name].get('opts', {}))}
+    if is_direct_media(url):
+        return {'platform': 'direct', 'extractors': (get_info_extractor('Generic'),), 'opts': {'force_generic_extractor': True}}
+    return {'platform': 'other', 'extractors': None, 'opts': {}}
@@ -0,0 +1,140 @@
+import os
+import threading
+from typing import List, Optional
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import ExtractorError, format_bytes, parse_bytes
+
+# Video quality presets: the max height, or None for the best available. 'under:<size>'
+# (e.g. 'under:50M') is the best format whose estimated size fits in <size>.
+QUALITY_PRESETS = {'best': None, '1080p': 1080, '720p': 720, '480p': 480, '360p': 360}
+DEFAULT_QUALITY = os.getenv('VIDEO_QUALITY', 'best')
+
+_merger = None
+_merger_lock = threading.Lock()
+
+
+def _parse(quality):
+    quality = (quality or '').strip().lower()
+    if quality in QUALITY_PRESETS:
+        return quality
+    if quality.startswith('under:'):
+        size = parse_bytes(quality[len('under:'):].strip())
+        if size:
+            return f'under:{size}'
+    return None
+
+
+def normalize(quality: Optional[str]) -> str:
+    """'720p', 'under:50M', ... as a key of QUALITY_PRESETS or 'under:<bytes>'; anything else
+    gives DEFAULT_QUALITY."""
+    return _parse(quality) or _parse(DEFAULT_QUALITY) or 'best'
+
+
+def size_cap(quality: Optional[str], max_filesize: Optional[str]) -> Optional[int]:
+    """Size limit in bytes from `max_filesize` ('50M', ...) and a normalized 'under:' preset."""
+    caps = [parse_bytes(str(max_filesize)) if max_filesize else None]
+    if quality and quality.startswith('under:'):
+        caps.append(int(quality[len('under:'):]))
+    return min(filter(None, caps), default=None)
+
+
+def _size(fmt, seconds=None):
+    if seconds is not None and fmt.get('tbr'):
+        # a clip: its share of the bitrate; without one the whole file is a safe overestimate
+        return int(fmt['tbr'] * 1000 / 8 * seconds)
+    # yt-dlp fills filesize_approx from tbr x duration when a format has no size of its own
+    return fmt.get('filesize') or fmt.get('filesize_approx')
+
+
+def _total(formats, seconds=None):
+    sizes = [_size(f, seconds) for f in formats]
+    return None if None in sizes else sum(sizes)
+
+
+def _compatible(video, audio):
+    return (video.get('ext') in ('mp4', 'mov')) == (audio.get('ext') in ('m4a', 'mp4', 'aac'))
+
+
+def choose(formats: list, max_height: Optional[int] = None, max_bytes: Optional[int] = None,
+           seconds: Optional[float] = None) -> Optional[List[dict]]:
+    """
+    Pick the formats to download: [muxed] or [video, audio]. The highest resolution within
+    `max_height` wins; at equal height a pre-muxed file is preferred since it needs no merge.
+    With `max_bytes`, options whose estimated size is over it are dropped and options of unknown
+    size only come after those known to fit. If no option is within `max_height`, the smallest
+    resolution is taken. Media without any video format (SoundCloud, podcasts) gets its audio-only
+    formats ranked the same way. None if nothing fits in `max_bytes`. With `seconds`, sizes are estimated
+    for a clip of that length rather than the whole media.
+    `formats` are in yt-dlp's order, worst to best, which breaks the remaining ties.
+    """
+    muxed, videos, audios, audio_only = [], [], [], []
+    for position, f in enumerate(formats):
+        vcodec, acodec = f.get('vcodec'), f.get('acodec')
+        if vcodec == 'none' and acodec == 'none':
+            continue  # storyboards and the like
+        if vcodec != 'none' and acodec != 'none':
+            muxed.append((position, [f]))
+        elif acodec == 'none':
+            videos.append((position, f))
+        else:
+            audios.append(f)
+            audio_only.append((position, [f]))
+
+    # without a video format the audio is the media; a video with a merged audio is ranked otherwise
+    options = list(muxed) if muxed or videos else audio_only
+    for position, video in videos:
+        # best audio that still fits, in the video's container family if there is one
+        for audio in sorted(reversed(audios), key=lambda a: not _compatible(video, a)):
+            total = _total([video, audio], seconds)
+            if max_bytes is None or total is None or total <= max_bytes:
+                options.append((position, [video, audio]))
+                break
+
+    # (known to fit, height, pre-muxed, position) -> formats
+    ranked = []
+    for position, chosen in options:
+        total = _total(chosen, seconds)
+        if max_bytes is not None and total is not None and total > max_bytes:
+            continue
+        height = max(f.get('height') or 0 for f in chosen)
+        ranked.append(((max_bytes is None or total is not None, height, len(chosen) == 1, position), chosen))
+    if not ranked:
+        return None
+    within = [option for option in ranked if not max_height or option[0][1] <= max_height]
+    if within:
+        return max(within, key=lambda option: option[0])[1]
+    return min(ranked, key=lambda option: (not option[0][0], option[0][1], not option[0][2], -option[0][3]))[1]
+
+
+def _merge_selector(spec):
+    # yt-dlp builds the merged format entry; a bare instance without extractors is enough
+    global _merger
+    with _merger_lock:
+        if _merger is None:
+            _merger = YoutubeDL({'quiet': True}, auto_init=False)
+        return _merger.build_format_selector(spec)
+
+
+class FormatSelector:
+    """yt-dlp `format` callable for a quality preset and `max_filesize`, resolved by `choose`
+    before any byte is downloaded. `seconds` is the length of a clip, if only one is downloaded."""
+
+    def __init__(self, quality: Optional[str] = None, max_filesize: Optional[str] = None,
+                 seconds: Optional[float] = None):
+        self.quality = normalize(quality)
+        self.seconds = seconds
+        self.max_bytes = size_cap(self.quality, max_filesize)
+        self.max_height = QUALITY_PRESETS.get(self.quality)
+
+    def __call__(self, ctx):
+        chosen = choose(ctx['formats'], self.max_height, self.max_bytes, self.seconds)
+        if chosen is None and self.max_bytes is None:
+            # nothing to rank (no formats with codec information): yt-dlp's own pick, as before presets
+            yield from _merge_selector('best')(ctx)
+            return
+        if chosen is None:
+            raise ExtractorError(f'No format of this media fits in {format_bytes(self.max_bytes)}', expected=True)
+        if len(chosen) == 1:
+            yield chosen[0]
+            return
+        yield from _merge_selector('+'.join(f['format_id'] for f in chosen))(ctx)
@@ -0,0 +1,64 @@
+import os
+import json
+import time
+import jobstore
+
+# At most one progress write per job per interval (seconds)
+PROGRESS_MIN_INTERVAL = float(os.getenv('PROGRESS_MIN_INTERVAL', '0.5'))
+# Skip updates that moved less than this many percent points...
+PROGRESS_MIN_DELTA = float(os.getenv('PROGRESS_MIN_DELTA', '1'))
+# ...unless nothing was written for this long (keeps byte counts fresh when the total is unknown)
+PROGRESS_MAX_INTERVAL = float(os.getenv('PROGRESS_MAX_INTERVAL', '5'))
+
+
+def channel(job_id):
+    """Pub/sub channel carrying progress payloads for `job_id`."""
+    return f'progress-events:{job_id}'
+
+
+def publish(client, job_id, payload, result=None):
+    """Store `payload` as the job's latest progress (and `result` as its file, if given) and
+    publish it to watchers in one round trip."""
+    pipe = client.pipeline(transaction=False)
+    jobstore.stage(pipe, job_id, payload, result)
+    pipe.publish(channel(job_id), json.dumps(payload))
+    pipe.execute()
+
+
+class ProgressReporter:
+    """Coalesces yt-dlp progress callbacks, which can fire dozens of times per second,
+    into at most one `publish` per PROGRESS_MIN_INTERVAL or PROGRESS_MIN_DELTA step.
+    Status changes are always published."""
+
+    def __init__(self, client, job_id, min_interval=PROGRESS_MIN_INTERVAL, min_delta=PROGRESS_MIN_DELTA, max_interval=PROGRESS_MAX_INTERVAL):
+        self.client = client
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self.max_interval = max_interval
+        self._last_time = 0.0
+        self._last_status = None
+        self._last_percent = None
+
+    def _should_publish(self, payload, now):
+        if payload.get('status') != self._last_status:
+            return True
+        elapsed = now - self._last_time
+        if elapsed < self.min_interval:
+            return False
+        percent = payload.get('percent')
+        if percent is not None and self._last_percent is not None and abs(percent - self._last_percent) < self.min_delta:
+            return elapsed >= self.max_interval
+        return True
+
+    def update(self, payload, force=False):
+        now = time.monotonic()
+        if not force and not self._should_publish(payload, now):
+            return
+        try:
+            publish(self.client, self.job_id, payload)
+        except Exception:
+            return
+        self._last_time = now
+        self._last_status = payload.get('status')
+        self._last_percent = payload.get('percent')
@@ -0,0 +1,150 @@
+import os
+import time
+import hashlib
+from yt_dlp.utils import parse_bytes
+
+# Byte budget for finished files in DOWNLOAD_DIR, e.g. '20G'; empty or 0 disables the budget
+DISK_QUOTA = parse_bytes(os.getenv('DISK_QUOTA', '10G') or '0') or 0
+# Files not served for this many seconds are evicted regardless of the budget; 0 disables
+DOWNLOAD_TTL = int(os.getenv('DOWNLOAD_TTL', str(6 * 60 * 60)))
+# Upper bound for a pin whose holder died without unpinning
+PIN_TTL = int(os.getenv('QUOTA_PIN_TTL', str(6 * 60 * 60)))
+# Newly registered files are protected for this long so the caller can pin or serve them
+GRACE_SECONDS = int(os.getenv('QUOTA_GRACE_SECONDS', '120'))
+EVICT_BATCH = 50
+
+# Index kept in Redis so eviction never walks the download directory:
+#   quota:lru    sorted set  path -> last served timestamp
+#   quota:sizes  hash        path -> size in bytes
+#   quota:bytes  integer     total bytes of indexed files
+_LRU = 'quota:lru'
+_SIZES = 'quota:sizes'
+_BYTES = 'quota:bytes'
+_LOCK = 'quota:lock'
+
+
+def _path_id(path):
+    return hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+
+
+def pin(client, path):
+    """Mark `path` as in use so it is not evicted until `unpin` (or PIN_TTL)."""
+    key = f'quota:pin:{_path_id(path)}'
+    pipe = client.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, PIN_TTL)
+    pipe.execute()
+
+
+def unpin(client, path):
+    key = f'quota:pin:{_path_id(path)}'
+    if client.decr(key) <= 0:
+        client.delete(key)
+
+
+def is_pinned(client, path):
+    path_id = _path_id(path)
+    pinned, grace = client.mget(f'quota:pin:{path_id}', f'quota:grace:{path_id}')
+    return bool(grace) or int(pinned or 0) > 0
+
+
+def touch(client, path):
+    """Record that `path` was just served or reused."""
+    client.zadd(_LRU, {os.path.abspath(path): time.time()}, xx=True)
+
+
+def register(client, path):
+    """Add a finished file to the index and evict older files if the budget is exceeded."""
+    path = os.path.abspath(path)
+    size = os.path.getsize(path)
+    previous = client.hget(_SIZES, path)
+    pipe = client.pipeline()
+    pipe.set(f'quota:grace:{_path_id(path)}', 1, ex=GRACE_SECONDS)
+    pipe.hset(_SIZES, path, size)
+    pipe.zadd(_LRU, {path: time.time()})
+    pipe.incrby(_BYTES, size - int(previous or 0))
+    pipe.execute()
+    enforce(client)
+
+
+def _evict(client, path):
+    size = client.hget(_SIZES, path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f'[WARN] Could not evict {path}: {e}', flush=True)
+        return False
+    try:
+        # a per-job result directory goes with its last file; non-empty directories stay
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+    pipe = client.pipeline()
+    pipe.zrem(_LRU, path)
+    pipe.hdel(_SIZES, path)
+    pipe.decrby(_BYTES, int(size or 0))
+    pipe.execute()
+    print(f'[INFO] Evicted {path}', flush=True)
+    return True
+
+
+def enforce(client):
+    """Evict expired files, then least-recently-served files until usage fits the budget.
+    Pinned files are skipped. Only one process evicts at a time."""
+    if not client.set(_LOCK, 1, nx=True, ex=60):
+        return
+    try:
+        if DOWNLOAD_TTL:
+            expired = client.zrangebyscore(_LRU, '-inf', time.time() - DOWNLOAD_TTL)
+            for raw in expired:
+                path = raw.decode('utf-8')
+                if not is_pinned(client, path):
+                    _evict(client, path)
+        if not DISK_QUOTA:
+            return
+        start = 0
+        while int(client.get(_BYTES) or 0) > DISK_QUOTA:
+            candidates = client.zrange(_LRU, start, start + EVICT_BATCH - 1)
+            if not candidates:
+                print('[WARN] Disk quota exceeded but every file is pinned', flush=True)
+                break
+            for raw in candidates:
+                path = raw.decode('utf-8')
+                if is_pinned(client, path) or not _evict(client, path):
+                    start += 1
+                if int(client.get(_BYTES) or 0) <= DISK_QUOTA:
+                    break
+    finally:
+        client.delete(_LOCK)
+
+
+def _files(directory):
+    """Finished files in `directory` and its per-job subdirectories; dot entries (workspaces,
+    partial files) and cookie files are skipped."""
+    for entry in os.scandir(directory):
+        if entry.name.startswith(('cookies-', '.')):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from (sub for sub in os.scandir(entry.path) if sub.is_file() and not sub.name.startswith('.'))
+        elif entry.is_file():
+            yield entry
+
+
+def rebuild(client, directory):
+    """Rebuild the index from `directory` with a single scan. Runs once per Redis instance
+    (guarded by `quota:initialized`) so files from before the index existed are accounted for."""
+    if not client.set('quota:initialized', 1, nx=True):
+        return
+    pipe = client.pipeline()
+    pipe.delete(_LRU, _SIZES, _BYTES)
+    total = 0
+    for entry in _files(directory):
+        st = entry.stat()
+        path = os.path.abspath(entry.path)
+        pipe.hset(_SIZES, path, st.st_size)
+        pipe.zadd(_LRU, {path: st.st_mtime})
+        total += st.st_size
+    pipe.set(_BYTES, total)
+    pipe.execute()
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from typing import Callable, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+from redis.exceptions import WatchError
+from yt_dlp.extractor import gen_extractor_classes
+import platforms
+import storage
+
+# How long a finished file stays addressable through the cache
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', str(24 * 60 * 60)))
+# Lifetime of the single-flight lock; the holder renews it every third of that while it downloads,
+# so downloads may run as long as their job timeout and a crashed worker's lock soon expires
+RESULT_CACHE_LOCK_TTL = int(os.getenv('RESULT_CACHE_LOCK_TTL', str(5 * 60)))
+# How long identical requests wait for the lock holder before downloading on their own
+RESULT_CACHE_WAIT_TIMEOUT = int(os.getenv('RESULT_CACHE_WAIT_TIMEOUT', str(60 * 60)))
+RESULT_CACHE_POLL_INTERVAL = 0.5
+
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def resolve_extractor(url: str) -> Tuple[str, Optional[str]]:
+    """Return (extractor key, media id) for `url` using only the extractors' URL patterns.
+    The media id is None when the URL is only matched by the generic extractor.
+    URLs of a known platform are matched against that platform's extractors only."""
+    platform = platforms.detect(url)
+    ie = platforms.suitable_extractor(url, platforms.extractors_for(platform)) if platform else None
+    if ie is not None:
+        try:
+            return ie.ie_key(), ie.get_temp_id(url)
+        except Exception:
+            return ie.ie_key(), None
+    for ie in gen_extractor_classes():
+        if ie.suitable(url):
+            ie_key = ie.ie_key()
+            if ie_key == 'Generic':
+                return ie_key, None
+            try:
+                return ie_key, ie.get_temp_id(url)
+            except Exception:
+                return ie_key, None
+    return 'Generic', None
+
+
+def _normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+
+def media_identity(url: str) -> list:
+    """[extractor, media id] for `url`; the normalized URL stands in for a missing id."""
+    ie_key, media_id = resolve_extractor(url)
+    return [ie_key, media_id or _normalize_url(url)]
+
+
+def cache_key(url: str, kind: str, fmt: str, max_filesize: Optional[str]) -> str:
+    """Key identifying a finished file: (extractor, media id, kind, format, max_filesize)."""
+    identity = media_identity(url) + [kind, fmt, str(max_filesize or '')]
+    return hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()
+
+
+def lookup(client, key: str) -> Optional[str]:
+    """Return the cached result (a `storage` reference) for `key`, dropping entries whose file is gone."""
+    path = client.get(f'cache:{key}')
+    if not path:
+        return None
+    path = path.decode('utf-8')
+    if storage.exists(path):
+        return path
+    client.delete(f'cache:{key}')
+    return None
+
+
+def store(client, key: str, path: str):
+    client.set(f'cache:{key}', path, ex=RESULT_CACHE_TTL)
+
+
+def _renew_lock(client, lock_key: str, token: str) -> bool:
+    """Reset the expiry of `lock_key` if `token` still holds it; False once the lock is lost."""
+    with client.pipeline() as pipe:
+        try:
+            pipe.watch(lock_key)
+            if pipe.get(lock_key) != token.encode('utf-8'):
+                return False
+            pipe.multi()
+            pipe.expire(lock_key, RESULT_CACHE_LOCK_TTL)
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
+
+
+def _keep_lock(client, lock_key: str, token: str, stopped: threading.Event):
+    while not stopped.wait(RESULT_CACHE_LOCK_TTL / 3):
+        try:
+            if not _renew_lock(client, lock_key, token):
+                print(f'[WARN] Lost cache lock {lock_key}', flush=True)
+                return
+        except Exception:
+            # Redis hiccup: try again at the next interval, the lock is still good until then
+            continue
+
+
+def get_or_create(client, key: str, produce: Callable[[], str]) -> Tuple[str, bool]:
+    """Return (path, cache_hit) for `key`, calling `produce()` at most once across all processes.
+
+    The first caller takes the `cache-lock:{key}` lock and runs `produce()`, renewing the lock
+    in a daemon thread until it returns; concurrent callers wait for its result. If the lock holder fails, a waiter takes over the lock and retries.
+    Redis errors fall back to an uncoordinated `produce()`.
+    """
+    lock_key = f'cache-lock:{key}'
+    token = str(uuid.uuid4())
+    deadline = time.monotonic() + RESULT_CACHE_WAIT_TIMEOUT
+    try:
+        while True:
+            path = lookup(client, key)
+            if path:
+                return path, True
+            if client.set(lock_key, token, nx=True, ex=RESULT_CACHE_LOCK_TTL):
+                break
+            if time.monotonic() > deadline:
+                print(f'[WARN] Timed out waiting for cache lock {key}, downloading anyway', flush=True)
+                token = None
+                break
+            time.sleep(RESULT_CACHE_POLL_INTERVAL)
+    except Exception as e:
+        print(f'[WARN] Result cache unavailable: {e}', flush=True)
+        token = None
+
+    if token is None:
+        return produce(), False
+
+    stopped = threading.Event()
+    threading.Thread(target=_keep_lock, args=(client, lock_key, token, stopped),
+                     name=f'cache-lock-{key[:12]}', daemon=True).start()
+    try:
+        path = produce()
+        try:
+            store(client, key, path)
+        except Exception:
+            pass
+        return path, False
+    finally:
+        stopped.set()
+        try:
+            client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except Exception:
+            pass
@@ -0,0 +1,115 @@
+"""
+Crash-resumable downloads: what a retried job may reuse from the attempts before it.
+
+A failed attempt that RQ will retry keeps its workspace (`downloads/.work/{job_id}`), so the next
+attempt's yt-dlp finds the `.part` files (continued with HTTP Range requests) and the fragment
+files with their `.ytdl` state and carries on where the previous attempt stopped.
+
+Every attempt adds the bytes it downloads to the job's `fetched` field in `jobstore`.
+Whatever was fetched but is no longer in the workspace (a server without Range support, a lost
+workspace, a worker on another machine) has to be fetched again. Once that exceeds
+RETRY_REFETCH_LIMIT the job is not retried any more.
+"""
+import os
+import socket
+import threading
+from typing import Dict
+from yt_dlp.utils import ContentTooShortError, DownloadCancelled, parse_bytes
+from yt_dlp.networking.exceptions import HTTPError, TransportError
+from redis.exceptions import RedisError
+import hostlimit
+import jobstore
+
+# Bytes a job may download more than once across its attempts before it stops retrying
+RETRY_REFETCH_LIMIT = parse_bytes(os.getenv('RETRY_REFETCH_LIMIT', '1G')) or 0
+# Bytes counted locally before they are added to the job's `fetched` total (lost if the worker dies)
+FLUSH_BYTES = 2 * 1024 * 1024
+
+
+def workspace_sizes(workdir: str) -> Dict[str, int]:
+    """Size of every file left in `workdir`, by path."""
+    sizes = {}
+    for root, _, files in os.walk(workdir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                pass
+    return sizes
+
+
+def refetched(client, job_id: str, workdir: str) -> int:
+    """Bytes earlier attempts of `job_id` fetched that are no longer in its workspace."""
+    try:
+        total = jobstore.fetched(job_id, conn=client)
+    except RedisError:
+        return 0
+    return max(total - sum(workspace_sizes(workdir).values()), 0)
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Whether an attempt that failed with `exc` is worth retrying: network errors, server errors,
+    throttling, the RQ job timeout and workers shut down mid-job. Extraction errors, size limits
+    and the like would fail the same way again, and a cancelled job is not run again."""
+    from rq.timeouts import JobTimeoutException
+    if isinstance(exc, DownloadCancelled):
+        # whatever error the cancellation caused on its way out
+        return False
+    if hostlimit.is_throttle_error(exc):
+        return True
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, HTTPError):
+            return exc.status >= 500
+        if isinstance(exc, (JobTimeoutException, SystemExit, TransportError, ContentTooShortError,
+                            ConnectionError, TimeoutError, socket.timeout)):
+            return True
+        exc_info = getattr(exc, 'exc_info', None)
+        exc = (exc_info[1] if exc_info else None) or exc.__cause__ or exc.__context__
+    return False
+
+
+class Tracker:
+    """yt-dlp progress hook adding the bytes an attempt downloads to the job's `fetched` total.
+    `downloaded_bytes` starts at the resumed size of a `.part` file, so only growth past the
+    size the file had when the attempt started counts, or everything if its first report is
+    below that size (the server made it start over). Parallel fragments report slightly out of
+    order, so later dips are ignored."""
+
+    def __init__(self, client, job_id, workdir):
+        self.client = client
+        self.job_id = job_id
+        self._seen = workspace_sizes(workdir)
+        self._reported = set()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def hook(self, d):
+        if d.get('status') != 'downloading':
+            return
+        name = d.get('tmpfilename') or d.get('filename')
+        downloaded = d.get('downloaded_bytes') or 0
+        with self._lock:
+            last = self._seen.get(name, 0)
+            if name not in self._reported:
+                self._reported.add(name)
+                if downloaded < last:
+                    last = 0
+            if downloaded > last:
+                self._pending += downloaded - last
+                self._seen[name] = downloaded
+            if self._pending < FLUSH_BYTES:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            amount, self._pending = self._pending, 0
+        if amount <= 0 or self.client is None:
+            return
+        try:
+            jobstore.add_fetched(self.job_id, amount, conn=self.client)
+        except RedisError:
+            pass
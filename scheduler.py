@@ -0,0 +1,309 @@
+import os
+import json
+import uuid
+import time
+import shutil
+import hashlib
+from typing import Optional, Tuple
+from redis.exceptions import WatchError
+from rq.exceptions import InvalidJobOperation, NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.registry import ScheduledJobRegistry, StartedJobRegistry
+import progress
+import metrics
+import jobstore
+import presets
+import clips
+import admission
+from downloader import WORK_DIR, peek_info, estimate_filesize
+from tasks import redis_conn, get_queue, enqueue_download
+
+# Lanes in priority order; workers listen on the RQ queues in this order.
+LANE_QUEUES = {
+    'fast': 'downloads-fast',
+    'standard': 'downloads',
+    'bulk': 'downloads-bulk',
+}
+LANE_TIMEOUTS = {'fast': 15 * 60, 'standard': 60 * 60, 'bulk': 3 * 60 * 60}
+
+
+def _parse_limits(value):
+    limits = {'fast': 4, 'standard': 4, 'bulk': 2}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        lane, _, limit = item.partition('=')
+        if lane in limits and limit.isdigit():
+            limits[lane] = int(limit)
+    return limits
+
+
+# Max jobs per lane handed to RQ (queued + running), e.g. 'fast=8,standard=4,bulk=1'
+LANE_LIMITS = _parse_limits(os.getenv('LANE_LIMITS', ''))
+# Deficit round-robin quantum, in cost units (one unit is roughly 10 MB of media)
+SCHED_QUANTUM = float(os.getenv('SCHED_QUANTUM', '5'))
+COST_UNIT_BYTES = 10 * 1024 * 1024
+# Lane thresholds on predicted size (bytes) and duration (seconds)
+FAST_MAX_BYTES, FAST_MAX_DURATION = 50 * 1024 * 1024, 10 * 60
+BULK_MIN_BYTES, BULK_MIN_DURATION = 500 * 1024 * 1024, 60 * 60
+# Proxies in front of the app that add the address they were reached from to X-Forwarded-For
+# (the compose nginx, the Heroku router, a load balancer); 0 uses the connection's peer
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '0'))
+
+# Per lane:
+#   sched:{lane}:ring              list of clients with pending jobs, in round-robin order
+#   sched:{lane}:active            set of the same clients (membership test)
+#   sched:{lane}:pending:{client}  list of job payloads waiting for a slot, FIFO per client
+#   sched:{lane}:deficit           hash client -> DRR deficit counter
+_LOCK = 'sched:lock'
+_DIRTY = 'sched:dirty'
+
+
+def client_address(forwarded_for: Optional[str], peer: Optional[str]) -> Optional[str]:
+    """The client's address as werkzeug's ProxyFix finds it: the X-Forwarded-For entry added by
+    the outermost of TRUSTED_PROXIES proxies. Entries left of it come from the client and can be
+    anything; without trusted proxies, or fewer entries than proxies, the connection's peer."""
+    if TRUSTED_PROXIES:
+        hops = [addr.strip() for addr in (forwarded_for or '').split(',') if addr.strip()]
+        if len(hops) >= TRUSTED_PROXIES:
+            return hops[-TRUSTED_PROXIES]
+    return peer
+
+
+def client_id_for(api_token: Optional[str], remote_addr: Optional[str]) -> str:
+    """Fairness key for a request: the API token if one is sent, otherwise the client IP."""
+    if api_token:
+        return 'token:' + hashlib.sha1(api_token.encode('utf-8')).hexdigest()[:16]
+    return f'ip:{remote_addr or "unknown"}'
+
+
+def predict_cost(url: str, kind: str, quality: str = None, section: Optional[clips.Section] = None) -> Tuple[str, float]:
+    """Return (lane, cost) for a job from already-cached metadata; never extracts.
+    Video is sized by the formats its `quality` preset picks; a clip (`section`) by its share of the media.
+    Without metadata, audio is assumed short and video medium-sized."""
+    info = peek_info(url)
+    if info is None:
+        return ('fast', 1.0) if kind == 'audio' else ('standard', 3.0)
+    duration = info.get('duration') or 0
+    if kind == 'audio':
+        # ~192 kbit/s after conversion
+        size = duration * 24 * 1024 if duration else COST_UNIT_BYTES
+    else:
+        selector = presets.FormatSelector(quality)
+        chosen = presets.choose(info.get('formats') or [], selector.max_height, selector.max_bytes)
+        size = sum(estimate_filesize(f, duration) or 0 for f in chosen) if chosen else None
+        size = size or estimate_filesize(info, duration)
+        if size is None:
+            size = sum(estimate_filesize(f, duration) or 0 for f in info.get('requested_formats') or []) or 3 * COST_UNIT_BYTES
+    if section is not None and duration:
+        seconds = clips.length(section, duration)
+        size, duration = size * seconds / duration, seconds
+    cost = max(1.0, size / COST_UNIT_BYTES)
+    if size <= FAST_MAX_BYTES and duration <= FAST_MAX_DURATION:
+        return 'fast', cost
+    if size >= BULK_MIN_BYTES or duration >= BULK_MIN_DURATION:
+        return 'bulk', cost
+    return 'standard', cost
+
+
+def submit(url: str, kind: str = 'video', cookies_text: str = None, max_filesize: str = None, client_id: str = 'anonymous', job_id: str = None,
+           concurrent_fragments: int = None, meta: dict = None, platform: str = 'auto', audio_format: str = None, quality: str = None,
+           start: float = None, end: float = None, admit: bool = False) -> str:
+    """Queue a download behind the scheduler and return its job id.
+    The job waits in its client's pending list until the lane has capacity and the client's turn comes.
+    `meta` is stored on the RQ job (e.g. the batch it belongs to); `start`/`end` select a clip.
+    With `admit`, raises `admission.Rejected` instead of queuing a job the system can't take on now."""
+    if job_id is None:
+        job_id = str(uuid.uuid4())
+    lane, cost = predict_cost(url, kind, quality, clips.parse_section(start, end))
+    if admit:
+        admission.check(redis_conn, client_id, cost, job_id=job_id)
+    else:
+        admission.record(redis_conn, job_id, client_id, cost)
+    payload = json.dumps({
+        'job_id': job_id, 'url': url, 'kind': kind, 'cookies_text': cookies_text,
+        'max_filesize': max_filesize, 'concurrent_fragments': concurrent_fragments, 'meta': meta,
+        'platform': platform, 'audio_format': audio_format, 'quality': quality, 'start': start, 'end': end,
+        'cost': cost, 'submitted_at': time.time(),
+    })
+    pipe = redis_conn.pipeline()
+    pipe.rpush(f'sched:{lane}:pending:{client_id}', payload)
+    pipe.sadd(f'sched:{lane}:active', client_id)
+    _, added = pipe.execute()
+    if added:
+        redis_conn.rpush(f'sched:{lane}:ring', client_id)
+    progress.publish(redis_conn, job_id, {'status': 'queued', 'lane': lane})
+    dispatch()
+    return job_id
+
+
+def _running(lane, finishing=None):
+    # jobs waiting out a retry backoff keep their slot
+    queue = get_queue(LANE_QUEUES[lane])
+    registry = StartedJobRegistry(queue=queue)
+    started = registry.get_job_ids()
+    retrying = ScheduledJobRegistry(queue=queue).count
+    return len(queue) + retrying + len([job_id for job_id in started if job_id != finishing])
+
+
+def _dispatch_lane(lane, finishing=None):
+    capacity = LANE_LIMITS[lane] - _running(lane, finishing)
+    ring = f'sched:{lane}:ring'
+    deficits = f'sched:{lane}:deficit'
+    while capacity > 0:
+        client = redis_conn.lindex(ring, 0)
+        if client is None:
+            return
+        client = client.decode('utf-8')
+        pending = f'sched:{lane}:pending:{client}'
+        deficit = float(redis_conn.hget(deficits, client) or 0) + SCHED_QUANTUM
+        while capacity > 0:
+            head = redis_conn.lindex(pending, 0)
+            if head is None:
+                break
+            job = json.loads(head)
+            if jobstore.status(job['job_id'], conn=redis_conn) == 'cancelled':
+                # cancelled while it waited here: drop it without using the turn
+                redis_conn.lpop(pending)
+                admission.release(redis_conn, job['job_id'])
+                _advance_batch(job.get('meta'))
+                continue
+            if job['cost'] > deficit:
+                break
+            redis_conn.lpop(pending)
+            deficit -= job['cost']
+            if 'submitted_at' in job:
+                metrics.observe_phase('schedule_wait', job['kind'], time.time() - job['submitted_at'])
+            enqueue_download(job['url'], job['kind'], job['cookies_text'], job['max_filesize'], job_id=job['job_id'],
+                             queue_name=LANE_QUEUES[lane], job_timeout=LANE_TIMEOUTS[lane],
+                             on_success=on_job_success, on_failure=on_job_failure,
+                             concurrent_fragments=job.get('concurrent_fragments'), meta=job.get('meta'),
+                             platform=job.get('platform', 'auto'), audio_format=job.get('audio_format'), client_id=client,
+                             quality=job.get('quality'), start=job.get('start'), end=job.get('end'))
+            capacity -= 1
+        _end_turn(lane, client, deficit)
+
+
+def _end_turn(lane, client, deficit):
+    """Move `client` to the back of the ring, or drop it if it has nothing pending.
+    Watching the pending list keeps a concurrent `submit` from being orphaned."""
+    pending = f'sched:{lane}:pending:{client}'
+    with redis_conn.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(pending)
+                has_more = pipe.llen(pending)
+                pipe.multi()
+                pipe.lpop(f'sched:{lane}:ring')
+                if has_more:
+                    pipe.hset(f'sched:{lane}:deficit', client, deficit)
+                    pipe.rpush(f'sched:{lane}:ring', client)
+                else:
+                    pipe.hdel(f'sched:{lane}:deficit', client)
+                    pipe.srem(f'sched:{lane}:active', client)
+                pipe.execute()
+                return
+            except WatchError:
+                continue
+
+
+def dispatch(finishing: str = None):
+    """Move pending jobs into the lanes' RQ queues while capacity allows, in deficit round-robin
+    order across clients. Only one process dispatches at a time; a request that arrives while
+    another dispatch runs marks the state dirty so the running dispatcher goes around again."""
+    redis_conn.set(_DIRTY, 1)
+    while redis_conn.set(_LOCK, 1, nx=True, ex=30):
+        try:
+            redis_conn.delete(_DIRTY)
+            for lane in LANE_QUEUES:
+                _dispatch_lane(lane, finishing)
+        finally:
+            redis_conn.delete(_LOCK)
+        if not redis_conn.exists(_DIRTY):
+            break
+
+
+def _advance_batch(meta):
+    batch_id = (meta or {}).get('batch_id')
+    if batch_id:
+        import batch  # batch submits through this module
+        try:
+            batch.advance(batch_id)
+        except Exception as e:
+            print(f'[WARN] Could not advance batch {batch_id}: {e}', flush=True)
+
+
+def _job_ended(job):
+    admission.release(redis_conn, job.id)
+    _advance_batch(job.meta)
+    dispatch(finishing=job.id)
+
+
+def on_job_success(job, connection, result, *args, **kwargs):
+    # RQ callback: the job still counts as started while this runs
+    metrics.observe_job(job)
+    _job_ended(job)
+
+
+def on_job_failure(job, connection, type, value, traceback):
+    if job.retries_left:
+        # RQ runs the job again after its backoff; it keeps its lane slot until then
+        if jobstore.status(job.id, conn=connection) != 'retrying':
+            progress.publish(connection, job.id, {'status': 'retrying', 'error': str(value) or 'Download job failed'})
+        return
+    # the downloader reports its own errors; this covers failures outside it, e.g. timeouts
+    if jobstore.status(job.id, conn=connection) not in jobstore.FINAL_STATUSES:
+        progress.publish(connection, job.id, {'status': 'error', 'error': str(value) or 'Download job failed'})
+    metrics.observe_job(job, failed=True, exc_type=type)
+    _job_ended(job)
+
+
+def cancel(job_id: str) -> Optional[str]:
+    """Cancel a job. One that has not started (pending here, queued in RQ or waiting out a retry
+    backoff) is cancelled right away; a running one is flagged and its worker stops it within
+    `cancel.CANCEL_POLL_SECONDS`. Returns 'cancelled', 'cancelling' (still running), the status
+    of a job that had already ended, or None for an unknown job."""
+    status = jobstore.status(job_id, conn=redis_conn)
+    if status is None:
+        return None
+    if status in jobstore.FINAL_STATUSES:
+        return status
+    # flagged first, so a worker that picks the job up from here on stops it at once
+    jobstore.request_cancel(job_id, conn=redis_conn)
+    try:
+        job = Job.fetch(job_id, connection=redis_conn)
+    except NoSuchJobError:
+        job = None  # still pending here; dispatch drops it
+    if job is not None and job.get_status() == JobStatus.STARTED:
+        return 'cancelling'
+    progress.publish(redis_conn, job_id, {'status': 'cancelled'})
+    admission.release(redis_conn, job_id)
+    if job is not None:
+        try:
+            job.cancel()
+        except InvalidJobOperation:
+            pass
+        # a retry's workspace is kept for it to resume
+        shutil.rmtree(os.path.join(WORK_DIR, job_id), ignore_errors=True)
+        _job_ended(job)
+    return 'cancelled'
+
+
+def lane_stats() -> dict:
+    """Queue depth per lane: jobs waiting in the scheduler, queued in RQ and running."""
+    stats = {}
+    for lane, queue_name in LANE_QUEUES.items():
+        queue = get_queue(queue_name)
+        clients = [c.decode('utf-8') for c in redis_conn.smembers(f'sched:{lane}:active')]
+        pipe = redis_conn.pipeline()
+        for client in clients:
+            pipe.llen(f'sched:{lane}:pending:{client}')
+        pending = sum(pipe.execute()) if clients else 0
+        stats[lane] = {
+            'queue': queue_name,
+            'pending': pending,
+            'clients': len(clients),
+            'queued': len(queue),
+            'started': StartedJobRegistry(queue=queue).count,
+            'retrying': ScheduledJobRegistry(queue=queue).count,
+            'limit': LANE_LIMITS[lane],
+        }
+    return stats
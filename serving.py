@@ -0,0 +1,213 @@
+import io
+import os
+import time
+import unicodedata
+from urllib.parse import quote
+from flask import Response, request
+from werkzeug.datastructures import Headers
+from werkzeug.http import dump_options_header, http_date, parse_date, parse_etags, parse_if_range_header, parse_range_header
+import quota
+import metrics
+import storage
+import bandwidth
+from downloader import redis_client
+
+# '' serves files from the Python worker; 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd)
+# hand the transfer to the front proxy so no worker is held for the body.
+SENDFILE_MODE = os.getenv('SENDFILE_MODE', '').lower()
+# nginx `internal` location aliased to the results directory (DOWNLOAD_DIR, or STORAGE_DIR with
+# STORAGE_BACKEND=shared), used to build X-Accel-Redirect URIs
+X_ACCEL_PREFIX = os.getenv('X_ACCEL_PREFIX', '/protected-downloads/')
+SERVE_CHUNK_SIZE = 256 * 1024
+
+
+class _PinnedFile(io.BufferedReader):
+    """File object that releases its disk quota pin (if `pinned`) and records the transfer
+    time when the WSGI server closes it after sending the body."""
+
+    def __init__(self, path, pinned=True):
+        super().__init__(io.FileIO(path, 'rb'))
+        self.pinned_path = path if pinned else None
+        self.opened = time.perf_counter()
+
+    def close(self):
+        if not self.closed:
+            metrics.observe_phase('transfer', 'file', time.perf_counter() - self.opened)
+            if self.pinned_path:
+                try:
+                    quota.unpin(redis_client, self.pinned_path)
+                except Exception:
+                    pass
+        super().close()
+
+
+class _RemoteFile:
+    """Body of an object in `storage`, fetched while it is sent; records the transfer time when closed."""
+
+    def __init__(self, body):
+        self.body = body
+        self.opened = time.perf_counter()
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+    def close(self):
+        if self.body is not None:
+            metrics.observe_phase('transfer', 'file', time.perf_counter() - self.opened)
+            self.body.close()
+            self.body = None
+
+
+def content_disposition(filename):
+    """Content-Disposition value for an attachment. Headers are latin-1 on the wire, so
+    non-ASCII names go in an RFC 5987 `filename*` with an ASCII fallback, as in send_file."""
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        return dump_options_header('attachment', {'filename': simple, 'filename*': f"UTF-8''{quote(filename, safe='')}"})
+    return dump_options_header('attachment', {'filename': filename})
+
+
+def read_range(f, length):
+    """Body that reads `length` bytes of `f` in chunks and closes it at the end; also the fallback
+    for servers whose file wrapper may not stop at Content-Length."""
+    try:
+        while length > 0:
+            chunk = f.read(min(SERVE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _if_range_matches(if_range, etag, st):
+    """A Range is only honoured if If-Range (when sent) still matches the file."""
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(st.mtime) <= if_range.date.timestamp()
+    return True
+
+
+def _offload(path, headers):
+    if SENDFILE_MODE == 'x-accel':
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(storage.file_root()))
+        headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + quote(rel.replace(os.sep, '/'))
+    else:
+        headers['X-Sendfile'] = os.path.abspath(path)
+    return headers
+
+
+class Prepared:
+    """Status and headers of a file response. `file` is the open file (seeked to `start`) when
+    the body is sent from Python, otherwise None (304, 416 or offloaded to the proxy)."""
+
+    def __init__(self, status, headers, file=None, start=0, length=0):
+        self.status = status
+        self.headers = headers
+        self.file = file
+        self.start = start
+        self.length = length
+
+
+def prepare(path: str, request_headers, download_name: str = None, pin: bool = True, client_id: str = None) -> Prepared:
+    """
+    Work out the response for a finished file (a `storage` reference) and the request's
+    conditional and Range headers (any mapping with `get`), independent of the web framework.
+    Pins the file and opens it when the body is to be sent from Python; an object is opened for
+    the requested range only. FileNotFoundError if the result is gone.
+    """
+    st = storage.stat(path)
+    etag = st.etag
+    headers = Headers({
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(st.mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age=0',
+    })
+    headers['Content-Disposition'] = content_disposition(download_name or storage.basename(path))
+
+    remote = storage.is_remote(path)
+    if remote:
+        # objects are not in the disk quota
+        pin = False
+    else:
+        try:
+            quota.touch(redis_client, path)
+        except Exception:
+            pin = False
+
+    if_none_match = parse_etags(request_headers.get('If-None-Match'))
+    if_modified_since = parse_date(request_headers.get('If-Modified-Since'))
+    if if_none_match.contains(etag) or (
+            not if_none_match and if_modified_since
+            and int(st.mtime) <= if_modified_since.timestamp()):
+        return Prepared(304, headers)
+
+    if SENDFILE_MODE in ('x-accel', 'x-sendfile') and not remote:
+        # the proxy opens the file itself and handles Range; unlinking it later is safe
+        metrics.SERVED_BYTES.labels(SENDFILE_MODE).inc(st.size)
+        rate = bandwidth.served_rate(client_id)
+        if rate and SENDFILE_MODE == 'x-accel':
+            headers['X-Accel-Limit-Rate'] = str(rate)
+        return Prepared(200, _offload(path, headers))
+
+    size = st.size
+    start, length, status = 0, size, 200
+    rng = parse_range_header(request_headers.get('Range'))
+    if_range = parse_if_range_header(request_headers.get('If-Range'))
+    if rng is not None and len(rng.ranges) == 1 and _if_range_matches(if_range, etag, st):
+        bounds = rng.range_for_length(size)
+        if bounds is None:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Prepared(416, headers)
+        start, stop = bounds
+        length, status = stop - start, 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    headers['Content-Length'] = str(length)
+
+    if remote:
+        f = _RemoteFile(storage.open_range(path, start, length if status == 206 else None))
+    else:
+        if pin:
+            try:
+                quota.pin(redis_client, path)
+            except Exception:
+                pin = False
+        f = _PinnedFile(path, pinned=pin)
+        f.seek(start)
+    metrics.SERVED_BYTES.labels('direct').inc(length)
+    headers['Content-Type'] = 'application/octet-stream'
+    return Prepared(status, headers, f, start, length)
+
+
+def serve_file(path: str, download_name: str = None, pin: bool = True, client_id: str = None) -> Response:
+    """
+    Serve a finished file (a `storage` reference) as an attachment with ETag/If-None-Match,
+    If-Modified-Since and single byte-range support.
+
+    Direct responses hand the open file (seeked to the range start) to the WSGI server's
+    file wrapper, so gunicorn sends it with zero-copy sendfile(). With SENDFILE_MODE set the
+    body is left to the front proxy via X-Accel-Redirect / X-Sendfile. Objects are streamed
+    from the store through this process.
+    When `pin` is set the file is pinned against disk quota eviction until the transfer ends.
+    With a BANDWIDTH_PER_CLIENT limit, bodies for `client_id` are paced from Python instead
+    (nginx gets the rate as X-Accel-Limit-Rate).
+    """
+    prepared = prepare(path, request.headers, download_name, pin, client_id)
+    f, length, status = prepared.file, prepared.length, prepared.status
+    if f is None:
+        return Response(status=status, headers=prepared.headers)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if bandwidth.served_rate(client_id):
+        # sendfile() cannot be paced
+        body = bandwidth.pace(read_range(f, length), redis_client, client_id)
+    # gunicorn's wrapper honours the current offset and Content-Length when using sendfile()
+    elif file_wrapper and not storage.is_remote(path) and (status == 200 or request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')):
+        body = file_wrapper(f, SERVE_CHUNK_SIZE)
+    else:
+        body = read_range(f, length)
+    return Response(body, status=status, headers=prepared.headers, direct_passthrough=True)
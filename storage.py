@@ -0,0 +1,219 @@
+"""
+Where finished files are kept, so that results downloaded on any worker can be served by any
+web node.
+
+STORAGE_BACKEND selects the backend:
+  local   per-job directories in DOWNLOAD_DIR (the default); web and workers have to share the
+          machine or the `downloads` volume
+  shared  per-job directories in STORAGE_DIR, a volume mounted at the same path on every web and
+          worker node (NFS, EFS, ...); finished files are copied there from the worker's workspace
+  s3      objects in S3_BUCKET under S3_PREFIX on S3 or an S3-compatible store (S3_ENDPOINT_URL,
+          e.g. MinIO); uploaded with multipart uploads and sent to clients with ranged GETs
+Downloads always run in the worker's local DOWNLOAD_DIR/.work; `publish` hands the finished file
+to the backend and returns the reference stored as the job's result: a path for the directory
+backends, `s3://bucket/key` for objects. The read functions take any reference, so results
+published before a backend change stay readable. Credentials for S3 come from boto3's usual
+sources (AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY, an instance role, ...).
+"""
+import os
+import time
+import uuid
+import errno
+import shutil
+import posixpath
+import threading
+from typing import NamedTuple
+from yt_dlp.utils import parse_bytes
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local').lower()
+STORAGE_DIR = os.getenv('STORAGE_DIR', '')
+S3_BUCKET = os.getenv('S3_BUCKET', '')
+S3_PREFIX = os.getenv('S3_PREFIX', 'downloads/')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL') or None
+S3_REGION = os.getenv('S3_REGION') or None
+# Files over the threshold are uploaded in parts, several at a time
+S3_MULTIPART_THRESHOLD = parse_bytes(os.getenv('S3_MULTIPART_THRESHOLD', '64M'))
+S3_PART_SIZE = parse_bytes(os.getenv('S3_PART_SIZE', '16M'))
+S3_UPLOAD_CONCURRENCY = int(os.getenv('S3_UPLOAD_CONCURRENCY', '4'))
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_backend = None
+_s3 = None
+_lock = threading.Lock()
+
+
+class Stat(NamedTuple):
+    size: int
+    mtime: float
+    etag: str
+
+
+def is_remote(ref: str) -> bool:
+    """Whether `ref` is an object rather than a file on this machine's filesystem."""
+    return ref.startswith('s3://')
+
+
+def basename(ref: str) -> str:
+    return posixpath.basename(ref) if is_remote(ref) else os.path.basename(ref)
+
+
+def _s3_client():
+    global _s3
+    with _lock:
+        if _s3 is None:
+            import boto3  # only needed with S3 results
+            _s3 = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION)
+        return _s3
+
+
+def _s3_location(ref):
+    bucket, _, key = ref[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def _not_found(e):
+    return e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def _head(ref):
+    from botocore.exceptions import ClientError
+    bucket, key = _s3_location(ref)
+    try:
+        return _s3_client().head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if _not_found(e):
+            raise FileNotFoundError(errno.ENOENT, 'No such object', ref) from e
+        raise
+
+
+def stat(ref: str) -> Stat:
+    """Size, modification time and entity tag of a result; FileNotFoundError if it is gone."""
+    if not is_remote(ref):
+        st = os.stat(ref)
+        return Stat(st.st_size, st.st_mtime, f'{st.st_mtime_ns:x}-{st.st_size:x}')
+    head = _head(ref)
+    return Stat(head['ContentLength'], head['LastModified'].timestamp(), head['ETag'].strip('"'))
+
+
+def exists(ref: str) -> bool:
+    if not is_remote(ref):
+        return os.path.exists(ref)
+    try:
+        _head(ref)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def open_range(ref: str, start: int = 0, length: int = None):
+    """Readable file object (`read(n)`, `close()`) positioned at `start`; remote objects are only
+    fetched for `length` bytes from there, and as they are read."""
+    if not is_remote(ref):
+        f = open(ref, 'rb')
+        f.seek(start)
+        return f
+    bucket, key = _s3_location(ref)
+    extra = {}
+    if start or length is not None:
+        extra['Range'] = f'bytes={start}-{"" if length is None else start + length - 1}'
+    try:
+        return _s3_client().get_object(Bucket=bucket, Key=key, **extra)['Body']
+    except Exception as e:
+        from botocore.exceptions import ClientError
+        if isinstance(e, ClientError) and _not_found(e):
+            raise FileNotFoundError(errno.ENOENT, 'No such object', ref) from e
+        raise
+
+
+def remove(ref: str):
+    """Delete a result; one that is already gone is ignored."""
+    if not is_remote(ref):
+        try:
+            os.remove(ref)
+        except FileNotFoundError:
+            pass
+        return
+    bucket, key = _s3_location(ref)
+    _s3_client().delete_object(Bucket=bucket, Key=key)
+
+
+class FileStorage:
+    """Results in per-job directories under `root`, a local directory or a shared volume."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def publish(self, path: str, job_id: str) -> str:
+        target_dir = os.path.join(self.root, job_id)
+        os.makedirs(target_dir, exist_ok=True)
+        target = os.path.join(target_dir, os.path.basename(path))
+        try:
+            os.replace(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # another filesystem: copy under a dot name readers skip, then rename it into place
+            part = os.path.join(target_dir, f'.{uuid.uuid4().hex}.part')
+            try:
+                with open(path, 'rb') as src, open(part, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+                os.replace(part, target)
+            except BaseException:
+                try:
+                    os.remove(part)
+                except OSError:
+                    pass
+                raise
+            os.remove(path)
+        return target
+
+
+class S3Storage:
+    """Results as objects `{prefix}{job_id}/{file name}` in `bucket`."""
+
+    def __init__(self, bucket: str, prefix: str = ''):
+        from boto3.s3.transfer import TransferConfig
+        if not bucket:
+            raise RuntimeError('STORAGE_BACKEND=s3 needs S3_BUCKET')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.transfer = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD, multipart_chunksize=S3_PART_SIZE,
+                                       max_concurrency=S3_UPLOAD_CONCURRENCY)
+
+    def publish(self, path: str, job_id: str) -> str:
+        key = f'{self.prefix}{job_id}/{os.path.basename(path)}'
+        started = time.perf_counter()
+        # streamed from the file; large files go up as a multipart upload that is aborted on failure
+        _s3_client().upload_file(path, self.bucket, key, Config=self.transfer)
+        print(f'[INFO] Uploaded {key} ({os.path.getsize(path)} bytes) in {time.perf_counter() - started:.1f}s', flush=True)
+        os.remove(path)
+        return f's3://{self.bucket}/{key}'
+
+
+def backend():
+    """The configured backend, created on first use."""
+    global _backend
+    with _lock:
+        if _backend is None:
+            if STORAGE_BACKEND == 's3':
+                _backend = S3Storage(S3_BUCKET, S3_PREFIX)
+            elif STORAGE_BACKEND == 'shared':
+                if not STORAGE_DIR:
+                    raise RuntimeError('STORAGE_BACKEND=shared needs STORAGE_DIR')
+                _backend = FileStorage(STORAGE_DIR)
+            else:
+                from downloader import DOWNLOAD_DIR  # the downloader publishes through this module
+                _backend = FileStorage(DOWNLOAD_DIR)
+        return _backend
+
+
+def file_root():
+    """Directory results are kept in, or None when they are not files on this machine."""
+    store = backend()
+    return store.root if isinstance(store, FileStorage) else None
+
+
+def publish(path: str, job_id: str) -> str:
+    """Hand a finished file from the worker's workspace to the backend; returns its reference.
+    The file itself is consumed."""
+    return backend().publish(path, job_id)
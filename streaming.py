@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import uuid
+import time
+import threading
+import subprocess
+from typing import Iterator, Optional, Tuple
+from yt_dlp.utils import sanitize_filename
+import quota
+import metrics
+import result_cache
+import storage
+from downloader import DOWNLOAD_DIR, DEFAULT_MAX_FILESIZE, redis_client, get_info, new_ydl, _remove_file
+
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', str(64 * 1024)))
+# Also save streamed bytes to `storage` so later requests are served from the result cache
+STREAM_TEE = os.getenv('STREAM_TEE', '1') != '0'
+
+# Only single-file formats can be piped: anything needing a merge or transcode waits for the whole file
+STREAM_FORMATS = {'video': 'best', 'audio': 'bestaudio'}
+
+
+def _stream_cache_key(url, kind, max_filesize):
+    return result_cache.cache_key(url, kind, json.dumps({'stream': STREAM_FORMATS.get(kind, 'best')}), max_filesize)
+
+
+def select_stream_format(info: dict, kind: str) -> Optional[dict]:
+    """Return the format that would be streamed for `kind`, or None if there is no single-file format."""
+    formats = info.get('formats') or [info]
+    with new_ydl({'quiet': True}) as ydl:
+        selector = ydl.build_format_selector(STREAM_FORMATS.get(kind, 'best'))
+        selected = list(selector({
+            'formats': formats,
+            'has_merged_format': any('none' not in (f.get('acodec'), f.get('vcodec')) for f in formats),
+            'incomplete_formats': False,
+        }))
+    if not selected or selected[0].get('requested_formats'):
+        return None
+    return selected[0]
+
+
+def cached_path(url: str, kind: str = 'video', max_filesize: Optional[str] = None) -> Optional[str]:
+    """`storage` reference of a previously streamed (tee'd) file for the same request, if still stored."""
+    if redis_client is None:
+        return None
+    try:
+        return result_cache.lookup(redis_client, _stream_cache_key(url, kind, max_filesize or DEFAULT_MAX_FILESIZE))
+    except Exception:
+        return None
+
+
+def open_stream(url: str, kind: str = 'video', max_filesize: Optional[str] = None) -> Optional[Tuple[str, Iterator[bytes]]]:
+    """
+    Start piping `url` through a yt-dlp subprocess writing to stdout.
+    Returns (download filename, chunk iterator), or None if the media has no single-file format;
+    the iterator's `close()` must be called when the response ends, see `_Pump`.
+    Raises RuntimeError if yt-dlp fails before producing any bytes.
+    The metadata comes from `get_info` (cached), so yt-dlp does not extract again.
+    """
+    if max_filesize is None:
+        max_filesize = DEFAULT_MAX_FILESIZE
+    info = get_info(url)
+    fmt = select_stream_format(info, kind)
+    if fmt is None:
+        return None
+
+    token = uuid.uuid4().hex
+    info_path = os.path.join(DOWNLOAD_DIR, f'.stream-{token}.info.json')
+    proc = None
+    try:
+        with open(info_path, 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+        cmd = [sys.executable, '-m', 'yt_dlp', '--quiet', '--no-warnings', '--no-playlist',
+               '--load-info-json', info_path, '-f', fmt['format_id'], '-o', '-']
+        if max_filesize:
+            cmd += ['--max-filesize', str(max_filesize)]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        first = proc.stdout.read1(STREAM_CHUNK_SIZE)
+        if not first:
+            proc.wait()
+            raise RuntimeError(f'yt-dlp exited with status {proc.returncode} before sending any data')
+
+        title = sanitize_filename(info.get('title') or 'download')
+        filename = f'{title}.{fmt.get("ext") or "bin"}'
+        final_path = os.path.join(DOWNLOAD_DIR, f'{title} [stream-{fmt["format_id"]}].{fmt.get("ext") or "bin"}')
+        key = _stream_cache_key(url, kind, max_filesize) if STREAM_TEE and redis_client else None
+        return filename, _Pump(proc, first, info_path, final_path, key, f'stream-{token}')
+    except BaseException:
+        if proc is not None:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+        _remove_file(info_path)
+        raise
+
+
+class _Pump:
+    """Iterator over the subprocess output; on a clean finish the tee file is published as
+    `job_id` and cached. `close()` kills yt-dlp and removes the temporary files, also when the
+    iterator was never started (client went away before the body, response discarded), so the
+    server has to call it however the response ends; it is safe to call more than once."""
+
+    def __init__(self, proc, first, info_path, final_path, key, job_id):
+        self.proc = proc
+        self.info_path = info_path
+        self.final_path = final_path
+        self.key = key
+        self.job_id = job_id
+        self.part_path = os.path.join(DOWNLOAD_DIR, f'.{os.path.basename(info_path)}.part')
+        self.tee = open(self.part_path, 'wb') if key else None
+        self._first = first
+        self._complete = False
+        self._closing = self._closed = False
+        self._started, self._sent = time.perf_counter(), 0
+        # reads and the file cleanup; close() may come from another thread while a read blocks
+        self._lock = threading.RLock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if self._closed:
+                raise StopIteration
+            chunk, self._first = self._first or self.proc.stdout.read1(STREAM_CHUNK_SIZE), None
+            if not chunk:
+                if self._closing:
+                    raise StopIteration
+                self._complete = self.proc.wait() == 0
+                if not self._complete:
+                    print(f'[ERROR] Streaming yt-dlp exited with status {self.proc.returncode}', flush=True)
+                self.close()
+                raise StopIteration
+            if self.tee:
+                self.tee.write(chunk)
+            self._sent += len(chunk)
+            return chunk
+
+    def close(self):
+        # killed outside the lock, so a read blocked on the pipe returns
+        self._closing = True
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            metrics.SERVED_BYTES.labels('stream').inc(self._sent)
+            metrics.observe_phase('transfer', 'stream', time.perf_counter() - self._started)
+            self.proc.stdout.close()
+            if self.tee:
+                self.tee.close()
+                if self._complete:
+                    os.replace(self.part_path, self.final_path)
+                    try:
+                        ref = storage.publish(self.final_path, self.job_id)
+                        result_cache.store(redis_client, self.key, ref)
+                        if not storage.is_remote(ref):
+                            quota.register(redis_client, ref)
+                    except Exception as e:
+                        print(f'[WARN] Could not cache streamed file: {e}', flush=True)
+                else:
+                    _remove_file(self.part_path)
+            _remove_file(self.info_path)
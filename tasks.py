@@ -1,17 +1,62 @@
 import os
-from redis import Redis
-from rq import Queue
-from dotenv import load_dotenv
+import uuid
+from rq import Queue, Retry, get_current_job
+import jobstore
+import resume
 from downloader import download_media
 
-load_dotenv()
-
-REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
-redis_conn = Redis.from_url(REDIS_URL)
+# the process-wide pool shared with the downloader and the job store
+redis_conn = jobstore.client
 q = Queue('downloads', connection=redis_conn)
 
+# Retries of a download that failed for a transient reason, after DOWNLOAD_RETRY_BACKOFF
+# seconds, then twice that, ...; each retry resumes the partial files of the one before
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', '3'))
+DOWNLOAD_RETRY_BACKOFF = int(os.getenv('DOWNLOAD_RETRY_BACKOFF', '30'))
+
+
+def get_queue(name: str = 'downloads') -> Queue:
+    if name == q.name:
+        return q
+    return Queue(name, connection=redis_conn)
+
+
+def retry_policy() -> Retry:
+    """RQ retry policy with exponential backoff (None if DOWNLOAD_RETRIES is 0)."""
+    if DOWNLOAD_RETRIES <= 0:
+        return None
+    return Retry(max=DOWNLOAD_RETRIES, interval=[DOWNLOAD_RETRY_BACKOFF * 2 ** i for i in range(DOWNLOAD_RETRIES)])
+
+
+def run_download(*args, **kwargs):
+    """RQ entry point for `download_media`. While the job has retries left, a transient failure
+    keeps the workspace for the next attempt; any other failure ends the job right away."""
+    job = get_current_job()
+    try:
+        return download_media(*args, resumable=bool(job and job.retries_left), **kwargs)
+    except BaseException as e:
+        if job is not None and job.retries_left and not resume.is_transient(e):
+            # RQ reads this from the same Job instance when it handles the failure
+            job.retries_left = 0
+        raise
+
+
+def enqueue_download(url: str, kind: str = 'video', cookies_text: str = None, max_filesize: str = None, job_id: str = None,
+                     queue_name: str = 'downloads', job_timeout: int = 60*60, on_success=None, on_failure=None, concurrent_fragments: int = None,
+                     meta: dict = None, platform: str = 'auto', audio_format: str = None, client_id: str = None,
+                     quality: str = None, start: float = None, end: float = None):
+    """Enqueue a background download job. Returns RQ job id.
 
-def enqueue_download(url: str, kind: str = 'video', cookies_text: str = None, max_filesize: str = None):
-    """Enqueue a background download job. Returns RQ job id."""
-    job = q.enqueue(download_media, url, kind, None, cookies_text, max_filesize, job_timeout=60*60)
+    The RQ job id is also passed to `download_media` as its job id, so the
+    job's `jobstore` state can be looked up by it. Transient failures are
+    retried with `retry_policy`.
+    """
+    if job_id is None:
+        job_id = str(uuid.uuid4())
+    jobstore.write(job_id, {'status': 'queued'}, conn=redis_conn)
+    job = get_queue(queue_name).enqueue(run_download, url, kind, job_id, cookies_text, max_filesize, job_id=job_id,
+                                        concurrent_fragments=concurrent_fragments, platform=platform, audio_format=audio_format,
+                                        client_id=client_id, quality=quality, start=start, end=end,
+                                        job_timeout=job_timeout, on_success=on_success, on_failure=on_failure, meta=meta,
+                                        retry=retry_policy())
     return job.get_id()
@@ -0,0 +1,24 @@
+"""
+Shared fixtures. The app's modules read REDIS_URL when they are imported, so a throwaway Redis
+(`redis-server` if installed, else fakeredis over TCP, as in the load tests) is started before
+any test module imports them.
+"""
+import os
+import pytest
+from bench_load import LocalRedis
+
+_redis = LocalRedis().__enter__()
+os.environ['REDIS_URL'] = _redis.url
+os.environ.setdefault('RESULT_CACHE', '0')
+
+
+def pytest_unconfigure(config):
+    _redis.__exit__(None, None, None)
+
+
+@pytest.fixture
+def redis_conn():
+    """The app's shared connection, emptied before each test."""
+    import jobstore
+    jobstore.client.flushdb()
+    return jobstore.client
@@ -0,0 +1,51 @@
+import time
+import threading
+import pytest
+import admission
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_CLIENT_JOBS', 3)
+    monkeypatch.setattr(admission, 'ADMISSION_CLIENT_COST', 0)
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_WAIT', 0)
+    monkeypatch.setattr(admission, 'ADMISSION_MIN_FREE_DISK', 0)
+    monkeypatch.setattr(admission, '_workers', lambda client: 1)
+
+
+def test_rejects_over_client_jobs(limits, redis_conn):
+    for n in range(3):
+        admission.admit(redis_conn, f'job-{n}', 'alice', 1)
+    with pytest.raises(admission.Rejected) as e:
+        admission.admit(redis_conn, 'job-3', 'alice', 1)
+    assert e.value.reason == 'client_jobs'
+    admission.admit(redis_conn, 'job-4', 'bob', 1)
+    admission.release(redis_conn, 'job-0')
+    admission.admit(redis_conn, 'job-3', 'alice', 1)
+
+
+def test_concurrent_admissions_do_not_overshoot(limits, monkeypatch, redis_conn):
+    open_cost = admission._open_cost
+
+    def slow_open_cost(client, job_ids):
+        # widen the window between reading the open work and recording the new job
+        time.sleep(0.05)
+        return open_cost(client, job_ids)
+
+    monkeypatch.setattr(admission, '_open_cost', slow_open_cost)
+    admitted = []
+
+    def submit(n):
+        try:
+            admission.admit(redis_conn, f'job-{n}', 'alice', 1)
+            admitted.append(n)
+        except admission.Rejected:
+            pass
+
+    threads = [threading.Thread(target=submit, args=(n,)) for n in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(admitted) == 3
+    assert redis_conn.zcard('admit:client:alice') == 3
@@ -0,0 +1,122 @@
+import io
+import os
+import shutil
+import pytest
+from yt_dlp.networking import Response
+from yt_dlp.networking.exceptions import HTTPError
+from yt_dlp.utils import DownloadError
+import cancel
+import downloader
+import hostlimit
+
+URL = 'https://media.test/watch/1'
+CACHED = {'id': '1', 'title': 'clip', 'extractor': 'generic', 'extractor_key': 'Generic', 'webpage_url': URL,
+          'url': 'https://cdn.media.test/1.mp4', 'ext': 'mp4'}
+
+
+def _http_error(status):
+    error = HTTPError(Response(io.BytesIO(b''), CACHED['url'], {}, status=status))
+    # as yt-dlp reports a failed download: wrapped, with the cause in exc_info
+    return DownloadError(f'ERROR: unable to download video data: {error}', exc_info=(HTTPError, error, None))
+
+
+class FakeYDL:
+    """Stands in for YoutubeDL: the cached-info download fails with `error`, a fresh extraction
+    fails with `Extracted` so the test sees whether it was attempted."""
+
+    class Extracted(Exception):
+        pass
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = []
+        self.opts = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def process_ie_result(self, info, download=True):
+        self.calls.append('process_ie_result')
+        raise self.error
+
+    def extract_info(self, url, download=True):
+        self.calls.append('extract_info')
+        cookiefile = self.opts.get('cookiefile')
+        self.cookies_seen = cookiefile and os.path.exists(cookiefile)
+        raise self.error if self.opts.get('cookiefile') else self.Extracted()
+
+
+@pytest.fixture
+def fake_ydl(monkeypatch, redis_conn):
+    def install(error):
+        ydl = FakeYDL(error)
+
+        def new_ydl(opts, extractors=None):
+            ydl.opts = opts
+            return ydl
+        monkeypatch.setattr(downloader, 'new_ydl', new_ydl)
+        monkeypatch.setattr(downloader, 'peek_info', lambda url: dict(CACHED))
+        return ydl
+    return install
+
+
+def _run(tmp_path, watch=None):
+    return downloader._download(URL, 'video', None, None, None, False, workdir=str(tmp_path), watch=watch)
+
+
+def test_cancel_does_not_extract_again(fake_ydl, tmp_path):
+    ydl = fake_ydl(cancel.Cancelled())
+    watch = cancel.Watch()
+    watch.cancel()
+    with pytest.raises(cancel.Cancelled):
+        _run(tmp_path, watch)
+    assert ydl.calls == ['process_ie_result']
+
+
+def test_throttled_host_is_not_asked_again(fake_ydl, tmp_path, redis_conn):
+    ydl = fake_ydl(_http_error(429))
+    with pytest.raises(RuntimeError, match='429'):
+        _run(tmp_path)
+    assert ydl.calls == ['process_ie_result']
+    # and the host backs off for every worker
+    assert hostlimit.backoff_remaining(redis_conn, hostlimit.limit_key(URL, CACHED)) > 0
+
+
+def test_other_errors_are_not_retried_with_extraction(fake_ydl, tmp_path):
+    ydl = fake_ydl(DownloadError('ERROR: Requested format is not available'))
+    with pytest.raises(RuntimeError, match='not available'):
+        _run(tmp_path)
+    assert ydl.calls == ['process_ie_result']
+
+
+@pytest.mark.parametrize('status', [403, 404, 410])
+def test_expired_stream_url_extracts_again(fake_ydl, tmp_path, status):
+    ydl = fake_ydl(_http_error(status))
+    with pytest.raises(RuntimeError):
+        _run(tmp_path)
+    assert ydl.calls == ['process_ie_result', 'extract_info']
+
+
+def _cookie_files():
+    return [os.path.join(root, name) for root, _, names in os.walk(downloader.DOWNLOAD_DIR)
+            for name in names if name.startswith('cookies-')]
+
+
+@pytest.mark.parametrize('resumable', [False, True])
+def test_cookies_removed_when_the_download_fails(fake_ydl, resumable):
+    # a 500 is transient: a resumable job keeps its workspace for the retry, but not the cookies
+    ydl = fake_ydl(_http_error(500))
+    job_id = 'cookie-test'
+    with pytest.raises(RuntimeError):
+        downloader.download_media(URL, job_id=job_id, cookies_text='# Netscape HTTP Cookie File\n', use_redis=False,
+                                  resumable=resumable)
+    try:
+        assert ydl.cookies_seen
+        assert os.path.dirname(ydl.opts['cookiefile']) == os.path.join(downloader.WORK_DIR, job_id)
+        assert _cookie_files() == []
+        assert os.path.isdir(os.path.join(downloader.WORK_DIR, job_id)) == resumable
+    finally:
+        shutil.rmtree(os.path.join(downloader.WORK_DIR, job_id), ignore_errors=True)
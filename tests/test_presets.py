@@ -0,0 +1,77 @@
+import pytest
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import ExtractorError
+import presets
+
+
+def _fmt(format_id, vcodec='none', acodec='none', height=None, size=None, ext='mp4', tbr=None):
+    return {'format_id': format_id, 'url': f'http://media.test/{format_id}', 'vcodec': vcodec, 'acodec': acodec,
+            'height': height, 'filesize': size, 'ext': ext, 'tbr': tbr, 'protocol': 'https'}
+
+
+VIDEO = [
+    _fmt('a-low', acodec='mp4a', size=1_000_000, ext='m4a'),
+    _fmt('a-high', acodec='mp4a', size=3_000_000, ext='m4a'),
+    _fmt('360', vcodec='avc1', acodec='mp4a', height=360, size=10_000_000),
+    _fmt('v720', vcodec='avc1', height=720, size=30_000_000),
+    _fmt('v1080', vcodec='avc1', height=1080, size=60_000_000),
+]
+AUDIO_ONLY = [
+    _fmt('mp3-128', acodec='mp3', size=2_000_000, ext='mp3'),
+    _fmt('opus-160', acodec='opus', size=3_000_000, ext='webm'),
+]
+
+
+def _ids(chosen):
+    return [f['format_id'] for f in chosen] if chosen else None
+
+
+def test_best_video_merges_best_audio():
+    assert _ids(presets.choose(VIDEO)) == ['v1080', 'a-high']
+
+
+def test_height_cap():
+    assert _ids(presets.choose(VIDEO, max_height=720)) == ['v720', 'a-high']
+    # nothing within the cap: the smallest resolution
+    assert _ids(presets.choose(VIDEO, max_height=240)) == ['360']
+
+
+def test_size_cap_drops_formats_over_it():
+    assert _ids(presets.choose(VIDEO, max_bytes=40_000_000)) == ['v720', 'a-high']
+    assert _ids(presets.choose(VIDEO, max_bytes=32_000_000)) == ['v720', 'a-low']
+    assert presets.choose(VIDEO, max_bytes=100) is None
+
+
+def test_clip_sizes_from_bitrate():
+    formats = [_fmt('big', vcodec='avc1', acodec='mp4a', height=720, size=500_000_000, tbr=1000)]
+    # 10 s at 1000 kbit/s is 1.25 MB, whatever the whole file's size
+    assert _ids(presets.choose(formats, max_bytes=2_000_000, seconds=10)) == ['big']
+
+
+def test_audio_only_media():
+    assert _ids(presets.choose(AUDIO_ONLY)) == ['opus-160']
+    assert _ids(presets.choose(AUDIO_ONLY, max_height=720)) == ['opus-160']
+    assert _ids(presets.choose(AUDIO_ONLY, max_bytes=2_500_000)) == ['mp3-128']
+    assert presets.choose(AUDIO_ONLY, max_bytes=100) is None
+
+
+def _select(selector, formats):
+    info = {'id': 'x', 'title': 'x', 'extractor': 'test', 'extractor_key': 'Test', 'webpage_url': 'http://media.test/',
+            'formats': [dict(f) for f in formats]}
+    with YoutubeDL({'quiet': True, 'format': selector, 'simulate': True}, auto_init=False) as ydl:
+        return ydl.process_ie_result(info, download=False)
+
+
+def test_selector_downloads_audio_only_media_as_video():
+    info = _select(presets.FormatSelector('best'), AUDIO_ONLY)
+    assert info['format_id'] == 'opus-160'
+
+
+def test_selector_merges_video_and_audio():
+    info = _select(presets.FormatSelector('720p'), VIDEO)
+    assert info['format_id'] == 'v720+a-high'
+
+
+def test_selector_size_error_only_with_a_cap():
+    with pytest.raises(ExtractorError, match='No format of this media fits'):
+        _select(presets.FormatSelector('under:1K'), AUDIO_ONLY)
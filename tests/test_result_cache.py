@@ -0,0 +1,29 @@
+import time
+import result_cache
+
+
+def test_lock_outlives_its_ttl_while_producing(monkeypatch, redis_conn):
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_LOCK_TTL', 1)
+    ttls = []
+
+    def produce():
+        for _ in range(5):
+            time.sleep(0.5)
+            ttls.append(redis_conn.ttl('cache-lock:k'))
+        return 'downloads/a.mp4'
+
+    assert result_cache.get_or_create(redis_conn, 'k', produce) == ('downloads/a.mp4', False)
+    # 2.5s of producing against a 1s lock: it was renewed throughout
+    assert all(ttl > 0 for ttl in ttls)
+    assert redis_conn.get('cache:k') == b'downloads/a.mp4'
+
+
+def test_renew_only_by_the_holder(monkeypatch, redis_conn):
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_LOCK_TTL', 60)
+    redis_conn.set('cache-lock:k', 'mine', ex=5)
+    assert not result_cache._renew_lock(redis_conn, 'cache-lock:k', 'theirs')
+    assert redis_conn.ttl('cache-lock:k') <= 5
+    assert result_cache._renew_lock(redis_conn, 'cache-lock:k', 'mine')
+    assert redis_conn.ttl('cache-lock:k') > 5
+    redis_conn.delete('cache-lock:k')
+    assert not result_cache._renew_lock(redis_conn, 'cache-lock:k', 'mine')
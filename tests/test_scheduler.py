@@ -0,0 +1,81 @@
+import pytest
+import scheduler
+
+
+@pytest.mark.parametrize('trusted, forwarded, peer, expected', [
+    (0, '6.6.6.6', '10.0.0.1', '10.0.0.1'),
+    (1, None, '10.0.0.1', '10.0.0.1'),
+    (1, '1.2.3.4', '10.0.0.1', '1.2.3.4'),
+    # the client's own header value is left of what the proxy added
+    (1, '6.6.6.6, 1.2.3.4', '10.0.0.1', '1.2.3.4'),
+    (2, '6.6.6.6, 1.2.3.4, 172.16.0.2', '10.0.0.1', '1.2.3.4'),
+    # fewer entries than proxies: the header did not come through all of them
+    (2, '1.2.3.4', '10.0.0.1', '10.0.0.1'),
+])
+def test_client_address(monkeypatch, trusted, forwarded, peer, expected):
+    monkeypatch.setattr(scheduler, 'TRUSTED_PROXIES', trusted)
+    assert scheduler.client_address(forwarded, peer) == expected
+
+
+def test_client_id_prefers_token():
+    assert scheduler.client_id_for('secret', '1.2.3.4').startswith('token:')
+    assert scheduler.client_id_for(None, '1.2.3.4') == 'ip:1.2.3.4'
+
+
+def test_spoofed_forwarded_for_is_ignored_in_both_tiers(monkeypatch):
+    import asgi
+    import web_app
+    from starlette.requests import Request
+    monkeypatch.setattr(scheduler, 'TRUSTED_PROXIES', 1)
+    headers = {'X-Forwarded-For': '6.6.6.6, 1.2.3.4'}
+    with web_app.app.test_request_context(headers=headers, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        assert web_app._client_id() == 'ip:1.2.3.4'
+    request = Request({'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'client': ('10.0.0.1', 5000),
+                       'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()]})
+    assert asgi._client_id(request) == 'ip:1.2.3.4'
+
+
+@pytest.fixture
+def lanes(monkeypatch, redis_conn):
+    """Every job in the standard lane at 3 cost units; RQ replaced by a record of what was enqueued."""
+    enqueued = []
+    monkeypatch.setattr(scheduler, 'predict_cost', lambda *args: ('standard', 3.0))
+    monkeypatch.setattr(scheduler, 'enqueue_download', lambda url, *args, **kwargs: enqueued.append(url))
+    monkeypatch.setattr(scheduler, '_running', lambda lane, finishing=None: len(enqueued) if lane == 'standard' else 0)
+    monkeypatch.setattr(scheduler, 'SCHED_QUANTUM', 5)
+    monkeypatch.setattr(scheduler, 'LANE_LIMITS', {'fast': 0, 'standard': 0, 'bulk': 0})
+    return enqueued
+
+
+def test_dispatch_deficit_round_robin(lanes, monkeypatch):
+    for n in range(4):
+        scheduler.submit(f'alice-{n}', client_id='alice')
+    for n in range(2):
+        scheduler.submit(f'bob-{n}', client_id='bob')
+    assert lanes == []
+    monkeypatch.setattr(scheduler, 'LANE_LIMITS', {'fast': 0, 'standard': 10, 'bulk': 0})
+    scheduler.dispatch()
+    # a quantum of 5 buys one 3-unit job the first turn, the saved 2 units make it two the next
+    assert lanes == ['alice-0', 'bob-0', 'alice-1', 'alice-2', 'bob-1', 'alice-3']
+
+
+def test_dispatch_respects_lane_limit(lanes, monkeypatch, redis_conn):
+    monkeypatch.setattr(scheduler, 'LANE_LIMITS', {'fast': 0, 'standard': 2, 'bulk': 0})
+    for n in range(4):
+        scheduler.submit(f'alice-{n}', client_id='alice')
+    assert lanes == ['alice-0', 'alice-1']
+    # a job ending frees its slot for the next one
+    lanes.pop(0)
+    scheduler.dispatch()
+    assert lanes == ['alice-1', 'alice-2']
+    assert redis_conn.llen('sched:standard:pending:alice') == 1
+
+
+def test_dispatch_drops_cancelled_pending_jobs(lanes, monkeypatch, redis_conn):
+    job_ids = [scheduler.submit(f'alice-{n}', client_id='alice') for n in range(2)]
+    assert scheduler.cancel(job_ids[0]) == 'cancelled'
+    monkeypatch.setattr(scheduler, 'LANE_LIMITS', {'fast': 0, 'standard': 10, 'bulk': 0})
+    scheduler.dispatch()
+    assert lanes == ['alice-1']
+    assert redis_conn.hget('admit:cost', job_ids[0]) is None
+    assert not redis_conn.sismember('sched:standard:active', 'alice')
@@ -0,0 +1,84 @@
+import pytest
+from flask import Flask
+from werkzeug.http import http_date
+import serving
+
+BODY = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def media(tmp_path, monkeypatch, redis_conn):
+    monkeypatch.setattr(serving, 'SENDFILE_MODE', '')
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(BODY)
+    return str(path)
+
+
+def _prepare(path, **headers):
+    prepared = serving.prepare(path, {name.replace('_', '-'): value for name, value in headers.items()})
+    body = prepared.file.read(prepared.length) if prepared.file else None
+    if prepared.file:
+        prepared.file.close()
+    return prepared, body
+
+
+def test_full_file(media):
+    prepared, body = _prepare(media)
+    assert prepared.status == 200
+    assert prepared.headers['Content-Length'] == str(len(BODY))
+    assert prepared.headers['Accept-Ranges'] == 'bytes'
+    assert body == BODY
+
+
+@pytest.mark.parametrize('header, start, stop', [
+    ('bytes=0-99', 0, 100),
+    ('bytes=1000-', 1000, 1024),
+    ('bytes=-24', 1000, 1024),
+    # an end past the file is clamped to it
+    ('bytes=1000-5000', 1000, 1024),
+])
+def test_range(media, header, start, stop):
+    prepared, body = _prepare(media, Range=header)
+    assert prepared.status == 206
+    assert prepared.headers['Content-Range'] == f'bytes {start}-{stop - 1}/{len(BODY)}'
+    assert prepared.headers['Content-Length'] == str(stop - start)
+    assert body == BODY[start:stop]
+
+
+def test_unsatisfiable_range(media):
+    prepared, body = _prepare(media, Range='bytes=2000-3000')
+    assert prepared.status == 416
+    assert prepared.headers['Content-Range'] == f'bytes */{len(BODY)}'
+    assert body is None
+
+
+def test_not_modified(media):
+    etag = _prepare(media)[0].headers['ETag']
+    prepared, body = _prepare(media, If_None_Match=etag)
+    assert prepared.status == 304
+    assert body is None
+    assert _prepare(media, If_None_Match='"other"')[0].status == 200
+
+
+def test_not_modified_since(media):
+    last_modified = _prepare(media)[0].headers['Last-Modified']
+    assert _prepare(media, If_Modified_Since=last_modified)[0].status == 304
+    assert _prepare(media, If_Modified_Since=http_date(0))[0].status == 200
+
+
+def test_stale_if_range_sends_whole_file(media):
+    prepared, body = _prepare(media, Range='bytes=0-9', If_Range='"other"')
+    assert prepared.status == 200
+    assert body == BODY
+    etag = prepared.headers['ETag']
+    assert _prepare(media, Range='bytes=0-9', If_Range=etag)[0].status == 206
+
+
+def test_serve_file_range(media):
+    app = Flask(__name__)
+    with app.test_request_context(headers={'Range': 'bytes=10-19'}):
+        response = serving.serve_file(media, download_name='clip.mp4')
+        assert response.status_code == 206
+        assert b''.join(response.response) == BODY[10:20]
+        response.close()
+    assert 'clip.mp4' in response.headers['Content-Disposition']
@@ -1,14 +1,32 @@
 import os
 import json
 import uuid
-from flask import Flask, request, render_template_string, send_file, jsonify
+import time
+from flask import Flask, Response, g, request, render_template_string, send_file, jsonify, url_for, stream_with_context
 from dotenv import load_dotenv
-from downloader import download_media
+from rq.job import Job
+import metrics
+import audio
+import cancel
+import clips
+import admission
+import storage
+import progress
+import jobstore
+import bandwidth
+import batch
+import scheduler
+import serving
+import streaming
+from downloader import download_media, get_info, summarize_info
+from tasks import redis_conn
 
 load_dotenv()
 
 app = Flask(__name__)
 
+SSE_KEEPALIVE_SECONDS = int(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))
+
 TEMPLATE = '''
 <!doctype html>
 <html lang="en">
@@ -341,9 +359,43 @@ TEMPLATE = '''
       <div class="form-group">
         <label for="kind"><span class="icon">🎬</span>Download Type</label>
         <select id="kind" name="kind">
-          <option value="video">🎥 Video (best quality)</option>
-          <option value="audio">🎵 Audio (MP3)</option>
+          <option value="video">🎥 Video</option>
+          <option value="audio">🎵 Audio</option>
+        </select>
+      </div>
+
+      <div class="form-group">
+        <label for="quality"><span class="icon">📺</span>Video Quality</label>
+        <select id="quality" name="quality">
+          <option value="best">Best available</option>
+          <option value="1080p">1080p</option>
+          <option value="720p">720p</option>
+          <option value="480p">480p</option>
+          <option value="360p">360p</option>
+          <option value="under:50M">Under 50 MB</option>
+          <option value="under:25M">Under 25 MB</option>
         </select>
+        <div class="helper-text">Used for video downloads; a ready-made file is preferred over merging separate streams</div>
+      </div>
+
+      <div class="form-group">
+        <label for="start"><span class="icon">✂️</span>Clip (Optional)</label>
+        <div style="display: flex; gap: 12px;">
+          <input id="start" name="start" type="text" placeholder="Start, e.g. 1:30">
+          <input id="end" name="end" type="text" placeholder="End, e.g. 2:45">
+        </div>
+        <div class="helper-text">Download only this part of the media; leave End empty to keep everything after Start</div>
+      </div>
+
+      <div class="form-group">
+        <label for="audio_format"><span class="icon">🎧</span>Audio Format</label>
+        <select id="audio_format" name="audio_format">
+          <option value="mp3">MP3</option>
+          <option value="m4a">M4A (AAC)</option>
+          <option value="opus">Opus</option>
+          <option value="best">Original (no conversion, fastest)</option>
+        </select>
+        <div class="helper-text">Used for audio downloads; the original codec is kept whenever the format allows it</div>
       </div>
 
       <div class="form-group">
@@ -357,6 +409,18 @@ TEMPLATE = '''
         <div class="helper-text">Only needed if age-restricted videos fail to download</div>
       </div>
 
+      <div class="form-group">
+        <label for="stream"><span class="icon">⚡</span>Stream Directly</label>
+        <input id="stream" name="stream" type="checkbox" style="width: 18px; height: 18px; accent-color: #00d4ff; cursor: pointer;">
+        <div class="helper-text">Start saving immediately while the media is fetched (single-file formats, no cookies)</div>
+      </div>
+
+      <div class="form-group">
+        <label for="playlist"><span class="icon">📚</span>Whole Playlist (ZIP)</label>
+        <input id="playlist" name="playlist" type="checkbox" style="width: 18px; height: 18px; accent-color: #00d4ff; cursor: pointer;">
+        <div class="helper-text">Download every entry of a playlist or channel and save them as one ZIP</div>
+      </div>
+
       <div class="button-group">
         <button type="submit">
           <span>⬇️ Download</span>
@@ -371,6 +435,15 @@ TEMPLATE = '''
 <script>
 const form = document.getElementById('dlForm');
 const resultDiv = document.getElementById('result');
+// the job being watched, cancelled if the page is closed before it ends
+let activeJob = null;
+
+window.addEventListener('pagehide', () => {
+  if (activeJob) {
+    fetch(activeJob.cancel_url, {method: 'DELETE', keepalive: true});
+    activeJob = null;
+  }
+});
 
 form.addEventListener('submit', (e) => {
   e.preventDefault();
@@ -382,45 +455,193 @@ form.addEventListener('submit', (e) => {
   }
 
   resultDiv.className = 'loading';
-  resultDiv.innerHTML = '<div class="loading-spinner"></div> Downloading... Please wait';
+  resultDiv.innerHTML = '<div class="loading-spinner"></div> Queued... Please wait';
 
   const formData = new FormData(form);
-  
-  fetch(form.action, {
+  // clips are cut by ffmpeg on the server, so they can't be passed through
+  const clipMode = formData.get('start').trim() || formData.get('end').trim();
+  const streamMode = document.getElementById('stream').checked && !formData.get('cookies').trim() && !clipMode;
+
+  if (document.getElementById('playlist').checked) {
+    startBatch(formData).catch(error => {
+      console.error('Download error:', error);
+      showError(error || 'Download failed. Please check the URL and try again.');
+    });
+    return;
+  }
+
+  (streamMode ? tryStream(url, formData.get('kind')) : Promise.resolve(false))
+  .then(started => started || startJob(formData))
+  .catch(error => {
+    console.error('Download error:', error);
+    showError(error || 'Download failed. Please check the URL and try again.');
+  });
+});
+
+function startJob(formData) {
+  return fetch('/jobs', {
     method: 'POST',
     body: formData
   })
   .then(response => {
-    if (!response.ok) {
-      return response.text().then(text => Promise.reject(text));
-    }
-    
-    // Extract filename from Content-Disposition header or use default
-    const disposition = response.headers.get('Content-Disposition');
-    let filename = 'download';
-    if (disposition) {
-      const matches = disposition.match(/filename="?(.+?)"?$/);
-      if (matches) filename = matches[1];
-    }
-    
-    return response.blob().then(blob => {
-      const url = window.URL.createObjectURL(blob);
-      const a = document.createElement('a');
-      a.href = url;
-      a.download = filename;
-      document.body.appendChild(a);
-      a.click();
-      window.URL.revokeObjectURL(url);
-      document.body.removeChild(a);
-      
-      showSuccess('File downloaded successfully!');
+    if (response.status === 503) {
+      // no background queue available: fall back to the blocking /start flow
+      return startSync();
+    }
+    return response.json().then(data => {
+      if (response.status === 429) {
+        // turned away while the server is busy: the sync fallback would be refused as well
+        return Promise.reject(`${data.error} (retry in ${data.retry_after}s)`);
+      }
+      if (!response.ok) {
+        return Promise.reject(data.error);
+      }
+      watchJob(data);
     });
+  });
+}
+
+function startBatch(formData) {
+  resultDiv.innerHTML = '<div class="loading-spinner"></div> Reading playlist...';
+  return fetch('/batches', {
+    method: 'POST',
+    body: formData
   })
+  .then(response => response.json().then(data => {
+    if (!response.ok) {
+      return Promise.reject(data.error);
+    }
+    return pollBatch(data.status_url);
+  }));
+}
+
+function pollBatch(statusUrl) {
+  return fetch(statusUrl)
+  .then(response => response.json().then(data => {
+    if (!response.ok) {
+      return Promise.reject(data.error);
+    }
+    const done = data.counts.finished + data.counts.error + data.counts.cancelled;
+    if (data.status !== 'finished') {
+      resultDiv.innerHTML = `<div class="loading-spinner"></div> Downloading playlist... ${done}/${data.total} (${data.percent}%)`;
+      return new Promise(resolve => setTimeout(resolve, 2000)).then(() => pollBatch(statusUrl));
+    }
+    if (!data.zip_url) {
+      return Promise.reject('None of the playlist entries could be downloaded');
+    }
+    nativeDownload(data.zip_url);
+    showSuccess(data.counts.error ? `ZIP started (${data.counts.error} of ${data.total} entries failed)` : 'ZIP download started!');
+  }));
+}
+
+// Resolves to true if the media could be streamed, false if a regular download is needed.
+function tryStream(url, kind) {
+  resultDiv.innerHTML = '<div class="loading-spinner"></div> Checking media...';
+  return fetch(`/info?url=${encodeURIComponent(url)}&platform=${encodeURIComponent(document.getElementById('platform').value)}`)
+  .then(response => response.json().then(data => {
+    if (!response.ok) {
+      return Promise.reject(data.error);
+    }
+    if (!data.streamable || !data.streamable[kind]) {
+      return false;
+    }
+    nativeDownload(`/stream?url=${encodeURIComponent(url)}&kind=${encodeURIComponent(kind)}`);
+    showSuccess('Download started!');
+    return true;
+  }));
+}
+
+// Hand the transfer to the browser's download manager instead of buffering it in memory.
+function nativeDownload(href) {
+  const a = document.createElement('a');
+  a.href = href;
+  a.download = '';
+  document.body.appendChild(a);
+  a.click();
+  document.body.removeChild(a);
+}
+
+function watchJob(job) {
+  activeJob = job;
+  if (!window.EventSource) {
+    pollJob(job.status_url);
+    return;
+  }
+  const source = new EventSource(job.events_url);
+  source.onmessage = (e) => {
+    try {
+      if (handleJobState(JSON.parse(e.data))) {
+        source.close();
+      }
+    } catch (error) {
+      source.close();
+      showError(error || 'Download failed. Please check the URL and try again.');
+    }
+  };
+  source.onerror = () => {
+    // stream unavailable (e.g. a proxy buffering it): fall back to polling
+    source.close();
+    pollJob(job.status_url);
+  };
+}
+
+function pollJob(statusUrl) {
+  fetch(statusUrl)
+  .then(response => response.json().then(data => {
+    if (!response.ok) {
+      return Promise.reject(data.error);
+    }
+    if (!handleJobState(data)) {
+      setTimeout(() => pollJob(statusUrl), 1000);
+    }
+  }))
   .catch(error => {
     console.error('Download error:', error);
     showError(error || 'Download failed. Please check the URL and try again.');
   });
-});
+}
+
+// Updates the page for a job state; returns true once the job is done.
+function handleJobState(data) {
+  if (['finished', 'error', 'cancelled'].includes(data.status)) {
+    activeJob = null;
+  }
+  if (data.status === 'finished') {
+    nativeDownload(data.file_url);
+    showSuccess('File downloaded successfully!');
+    return true;
+  }
+  if (data.status === 'error') {
+    throw data.error;
+  }
+  if (data.status === 'cancelled') {
+    throw 'Download cancelled';
+  }
+  let msg = 'Queued... Please wait';
+  if (data.status === 'downloading') {
+    msg = data.percent != null ? `Downloading... ${data.percent}%` : 'Downloading...';
+  } else if (data.status === 'processing') {
+    msg = 'Processing...';
+  } else if (data.status === 'retrying') {
+    msg = 'Download interrupted, resuming shortly...';
+  } else if (data.status === 'waiting') {
+    if (data.reason === 'backoff') {
+      msg = 'Source is rate limiting, retrying shortly...';
+    } else if (data.reason === 'transcode') {
+      msg = 'Waiting for a free converter...';
+    } else {
+      msg = 'Waiting for a free connection to the source...';
+    }
+  }
+  resultDiv.innerHTML = `<div class="loading-spinner"></div> ${msg}`;
+  return false;
+}
+
+function startSync() {
+  // a native form submission lets the browser save the attachment as it arrives
+  resultDiv.innerHTML = '<div class="loading-spinner"></div> Downloading... The file will be saved when ready';
+  form.submit();
+}
 
 function showError(msg) {
   resultDiv.className = 'error';
@@ -439,34 +660,383 @@ function showSuccess(msg) {
 </body>
 </html>
 '''
+@app.before_request
+def _start_timer():
+        g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _observe_request(response):
+        # handler latency; bodies streamed afterwards (files, SSE, ZIP) are timed as `transfer`
+        started = g.pop('request_started', None)
+        if started is not None and request.endpoint != 'prometheus_metrics':
+                metrics.REQUEST_SECONDS.labels(request.endpoint or 'unknown', request.method, str(response.status_code)).observe(time.perf_counter() - started)
+        return response
+
+
 @app.route('/')
 def index():
                 return render_template_string(TEMPLATE)
 
 
+def _client_id():
+        # scheduler fairness, bandwidth and admission quotas: the API token, else the client address;
+        # X-Forwarded-For only as far as TRUSTED_PROXIES wrote it
+        address = scheduler.client_address(request.headers.get('X-Forwarded-For'), request.remote_addr)
+        return scheduler.client_id_for(request.headers.get('X-API-Token'), address)
+
+
+def _rejected(e, as_json=True):
+        # over the admission budget: 429 with when to come back
+        body = jsonify({'error': str(e), 'retry_after': e.retry_after}) if as_json else str(e)
+        return body, 429, {'Retry-After': str(e.retry_after)}
+
+
+def _clip():
+        # optional clip section as (start, end) seconds; ValueError for an unreadable or empty one
+        return clips.parse_section(request.form.get('start'), request.form.get('end')) or (None, None)
+
+
+def _concurrent_fragments():
+        # optional per-job override of the platform's fragment concurrency
+        value = request.form.get('fragments', '').strip()
+        return int(value) if value.isdigit() and int(value) > 0 else None
+
+
 @app.route('/start', methods=['POST'])
 def start():
         # synchronous download: performs download immediately and returns file
         url = request.form.get('url', '').strip()
         kind = request.form.get('kind', 'video')
         platform = request.form.get('platform', 'auto')
+        audio_format = request.form.get('audio_format')
+        quality = request.form.get('quality')
         cookies_text = request.form.get('cookies', '').strip()
         if not url:
                 return 'Provide URL', 400
+        try:
+                clip_start, clip_end = _clip()
+        except ValueError as e:
+                return str(e), 400
+        client_id = _client_id()
+        # the download runs in this process, but takes its share of the same budget as queued jobs
+        lease = f'sync:{uuid.uuid4()}'
+        _, cost = scheduler.predict_cost(url, kind, quality, None if clip_start is None else (clip_start, clip_end))
+        try:
+                admission.admit(redis_conn, lease, client_id, cost)
+        except admission.Rejected as e:
+                print(f'[INFO] Download from {client_id} rejected ({e.reason}), retry after {e.retry_after}s', flush=True)
+                return _rejected(e, as_json=False)
 
+        # stop the download if the client goes away; the server's socket is only known to gunicorn and werkzeug
+        sock = request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
         # call downloader synchronously; disable redis writes for this immediate flow
         try:
-                path = download_media(url, kind=kind, job_id=None, cookies_text=cookies_text if cookies_text else None, max_filesize=None, use_redis=False)
+                path = download_media(url, kind=kind, job_id=None, cookies_text=cookies_text if cookies_text else None, max_filesize=None, use_redis=False,
+                                      concurrent_fragments=_concurrent_fragments(), platform=platform, audio_format=audio_format,
+                                      client_id=client_id, quality=quality, cancelled=(lambda: cancel.socket_closed(sock)) if sock is not None else None,
+                                      start=clip_start, end=clip_end)
+        except cancel.Cancelled:
+                print(f'[INFO] Client disconnected, download of {url} cancelled', flush=True)
+                return 'Download cancelled', 499
         except Exception as e:
                 error_msg = f'Error during download: {str(e)}'
                 print(f'[ERROR] {error_msg}', flush=True)  # log to container stdout
                 return error_msg, 500
+        finally:
+                admission.release(redis_conn, lease)
 
-        if not os.path.exists(path):
+        if not storage.exists(path):
                 error_msg = f'Download succeeded but file missing at {path}'
                 print(f'[ERROR] {error_msg}', flush=True)
                 return error_msg, 500
-        return send_file(path, as_attachment=True)
+        return serving.serve_file(path, client_id=client_id)
+
+
+def _job_states(job_ids, file_url=None):
+        """Combine the downloader's job state with the RQ job status, for many jobs in two
+        round trips (the second only for unfinished jobs). None for unknown jobs.
+        `file_url(job_id)` links finished files; url_for by default, which needs a Flask request."""
+        states = [state or {} for state in jobstore.read_many(job_ids, conn=redis_conn)]
+        open_ids = [job_id for job_id, state in zip(job_ids, states) if state.get('status') not in jobstore.FINAL_STATUSES]
+        jobs = dict(zip(open_ids, Job.fetch_many(open_ids, connection=redis_conn))) if open_ids else {}
+        out = []
+        for job_id, state in zip(job_ids, states):
+                result = state.pop('result', None)
+                if job_id in jobs:
+                        job = jobs[job_id]
+                        if job is None and not state:
+                                out.append(None)
+                                continue
+                        if job is not None and job.is_failed:
+                                # a worker that crashed or timed out never writes a final status
+                                state = {'status': 'error', 'error': 'Download job failed'}
+                        elif not state:
+                                state = {'status': job.get_status() or 'queued'}
+                state['job_id'] = job_id
+                if state.get('status') == 'finished' and result:
+                        state['file_url'] = file_url(job_id) if file_url else url_for('job_file', job_id=job_id)
+                out.append(state)
+        return out
+
+
+def _job_state(job_id):
+        """`_job_states` for one job."""
+        return _job_states([job_id])[0]
+
+
+@app.route('/info', methods=['GET', 'POST'])
+def info():
+        # metadata lookup without downloading; cached so a following download reuses it
+        url = (request.values.get('url') or '').strip()
+        platform = request.values.get('platform', 'auto')
+        cookies_text = request.form.get('cookies', '').strip()
+        if not url:
+                return jsonify({'error': 'Provide URL'}), 400
+        try:
+                media_info = get_info(url, cookies_text=cookies_text if cookies_text else None, platform=platform)
+        except Exception as e:
+                print(f'[ERROR] Info lookup failed: {e}', flush=True)
+                return jsonify({'error': str(e)}), 400
+        summary = summarize_info(media_info)
+        summary['streamable'] = {kind: streaming.select_stream_format(media_info, kind) is not None for kind in ('video', 'audio')}
+        return jsonify(summary)
+
+
+@app.route('/stream', methods=['GET'])
+def stream():
+        # pass-through download: bytes are sent while yt-dlp is still fetching them
+        url = request.args.get('url', '').strip()
+        kind = request.args.get('kind', 'video')
+        if not url:
+                return 'Provide URL', 400
+        client_id = _client_id()
+        path = streaming.cached_path(url, kind)
+        if path:
+                return serving.serve_file(path, client_id=client_id)
+        # a new download like /start: leased against the admission budget until the response ends
+        lease = f'stream:{uuid.uuid4()}'
+        _, cost = scheduler.predict_cost(url, kind)
+        try:
+                admission.admit(redis_conn, lease, client_id, cost)
+        except admission.Rejected as e:
+                print(f'[INFO] Stream for {client_id} rejected ({e.reason}), retry after {e.retry_after}s', flush=True)
+                return _rejected(e, as_json=False)
+        try:
+                opened = streaming.open_stream(url, kind=kind)
+        except Exception as e:
+                admission.release(redis_conn, lease)
+                error_msg = f'Error during streaming: {str(e)}'
+                print(f'[ERROR] {error_msg}', flush=True)
+                return error_msg, 502
+        if opened is None:
+                admission.release(redis_conn, lease)
+                return 'This media has no single-file format that can be streamed; use a regular download', 409
+        filename, chunks = opened
+
+        def close():
+                try:
+                        chunks.close()
+                finally:
+                        admission.release(redis_conn, lease)
+
+        try:
+                response = Response(bandwidth.pace(chunks, redis_conn, client_id, ingress=True), mimetype='application/octet-stream')
+                response.headers.set('Content-Disposition', 'attachment', filename=filename)
+                response.headers['X-Accel-Buffering'] = 'no'
+                # also when the body is never iterated: stops yt-dlp and removes its temporary files
+                response.call_on_close(close)
+        except BaseException:
+                close()
+                raise
+        return response
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+        # asynchronous download: queues a job behind the scheduler and returns immediately
+        url = request.form.get('url', '').strip()
+        kind = request.form.get('kind', 'video')
+        platform = request.form.get('platform', 'auto')
+        audio_format = request.form.get('audio_format')
+        quality = request.form.get('quality')
+        cookies_text = request.form.get('cookies', '').strip()
+        if not url:
+                return jsonify({'error': 'Provide URL'}), 400
+        try:
+                clip_start, clip_end = _clip()
+        except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        client_id = _client_id()
+        try:
+                job_id = scheduler.submit(url, kind=kind, cookies_text=cookies_text if cookies_text else None, client_id=client_id,
+                                          concurrent_fragments=_concurrent_fragments(), platform=platform, audio_format=audio_format,
+                                          quality=quality, start=clip_start, end=clip_end, admit=True)
+        except admission.Rejected as e:
+                print(f'[INFO] Download from {client_id} rejected ({e.reason}), retry after {e.retry_after}s', flush=True)
+                return _rejected(e)
+        except Exception as e:
+                print(f'[ERROR] Could not queue download: {e}', flush=True)
+                return jsonify({'error': 'Background queue unavailable'}), 503
+        return jsonify({
+                'job_id': job_id,
+                'status_url': url_for('job_status', job_id=job_id),
+                'events_url': url_for('job_events', job_id=job_id),
+                'cancel_url': url_for('cancel_job', job_id=job_id),
+        }), 202
+
+
+@app.route('/batches', methods=['POST'])
+def create_batch():
+        # playlist/channel: expands the entries and downloads them as jobs, a few at a time
+        url = request.form.get('url', '').strip()
+        kind = request.form.get('kind', 'video')
+        platform = request.form.get('platform', 'auto')
+        audio_format = request.form.get('audio_format')
+        quality = request.form.get('quality')
+        cookies_text = request.form.get('cookies', '').strip()
+        if not url:
+                return jsonify({'error': 'Provide URL'}), 400
+        client_id = _client_id()
+        try:
+                created = batch.create(url, kind=kind, cookies_text=cookies_text if cookies_text else None, client_id=client_id, platform=platform,
+                                       audio_format=audio_format, quality=quality)
+        except admission.Rejected as e:
+                print(f'[INFO] Batch from {client_id} rejected ({e.reason}), retry after {e.retry_after}s', flush=True)
+                return _rejected(e)
+        except RuntimeError as e:
+                print(f'[ERROR] Batch expansion failed: {e}', flush=True)
+                return jsonify({'error': str(e)}), 400
+        except Exception as e:
+                print(f'[ERROR] Could not queue batch: {e}', flush=True)
+                return jsonify({'error': 'Background queue unavailable'}), 503
+        created.update({
+                'status_url': url_for('batch_status', batch_id=created['batch_id']),
+                'zip_url': url_for('batch_zip', batch_id=created['batch_id']),
+        })
+        return jsonify(created), 202
+
+
+@app.route('/batches/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+        state = batch.status(batch_id)
+        if state is None:
+                return jsonify({'error': 'Unknown batch'}), 404
+        if state['status'] == 'finished' and state['counts']['finished']:
+                state['zip_url'] = url_for('batch_zip', batch_id=batch_id)
+        return jsonify(state)
+
+
+@app.route('/batches/<batch_id>/zip', methods=['GET'])
+def batch_zip(batch_id):
+        state = batch.status(batch_id)
+        if state is None:
+                return 'Unknown batch', 404
+        if state['status'] != 'finished':
+                return 'Batch still downloading', 409
+        files = batch.finished_files(batch_id)
+        if not files:
+                return 'No finished files available', 410
+        # the archive is built while it is sent, so its length is not known up front
+        response = Response(bandwidth.pace(batch.stream_zip(files), redis_conn, _client_id()), mimetype='application/zip')
+        response.headers.set('Content-Disposition', 'attachment', filename=f'{state["title"] or "playlist"}.zip')
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
+@app.route('/queue/stats', methods=['GET'])
+def queue_stats():
+        return jsonify(scheduler.lane_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE_LATEST)
+
+
+@app.route('/transcode/stats', methods=['GET'])
+def transcode_stats():
+        return jsonify(audio.pool_stats(redis_conn))
+
+
+@app.route('/jobs/status', methods=['GET', 'POST'])
+def job_statuses():
+        # many jobs at once for dashboards and pollers: ?ids=a,b,c or a JSON body {"ids": [...]}
+        body = request.get_json(silent=True) or {}
+        ids = body.get('ids') if isinstance(body.get('ids'), list) else [i for i in request.values.get('ids', '').split(',') if i]
+        ids = [str(i) for i in ids]
+        if not ids:
+                return jsonify({'error': 'Provide ids'}), 400
+        if len(ids) > jobstore.JOB_STATUS_MAX_IDS:
+                return jsonify({'error': f'At most {jobstore.JOB_STATUS_MAX_IDS} ids per request'}), 400
+        return jsonify({job_id: state for job_id, state in zip(ids, _job_states(ids))})
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+        state = _job_state(job_id)
+        if state is None:
+                return jsonify({'error': 'Unknown job'}), 404
+        return jsonify(state)
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+        # stops the download wherever it is: waiting in the scheduler, queued, retrying or running
+        try:
+                status = scheduler.cancel(job_id)
+        except Exception as e:
+                print(f'[ERROR] Could not cancel job {job_id}: {e}', flush=True)
+                return jsonify({'error': 'Background queue unavailable'}), 503
+        if status is None:
+                return jsonify({'error': 'Unknown job'}), 404
+        if status not in ('cancelled', 'cancelling'):
+                return jsonify({'job_id': job_id, 'status': status, 'error': 'Job already ended'}), 409
+        return jsonify({'job_id': job_id, 'status': status}), 202 if status == 'cancelling' else 200
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+        # Server-Sent Events: one pub/sub subscription per watcher instead of a polling loop
+        if _job_state(job_id) is None:
+                return jsonify({'error': 'Unknown job'}), 404
+
+        def stream():
+                pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(progress.channel(job_id))
+                try:
+                        # read the state after subscribing so no update is missed in between
+                        state = _job_state(job_id) or {'status': 'error', 'error': 'Unknown job'}
+                        yield f'data: {json.dumps(state)}\n\n'
+                        while state.get('status') not in jobstore.FINAL_STATUSES:
+                                message = pubsub.get_message(timeout=SSE_KEEPALIVE_SECONDS)
+                                if message is None:
+                                        # also catches workers that died without a final update
+                                        state = _job_state(job_id) or {'status': 'error', 'error': 'Unknown job'}
+                                        yield f'data: {json.dumps(state)}\n\n'
+                                        continue
+                                state = json.loads(message['data'])
+                                if state.get('status') in jobstore.FINAL_STATUSES:
+                                        # the job's state may have expired or been deleted meanwhile
+                                        state = _job_state(job_id) or {'status': 'error', 'error': 'Unknown job'}
+                                state['job_id'] = job_id
+                                yield f'data: {json.dumps(state)}\n\n'
+                finally:
+                        pubsub.close()
+
+        return Response(stream_with_context(stream()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/jobs/<job_id>/file', methods=['GET'])
+def job_file(job_id):
+        state = jobstore.read(job_id, conn=redis_conn)
+        path = state and state['result']
+        if not path:
+                return 'Result not ready', 404
+        try:
+                return serving.serve_file(path, client_id=_client_id())
+        except FileNotFoundError:
+                return 'Result file no longer available', 410
 
 
 @app.route('/demo', methods=['GET', 'POST'])
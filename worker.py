@@ -0,0 +1,171 @@
+"""
+Warm worker pool for the download queues.
+
+`rq worker` forks a work-horse for every job, and the horse imports the downloader (and yt-dlp's
+extractor registry) from scratch each time. This pool warms one parent process up front with
+`downloader.warm_up()` and forks WORKER_PROCESSES children from it. Each child runs an RQ
+`SimpleWorker`, which executes jobs in the already-warm process instead of forking per job.
+Children that exit (crash, or recycled after WORKER_MAX_JOBS jobs) are replaced by a new fork
+of the warm parent; the job of a child that died mid-job goes to its retry policy right away.
+One more child runs RQ's scheduler, which puts jobs back on their queue when their retry
+backoff is over (only one scheduler per queue is active across all machines).
+On SIGTERM children finish their job for WORKER_SHUTDOWN_GRACE seconds, then stop it, so it is
+retried (and resumed) by the next worker instead of being killed with the container.
+
+Usage: python worker.py [queue ...]   (default: the scheduler lanes, fast first)
+"""
+import os
+import sys
+import time
+import uuid
+import signal
+from rq import Queue, SimpleWorker
+from rq.scheduler import RQScheduler
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
+import metrics
+import jobstore
+import downloader
+from scheduler import LANE_QUEUES
+
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '2'))
+# Replace a worker process after this many jobs to bound memory growth; 0 disables
+WORKER_MAX_JOBS = int(os.getenv('WORKER_MAX_JOBS', '200'))
+# A child exiting sooner than this after its start is restarted with a delay, not in a tight loop
+RESTART_BACKOFF_SECONDS = 5
+# Seconds a job may keep running after SIGTERM before it is stopped and left to its retry policy
+WORKER_SHUTDOWN_GRACE = int(os.getenv('WORKER_SHUTDOWN_GRACE', '5'))
+
+
+def _run_child(queue_names, name):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    # the shared pool drops the parent's connections after the fork and opens its own
+    connection = jobstore.client
+    if name is None:
+        scheduler = RQScheduler(queue_names, connection=connection)
+        # it would build its own client from the pool's kwargs, which newer redis-py rejects
+        scheduler._connection = connection
+        scheduler.work()
+        return
+    queues = [Queue(queue_name, connection=connection) for queue_name in queue_names]
+    worker = SimpleWorker(queues, connection=connection, name=name)
+    worker.work(max_jobs=WORKER_MAX_JOBS or None)
+
+
+def _requeue_abandoned(name):
+    """Hand the job a dead child was running to its retry policy (or fail it), as RQ does for a
+    job that raised; it would otherwise count as started until its timeout."""
+    connection = jobstore.client
+    worker = SimpleWorker.find_by_key(SimpleWorker.redis_worker_namespace_prefix + name, connection=connection)
+    if worker is None:
+        return
+    job_id = worker.get_current_job_id()
+    worker.register_death()
+    if job_id is None:
+        return
+    try:
+        job = Job.fetch(job_id, connection=connection)
+    except NoSuchJobError:
+        return
+    error = RuntimeError('Worker process died')
+    if job.failure_callback:
+        try:
+            job.failure_callback(job, connection, RuntimeError, error, None)
+        except Exception as e:
+            print(f'[WARN] Failure callback of job {job_id} failed: {e}', flush=True)
+    queue = Queue(job.origin, connection=connection)
+    with connection.pipeline() as pipe:
+        queue.started_job_registry.remove(job, pipeline=pipe)
+        if job.retries_left:
+            job.retry(queue, pipe)
+        else:
+            job.set_status(JobStatus.FAILED, pipeline=pipe)
+            queue.failed_job_registry.add(job, ttl=job.failure_ttl, exc_string=str(error), pipeline=pipe)
+        pipe.execute()
+    print(f'[INFO] Job {job_id} of the dead worker process {"will be retried" if job.retries_left else "failed"}', flush=True)
+
+
+def _spawn(queue_names, name):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            _run_child(queue_names, name)
+        except BaseException as e:
+            print(f'[ERROR] Worker process failed: {e}', flush=True)
+            status = 1
+        finally:
+            os._exit(status)
+    return pid
+
+
+def main(queue_names):
+    started = time.perf_counter()
+    downloader.warm_up()
+    print(f'[INFO] Worker pool warmed up in {time.perf_counter() - started:.2f}s; '
+          f'starting {WORKER_PROCESSES} processes on {", ".join(queue_names)}', flush=True)
+
+    stopping = False
+
+    def _forward(signum):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        if signum == signal.SIGTERM:
+            # Ctrl-C already reaches the whole process group; SIGTERM is forwarded so each
+            # child finishes its current job first (RQ warm shutdown)...
+            _forward(signal.SIGTERM)
+            signal.alarm(WORKER_SHUTDOWN_GRACE)
+
+    def _force_stop(signum, frame):
+        # ...for a while: a second SIGTERM stops the job (RQ cold shutdown), which RQ retries
+        _forward(signal.SIGTERM)
+
+    children = {}
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGALRM, _force_stop)
+    # worker processes have a name to find their current job by; the scheduler has none
+    for name in [uuid.uuid4().hex for _ in range(WORKER_PROCESSES)] + [None]:
+        children[_spawn(queue_names, name)] = (time.monotonic(), name)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        child = children.pop(pid, None)
+        metrics.mark_process_dead(pid)
+        if child is None:
+            continue
+        started_at, name = child
+        code = os.waitstatus_to_exitcode(status)
+        if code != 0 and name is not None:
+            try:
+                _requeue_abandoned(name)
+            except Exception as e:
+                print(f'[WARN] Could not requeue the job of worker process {pid}: {e}', flush=True)
+        if stopping:
+            continue
+        if code != 0:
+            print(f'[WARN] {"Worker" if name else "Scheduler"} process {pid} exited with status {code}, restarting', flush=True)
+        if time.monotonic() - started_at < RESTART_BACKOFF_SECONDS:
+            time.sleep(RESTART_BACKOFF_SECONDS)
+            if stopping:
+                continue
+        name = name and uuid.uuid4().hex
+        children[_spawn(queue_names, name)] = (time.monotonic(), name)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or list(LANE_QUEUES.values()))